@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+
+
+# Request body formats accepted by the batch endpoints, by Content-Type.
+JSON_TYPES = ('application/json',)
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+CSV_TYPES = ('text/csv',)
+
+
+def _variable(where, name, value):
+    # Expr numbers are floats; JSON integers are converted so rows behave like literals.
+    if isinstance(value, bool) or isinstance(value, float):
+        return value
+    if isinstance(value, int):
+        return float(value)
+    raise ValueError(f"{where}: '{name}' must be a number or a boolean, got {value!r}.")
+
+
+def _variables(where, row):
+    if not isinstance(row, dict):
+        raise ValueError(f"{where}: expected an object of variables, got {row!r}.")
+    return {name: _variable(where, name, value) for name, value in row.items()}
+
+
+def _json_row(row_number, row):
+    return _variables(f"Row {row_number}", row)
+
+
+def parse_env(env):
+    """Validates a decoded JSON object of initial variables, converting integers to floats."""
+    return _variables("env", env)
+
+
+def parse_rows(body: bytes, content_type: str):
+    """Parses a batch request body into a list of variable dicts (one per row).
+
+    Accepts a JSON array of objects, NDJSON (one object per line) or CSV with a header
+    row naming the variables; empty CSV cells leave the variable unset. Raises
+    ValueError with a message suitable for a 400 response on malformed input.
+    """
+    media_type = content_type.split(';')[0].strip().lower() or JSON_TYPES[0]
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError("Request body must be UTF-8.") from None
+
+    if media_type in JSON_TYPES:
+        try:
+            rows = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}") from None
+        if not isinstance(rows, list):
+            raise ValueError("Expected a JSON array of rows.")
+        return [_json_row(number, row) for number, row in enumerate(rows)]
+
+    if media_type in NDJSON_TYPES:
+        rows = []
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON on line {line_number}: {e}") from None
+            rows.append(_json_row(len(rows), row))
+        return rows
+
+    if media_type in CSV_TYPES:
+        rows = []
+        for number, record in enumerate(csv.DictReader(io.StringIO(text))):
+            row = {}
+            for name, cell in record.items():
+                if name is None or cell is None:
+                    raise ValueError(f"Row {number}: has more or fewer cells than the header.")
+                if cell.strip():
+                    try:
+                        row[name.strip()] = float(cell)
+                    except ValueError:
+                        raise ValueError(f"Row {number}: '{name}' is not a number: {cell!r}.") from None
+            rows.append(row)
+        return rows
+
+    raise ValueError(f"Unsupported Content-Type '{media_type}'; "
+                     f"use {', '.join(JSON_TYPES + NDJSON_TYPES + CSV_TYPES)}.")
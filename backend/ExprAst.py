@@ -0,0 +1,612 @@
+import operator
+from enum import IntEnum
+from ExprParser import ExprParser
+from ExprVisitor import ExprVisitor
+
+
+# Operator codes, resolved once while lowering so evaluation never looks at token text.
+class Op(IntEnum):
+    ADD = 0
+    SUB = 1
+    MUL = 2
+    DIV = 3
+    MOD = 4
+    EQ = 5
+    NE = 6
+    LT = 7
+    LE = 8
+    GT = 9
+    GE = 10
+    AND = 11
+    OR = 12
+    POS = 13
+    NEG = 14
+    NOT = 15
+
+
+OP_FROM_TEXT = {
+    '+': Op.ADD, '-': Op.SUB, '*': Op.MUL, '/': Op.DIV, '%': Op.MOD,
+    '==': Op.EQ, '!=': Op.NE, '<': Op.LT, '<=': Op.LE, '>': Op.GT, '>=': Op.GE,
+}
+
+OP_TEXT = {op: text for text, op in OP_FROM_TEXT.items()}
+OP_TEXT.update({Op.AND: 'and', Op.OR: 'or', Op.POS: '+', Op.NEG: '-', Op.NOT: 'not'})
+
+
+# ---- AST Nodes ----
+# Every node records `tok`, the index of its first token in the token stream.
+# Line/column are looked up through Program.positions only when an error is reported.
+class Node:
+    __slots__ = ('tok',)
+
+
+class Const(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value, tok):
+        self.value = value
+        self.tok = tok
+
+
+class Name(Node):
+    __slots__ = ('name',)
+
+    def __init__(self, name, tok):
+        self.name = name
+        self.tok = tok
+
+
+class BinOp(Node):
+    """Arithmetic (+ - * / %) and boolean (and/or) binary operations."""
+    __slots__ = ('op', 'left', 'right')
+
+    def __init__(self, op, left, right, tok):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.tok = tok
+
+
+class Compare(Node):
+    """A comparison chain such as `a < b <= c`."""
+    __slots__ = ('ops', 'operands')
+
+    def __init__(self, ops, operands, tok):
+        self.ops = ops
+        self.operands = operands
+        self.tok = tok
+
+
+class Unary(Node):
+    __slots__ = ('op', 'operand')
+
+    def __init__(self, op, operand, tok):
+        self.op = op
+        self.operand = operand
+        self.tok = tok
+
+
+class Pow(Node):
+    __slots__ = ('base', 'exponent')
+
+    def __init__(self, base, exponent, tok):
+        self.base = base
+        self.exponent = exponent
+        self.tok = tok
+
+
+class Scientific(Node):
+    """`NUMBER x10^ expr`: the mantissa is a float, the exponent an expression."""
+    __slots__ = ('mantissa', 'exponent')
+
+    def __init__(self, mantissa, exponent, tok):
+        self.mantissa = mantissa
+        self.exponent = exponent
+        self.tok = tok
+
+
+class Assign(Node):
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name, value, tok):
+        self.name = name
+        self.value = value
+        self.tok = tok
+
+
+class Assert(Node):
+    # `tok` points at the asserted expression, which is where failures are reported.
+    __slots__ = ('expr',)
+
+    def __init__(self, expr, tok):
+        self.expr = expr
+        self.tok = tok
+
+
+class Print(Node):
+    __slots__ = ('expr',)
+
+    def __init__(self, expr, tok):
+        self.expr = expr
+        self.tok = tok
+
+
+class Program:
+    """Lowered statements plus the source and the (line, column) of every token, indexed by `Node.tok`."""
+    __slots__ = ('stats', 'source', 'positions', '_depth', '_largest')
+
+    def __init__(self, stats, source, positions):
+        self.stats = stats
+        self.source = source
+        self.positions = positions
+        self._depth = None
+        self._largest = None
+
+    def relocate(self, source, positions):
+        """Same statements, attached to another source with an identical token stream."""
+        program = Program(self.stats, source, positions)
+        # Computed once on the cached original, not per copy
+        program._depth, program._largest = self.depth, self.largest
+        return program
+
+    def head(self, count):
+        """A program of just the first `count` statements."""
+        return Program(self.stats[:count], self.source, self.positions)
+
+    @property
+    def depth(self):
+        """Depth of the deepest statement tree (computed once)."""
+        if self._depth is None:
+            self._depth = max((max_depth(stat) for stat in self.stats), default=0)
+        return self._depth
+
+    @property
+    def largest(self):
+        """Number of nodes in the largest statement (computed once)."""
+        if self._largest is None:
+            self._largest = max((count_nodes(stat) for stat in self.stats), default=0)
+        return self._largest
+
+
+class ExprRuntimeError(Exception):
+    """Raised while evaluating an AST; the Interpreter turns it into a located CustomRuntimeError."""
+
+    def __init__(self, node, message):
+        self.node = node
+        self.message = message
+        super().__init__(message)
+
+
+class RunCancelled(Exception):
+    """Raised by CancelToken.check() once the token has been cancelled."""
+
+
+class CancelToken:
+    """Stops a run from another thread: evaluators call check() between statements.
+
+    The StackEvaluator also checks every CANCEL_CHECK_INTERVAL nodes, and compiled
+    statements about as often (see ExprCompiler.checkpoints), since a single large
+    statement can take long. The AstEvaluator only checks between statements, so
+    cancellable runs of larger statements use the StackEvaluator (see Interpreter).
+    """
+    __slots__ = ('cancelled',)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise RunCancelled()
+
+
+# ---- Lowering: ANTLR parse tree -> AST ----
+class AstBuilder(ExprVisitor):
+    """Turns an ExprParser.ProgContext into a Program of compact AST nodes."""
+
+    def build(self, tree: ExprParser.ProgContext, tokens, source):
+        stats = [self.visit(stat) for stat in tree.stat()]
+        positions = [(t.line, t.column) for t in tokens]
+        return Program(stats, source, positions)
+
+    # ---- Statements ----
+    def visitStat(self, ctx: ExprParser.StatContext):
+        return self.visit(ctx.getChild(0))
+
+    def visitAssignment(self, ctx: ExprParser.AssignmentContext):
+        return Assign(ctx.ID().getText(), self.visit(ctx.expr()), ctx.start.tokenIndex)
+
+    def visitAssertStat(self, ctx: ExprParser.AssertStatContext):
+        expr = ctx.expr()
+        return Assert(self.visit(expr), expr.start.tokenIndex)
+
+    def visitPrintStat(self, ctx: ExprParser.PrintStatContext):
+        return Print(self.visit(ctx.expr()), ctx.start.tokenIndex)
+
+    # ---- Expressions ----
+    def visitExpr(self, ctx: ExprParser.ExprContext):
+        return self.visit(ctx.orExpr())
+
+    def _lower_chain(self, ctx, operands, ops):
+        # Left-associative chains (a op b op c) become nested BinOp nodes.
+        result = self.visit(operands[0])
+        for op, operand in zip(ops, operands[1:]):
+            result = BinOp(op, result, self.visit(operand), ctx.start.tokenIndex)
+        return result
+
+    def visitOrExpr(self, ctx: ExprParser.OrExprContext):
+        return self._lower_chain(ctx, ctx.andExpr(), [Op.OR] * len(ctx.OR()))
+
+    def visitAndExpr(self, ctx: ExprParser.AndExprContext):
+        return self._lower_chain(ctx, ctx.notExpr(), [Op.AND] * len(ctx.AND()))
+
+    def visitNotExpr(self, ctx: ExprParser.NotExprContext):
+        if ctx.NOT():
+            return Unary(Op.NOT, self.visit(ctx.notExpr()), ctx.start.tokenIndex)
+        return self.visit(ctx.cmpExpr())
+
+    def visitCmpExpr(self, ctx: ExprParser.CmpExprContext):
+        operands = [self.visit(operand) for operand in ctx.addSubExpr()]
+        if len(operands) == 1:
+            return operands[0]
+        ops = tuple(OP_FROM_TEXT[op.getText()] for op in ctx.COMPARE())
+        return Compare(ops, tuple(operands), ctx.start.tokenIndex)
+
+    def visitAddSubExpr(self, ctx: ExprParser.AddSubExprContext):
+        ops = [OP_FROM_TEXT[op.getText()] for op in ctx.ADD_SUB()]
+        return self._lower_chain(ctx, ctx.mulDivExpr(), ops)
+
+    def visitMulDivExpr(self, ctx: ExprParser.MulDivExprContext):
+        ops = [OP_FROM_TEXT[op.getText()] for op in ctx.MUL_DIV()]
+        return self._lower_chain(ctx, ctx.unaryExpr(), ops)
+
+    def visitUnaryExpr(self, ctx: ExprParser.UnaryExprContext):
+        if ctx.ADD_SUB():
+            op = Op.POS if ctx.ADD_SUB().getText() == '+' else Op.NEG
+            return Unary(op, self.visit(ctx.unaryExpr()), ctx.start.tokenIndex)
+        return self.visit(ctx.powExpr())
+
+    def visitPowExpr(self, ctx: ExprParser.PowExprContext):
+        base = self.visit(ctx.atom())
+        if ctx.powExpr():
+            return Pow(base, self.visit(ctx.powExpr()), ctx.start.tokenIndex)
+        return base
+
+    # ---- Atoms ----
+    def visitAtom(self, ctx: ExprParser.AtomContext):
+        if ctx.ID():
+            token = ctx.ID().getPayload()
+            return Name(token.text, token.tokenIndex)
+        if ctx.numberExpr(): return self.visit(ctx.numberExpr())
+        if ctx.scientificExpr(): return self.visit(ctx.scientificExpr())
+        if ctx.expr(): return self.visit(ctx.expr())
+        raise Exception("Unknown atom type")
+
+    def visitNumberExpr(self, ctx: ExprParser.NumberExprContext):
+        return Const(float(ctx.NUMBER().getText()), ctx.start.tokenIndex)
+
+    def visitScientificExpr(self, ctx: ExprParser.ScientificExprContext):
+        mantissa = float(ctx.NUMBER().getText())
+        return Scientific(mantissa, self.visit(ctx.expr()), ctx.start.tokenIndex)
+
+
+# Trees deeper than this run on the StackEvaluator: the optimizer, the compiler and the
+# recursive evaluators use up to ~4 Python frames per level, and the default limit is 1000.
+MAX_RECURSIVE_DEPTH = 150
+
+
+def children(node):
+    """The child nodes of `node`, in evaluation order."""
+    t = type(node)
+    if t is BinOp:
+        return (node.left, node.right)
+    if t is Compare:
+        return node.operands
+    if t is Unary:
+        return (node.operand,)
+    if t is Pow:
+        return (node.base, node.exponent)
+    if t is Scientific:
+        return (node.exponent,)
+    if t is Assign:
+        return (node.value,)
+    if t is Assert or t is Print:
+        return (node.expr,)
+    return ()
+
+
+# Both walks use an explicit stack, so they work on trees of any depth.
+def count_nodes(node):
+    """Number of AST nodes in the subtree rooted at `node`."""
+    count, pending = 0, [node]
+    while pending:
+        count += 1
+        pending.extend(children(pending.pop()))
+    return count
+
+
+def max_depth(node):
+    """Number of nodes on the longest root-to-leaf path of the subtree rooted at `node`."""
+    depth, pending = 0, [(node, 1)]
+    while pending:
+        node, level = pending.pop()
+        if level > depth:
+            depth = level
+        pending.extend((child, level + 1) for child in children(node))
+    return depth
+
+
+def lower(tree: ExprParser.ProgContext, tokens, source):
+    """Lowers a parse tree to a Program; `tokens` is the lexed token list (stream.tokens)."""
+    return AstBuilder().build(tree, tokens, source)
+
+
+# ---- Evaluation ----
+class SkipCounter:
+    """Tally of operands skipped by short-circuiting `and`/`or`."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.subtrees = 0
+        self.nodes = 0
+
+
+class AstEvaluator:
+    """Evaluates a lowered Program with the same semantics as the Interpreter visitor.
+
+    `on_print(value)` receives printed values. Assertion failures and undefined
+    variables raise ExprRuntimeError carrying the offending node.
+
+    With `lazy_bool`, `and`/`or` skip their right operand once the left one decides
+    the result; skipped subtrees and their node counts are tallied in `skipped`.
+    With a `cancel_token`, run() raises RunCancelled between statements once it is cancelled.
+    """
+
+    def __init__(self, env, on_print, lazy_bool=False, cancel_token=None):
+        self.env = env
+        self.on_print = on_print
+        self.lazy_bool = lazy_bool
+        self.cancel_token = cancel_token
+        self.skipped = SkipCounter()
+        self._dispatch = {
+            Const: self._eval_const,
+            Name: self._eval_name,
+            BinOp: self._eval_binop,
+            Compare: self._eval_compare,
+            Unary: self._eval_unary,
+            Pow: self._eval_pow,
+            Scientific: self._eval_scientific,
+            Assign: self._eval_assign,
+            Assert: self._eval_assert,
+            Print: self._eval_print,
+        }
+
+    def run(self, program: Program):
+        result = None
+        cancel = self.cancel_token
+        for stat in program.stats:
+            if cancel is not None:
+                cancel.check()
+            result = self.eval(stat)
+        return result
+
+    def eval(self, node):
+        return self._dispatch[type(node)](node)
+
+    # ---- Statements ----
+    def _eval_assign(self, node):
+        value = self.eval(node.value)
+        self.env[node.name] = value
+        return value
+
+    def _eval_assert(self, node):
+        value = self.eval(node.expr)
+        if not value:
+            raise ExprRuntimeError(node, "Assertion failed.")
+        return value
+
+    def _eval_print(self, node):
+        value = self.eval(node.expr)
+        self.on_print(value)
+        return value
+
+    # ---- Expressions ----
+    def _eval_const(self, node):
+        return node.value
+
+    def _eval_name(self, node):
+        try:
+            return self.env[node.name]
+        except KeyError:
+            raise ExprRuntimeError(node, f"Undefined variable '{node.name}'.") from None
+
+    def _eval_binop(self, node):
+        if self.lazy_bool and node.op in (Op.AND, Op.OR):
+            return self._eval_lazy_bool(node)
+        left = self.eval(node.left)
+        right = self.eval(node.right)
+        match node.op:
+            case Op.ADD: return left + right
+            case Op.SUB: return left - right
+            case Op.MUL: return left * right
+            case Op.DIV: return left / right
+            case Op.MOD: return left % right
+            # Both operands are always evaluated, matching visitOrExpr/visitAndExpr.
+            case Op.AND: return bool(left) and bool(right)
+            case Op.OR: return bool(left) or bool(right)
+        raise RuntimeError(f"Unknown binary operator: {node.op!r}")
+
+    def _eval_lazy_bool(self, node):
+        left = bool(self.eval(node.left))
+        if left == (node.op == Op.OR):
+            self.skipped.subtrees += 1
+            self.skipped.nodes += count_nodes(node.right)
+            return left
+        return bool(self.eval(node.right))
+
+    def _eval_compare(self, node):
+        operands = node.operands
+        left = self.eval(operands[0])
+        for op, operand in zip(node.ops, operands[1:]):
+            right = self.eval(operand)
+            match op:
+                case Op.EQ: ok = left == right
+                case Op.NE: ok = left != right
+                case Op.LT: ok = left < right
+                case Op.LE: ok = left <= right
+                case Op.GT: ok = left > right
+                case Op.GE: ok = left >= right
+                case _: raise RuntimeError(f"Unknown comparison operator: {op!r}")
+            if not ok:
+                return False
+            left = right
+        return True
+
+    def _eval_unary(self, node):
+        value = self.eval(node.operand)
+        match node.op:
+            case Op.NOT: return not value
+            case Op.NEG: return -value
+            case Op.POS: return +value
+        raise RuntimeError(f"Unknown unary operator: {node.op!r}")
+
+    def _eval_pow(self, node):
+        return self.eval(node.base) ** self.eval(node.exponent)
+
+    def _eval_scientific(self, node):
+        return node.mantissa * (10 ** self.eval(node.exponent))
+
+
+ARITHMETIC_FUNCS = {
+    Op.ADD: operator.add, Op.SUB: operator.sub, Op.MUL: operator.mul,
+    Op.DIV: operator.truediv, Op.MOD: operator.mod,
+    # Both operands are always evaluated, matching visitOrExpr/visitAndExpr.
+    Op.AND: lambda left, right: bool(left) and bool(right),
+    Op.OR: lambda left, right: bool(left) or bool(right),
+}
+
+COMPARE_FUNCS = {
+    Op.EQ: operator.eq, Op.NE: operator.ne, Op.LT: operator.lt,
+    Op.LE: operator.le, Op.GT: operator.gt, Op.GE: operator.ge,
+}
+
+UNARY_FUNCS = {Op.NOT: operator.not_, Op.NEG: operator.neg, Op.POS: operator.pos}
+
+# StackEvaluator work items that finish a node once its operands are on the value stack.
+(_FINISH_BINOP, _FINISH_LAZY, _FINISH_BOOL, _FINISH_COMPARE, _FINISH_UNARY, _FINISH_POW,
+ _FINISH_SCIENTIFIC, _FINISH_ASSIGN, _FINISH_ASSERT, _FINISH_PRINT) = range(10)
+
+
+# Work items between cancellation checks in StackEvaluator.eval.
+CANCEL_CHECK_INTERVAL = 4096
+
+
+class StackEvaluator(AstEvaluator):
+    """An AstEvaluator that keeps its own work and value stacks instead of recursing.
+
+    It evaluates trees of any depth (long `^` chains, thousands of nested parentheses,
+    generated `a + b + ...` sums) with the same semantics, evaluation order and
+    errors as AstEvaluator.
+    """
+
+    def eval(self, node):
+        env, values = self.env, []
+        work = [node]
+        cancel, countdown = self.cancel_token, CANCEL_CHECK_INTERVAL
+        if cancel is not None:
+            cancel.check()
+        while work:
+            if cancel is not None:
+                countdown -= 1
+                if not countdown:
+                    cancel.check()
+                    countdown = CANCEL_CHECK_INTERVAL
+            item = work.pop()
+            t = type(item)
+            if t is tuple:
+                code, node = item[0], item[1]
+                if code == _FINISH_BINOP:
+                    right = values.pop()
+                    values[-1] = ARITHMETIC_FUNCS[node.op](values[-1], right)
+                elif code == _FINISH_COMPARE:
+                    # item[2] is the index of the operand just evaluated.
+                    index = item[2]
+                    right = values.pop()
+                    if not COMPARE_FUNCS[node.ops[index - 1]](values[-1], right):
+                        values[-1] = False
+                    elif index + 1 == len(node.operands):
+                        values[-1] = True
+                    else:
+                        values[-1] = right
+                        work.append((_FINISH_COMPARE, node, index + 1))
+                        work.append(node.operands[index + 1])
+                elif code == _FINISH_UNARY:
+                    values[-1] = UNARY_FUNCS[node.op](values[-1])
+                elif code == _FINISH_POW:
+                    exponent = values.pop()
+                    values[-1] = values[-1] ** exponent
+                elif code == _FINISH_LAZY:
+                    left = bool(values[-1])
+                    if left == (node.op == Op.OR):
+                        self.skipped.subtrees += 1
+                        self.skipped.nodes += count_nodes(node.right)
+                        values[-1] = left
+                    else:
+                        values.pop()
+                        work.append((_FINISH_BOOL, node))
+                        work.append(node.right)
+                elif code == _FINISH_BOOL:
+                    values[-1] = bool(values[-1])
+                elif code == _FINISH_SCIENTIFIC:
+                    values[-1] = node.mantissa * (10 ** values[-1])
+                elif code == _FINISH_ASSIGN:
+                    env[node.name] = values[-1]
+                elif code == _FINISH_ASSERT:
+                    if not values[-1]:
+                        raise ExprRuntimeError(node, "Assertion failed.")
+                else:
+                    self.on_print(values[-1])
+            elif t is Const:
+                values.append(item.value)
+            elif t is Name:
+                try:
+                    values.append(env[item.name])
+                except KeyError:
+                    raise ExprRuntimeError(item, f"Undefined variable '{item.name}'.") from None
+            elif t is BinOp:
+                if self.lazy_bool and (item.op == Op.AND or item.op == Op.OR):
+                    work.append((_FINISH_LAZY, item))
+                else:
+                    work.append((_FINISH_BINOP, item))
+                    work.append(item.right)
+                work.append(item.left)
+            elif t is Compare:
+                work.append((_FINISH_COMPARE, item, 1))
+                work.append(item.operands[1])
+                work.append(item.operands[0])
+            elif t is Unary:
+                work.append((_FINISH_UNARY, item))
+                work.append(item.operand)
+            elif t is Pow:
+                work.append((_FINISH_POW, item))
+                work.append(item.exponent)
+                work.append(item.base)
+            elif t is Scientific:
+                work.append((_FINISH_SCIENTIFIC, item))
+                work.append(item.exponent)
+            elif t is Assign:
+                work.append((_FINISH_ASSIGN, item))
+                work.append(item.value)
+            elif t is Assert:
+                work.append((_FINISH_ASSERT, item))
+                work.append(item.expr)
+            elif t is Print:
+                work.append((_FINISH_PRINT, item))
+                work.append(item.expr)
+            else:
+                raise RuntimeError(f"Unknown node type: {t.__name__}")
+        return values[0]
@@ -0,0 +1,368 @@
+import threading
+from operator import itemgetter
+from ExprAst import (
+    CANCEL_CHECK_INTERVAL, COMPARE_FUNCS, Assert, Assign, BinOp, Compare, Const, ExprRuntimeError,
+    Name, Op, Pow, Print, Program, Scientific, SkipCounter, Unary, children, count_nodes,
+)
+
+
+# Python operator for each binary operation that compiles to a single expression.
+BINARY_SYMBOLS = {
+    Op.ADD: '+', Op.SUB: '-', Op.MUL: '*', Op.DIV: '/', Op.MOD: '%',
+    Op.EQ: '==', Op.NE: '!=', Op.LT: '<', Op.LE: '<=', Op.GT: '>', Op.GE: '>=',
+}
+
+# Operand shapes: a frame slot known to be assigned, a constant, or any other closure.
+SLOT, CONST, EXPR = 'slot', 'const', 'expr'
+
+_FACTORY_TEMPLATE = """
+def slot_slot(a, b): return lambda frame: frame[a] {op} frame[b]
+def slot_const(a, b): return lambda frame: frame[a] {op} b
+def slot_expr(a, b): return lambda frame: frame[a] {op} b(frame)
+def const_slot(a, b): return lambda frame: a {op} frame[b]
+def const_expr(a, b): return lambda frame: a {op} b(frame)
+def expr_slot(a, b): return lambda frame: a(frame) {op} frame[b]
+def expr_const(a, b): return lambda frame: a(frame) {op} b
+def expr_expr(a, b): return lambda frame: a(frame) {op} b(frame)
+"""
+
+
+def _binary_factories(symbol):
+    """Builds one closure factory per operand shape pair for a Python operator.
+
+    Inlining slot reads and constants into the operator's own lambda saves a
+    closure call per leaf, which is most of the cost of small formulas.
+    """
+    namespace = {}
+    exec(_FACTORY_TEMPLATE.format(op=symbol), namespace)
+    return {
+        (left, right): namespace[f"{left}_{right}"]
+        for left in (SLOT, CONST, EXPR) for right in (SLOT, CONST, EXPR)
+        if (left, right) != (CONST, CONST)
+    }
+
+
+BINARY_FACTORIES = {op: _binary_factories(symbol) for op, symbol in BINARY_SYMBOLS.items()}
+POW_FACTORIES = _binary_factories('**')
+
+
+class ThreadSkipCounter(threading.local, SkipCounter):
+    """Per-thread SkipCounter for lazy `and`/`or` closures.
+
+    Compiled programs are shared between threads (see ProgramCache.py), so the
+    closures cannot own the counters; callers reset() before a run and read after.
+    """
+
+
+SKIPPED = ThreadSkipCounter()
+
+
+class _Unset:
+    """Marks a frame slot whose variable has not been assigned yet."""
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<unset>'
+
+
+UNSET = _Unset()
+
+
+def checkpoints(node, interval=CANCEL_CHECK_INTERVAL):
+    """Ids of the nodes under `node` after which a run checks for cancellation.
+
+    A node is picked when its subtree crosses a multiple of `interval` nodes that
+    none of its children's subtrees does, so evaluating the whole tree passes about
+    one check per `interval` nodes however the tree is shaped.
+    """
+    picked, sizes, pending = set(), {}, [(node, False)]
+    while pending:
+        node, visited = pending.pop()
+        if not visited:
+            pending.append((node, True))
+            pending.extend((child, False) for child in children(node))
+            continue
+        child_sizes = [sizes.pop(id(child)) for child in children(node)]
+        size = sizes[id(node)] = 1 + sum(child_sizes)
+        if size // interval > max(child_sizes, default=0) // interval:
+            picked.add(id(node))
+    return picked
+
+
+class CompiledProgram:
+    """A program compiled to one closure per statement.
+
+    Every variable is resolved to a fixed slot in a flat frame list (`names[i]` is
+    the variable in slot i); the slot after them holds the run's cancel token, which
+    statements larger than CANCEL_CHECK_INTERVAL nodes check as they go. Statement
+    closures take `(frame, emit)`: the frame and the print callback. `free_uses`
+    lists, per variable that a statement reads before the program assigns it,
+    (name, Name node, statement index) for its first such read in source order;
+    reads that short-circuiting may skip are not listed.
+    The compiled form holds no per-run state, so it can be run any number of times.
+    """
+    __slots__ = ('stats', 'names', 'free_uses', 'source', 'positions')
+
+    def __init__(self, stats, names, free_uses, source, positions):
+        self.stats = stats
+        self.names = names
+        self.free_uses = free_uses
+        self.source = source
+        self.positions = positions
+
+    def relocate(self, source, positions):
+        """Same compiled statements, attached to another source with an identical token stream."""
+        return type(self)(self.stats, self.names, self.free_uses, source, positions)
+
+    def head(self, count):
+        """A program of just the first `count` statements (the slots of the rest are written back unchanged)."""
+        free_uses = [use for use in self.free_uses if use[2] < count]
+        return type(self)(self.stats[:count], self.names, free_uses, self.source, self.positions)
+
+    def run(self, env, emit, cancel_token=None):
+        """Runs against the `env` dict: slots are loaded from it and written back at the end.
+
+        With a `cancel_token`, raises RunCancelled between statements, and within large
+        ones, once it is cancelled.
+        """
+        frame = [env.get(name, UNSET) for name in self.names]
+        frame.append(cancel_token)
+        try:
+            result = None
+            if cancel_token is None:
+                for stat in self.stats:
+                    result = stat(frame, emit)
+            else:
+                for stat in self.stats:
+                    cancel_token.check()
+                    result = stat(frame, emit)
+            return result
+        finally:
+            for name, value in zip(self.names, frame):
+                if value is not UNSET:
+                    env[name] = value
+
+
+class Compiler:
+    """Compiles lowered AST nodes into nested Python closures.
+
+    Expression closures take the variable frame and return a value; operators and
+    variable slots are resolved here, once, so running a closure never dispatches
+    on node type or operator code, nor hashes a variable name.
+    With `lazy_bool`, `and`/`or` short-circuit and count what they skip in SKIPPED.
+    """
+
+    program_class = CompiledProgram
+
+    def __init__(self, lazy_bool=False):
+        self.lazy_bool = lazy_bool
+        self._checkpoints = ()
+        self._expr_dispatch = {
+            Const: self._const,
+            Name: self._name,
+            BinOp: self._binop,
+            Compare: self._compare,
+            Unary: self._unary,
+            Pow: self._pow,
+            Scientific: self._scientific,
+        }
+
+    def compile_program(self, program: Program):
+        # Assigned variables take the first slots, in assignment order, so writing the
+        # frame back creates env keys in the same order the assignments would have.
+        self._slots = {}
+        for stat in program.stats:
+            if isinstance(stat, Assign):
+                self._slot(stat.name)
+        self._assigned = set()
+        self._free_uses = {}
+        self._conditional = 0  # > 0 while compiling an operand that may be skipped
+        stats = []
+        for self._index, stat in enumerate(program.stats):
+            large = count_nodes(stat) > CANCEL_CHECK_INTERVAL
+            self._checkpoints = checkpoints(stat) if large else ()
+            stats.append(self.stat(stat))
+        free_uses = [(name, node, index) for name, (node, index) in self._free_uses.items()]
+        return self.program_class(stats, list(self._slots), free_uses, program.source, program.positions)
+
+    def _slot(self, name):
+        return self._slots.setdefault(name, len(self._slots))
+
+    # ---- Statements ----
+    def stat(self, node):
+        if isinstance(node, Assign):
+            return self._assign(node)
+        if isinstance(node, Assert):
+            return self._assert(node)
+        if isinstance(node, Print):
+            return self._print(node)
+        expr = self.expr(node)
+        return lambda frame, emit: expr(frame)
+
+    def _assign(self, node):
+        slot = self._slot(node.name)
+        expr = self.expr(node.value)
+        # Programs are straight-line: later reads can only run after this assignment.
+        self._assigned.add(node.name)
+
+        def assign(frame, emit):
+            value = expr(frame)
+            frame[slot] = value
+            return value
+        return assign
+
+    def _assert(self, node):
+        expr = self.expr(node.expr)
+
+        def assert_(frame, emit):
+            value = expr(frame)
+            if not value:
+                raise ExprRuntimeError(node, "Assertion failed.")
+            return value
+        return assert_
+
+    def _print(self, node):
+        expr = self.expr(node.expr)
+
+        def print_(frame, emit):
+            value = expr(frame)
+            emit(value)
+            return value
+        return print_
+
+    # ---- Expressions ----
+    def expr(self, node):
+        expr = self._expr_dispatch[type(node)](node)
+        if id(node) in self._checkpoints:
+            return self._checked(expr)
+        return expr
+
+    @staticmethod
+    def _checked(expr):
+        def checked(frame):
+            value = expr(frame)
+            cancel_token = frame[-1]
+            if cancel_token is not None:
+                cancel_token.check()
+            return value
+        return checked
+
+    def _const(self, node):
+        value = node.value
+        return lambda frame: value
+
+    def _name(self, node):
+        name = node.name
+        slot = self._slot(name)
+        if name in self._assigned:
+            return itemgetter(slot)
+
+        # May be undefined: only set if the initial environment provides it.
+        if not self._conditional:
+            self._free_uses.setdefault(name, (node, self._index))
+
+        def load(frame):
+            value = frame[slot]
+            if value is UNSET:
+                raise ExprRuntimeError(node, f"Undefined variable '{name}'.")
+            return value
+        return load
+
+    def _operand(self, node):
+        """Classifies an operand as (SLOT, index), (CONST, value) or (EXPR, closure)."""
+        if isinstance(node, Const):
+            return CONST, node.value
+        if isinstance(node, Name) and node.name in self._assigned:
+            return SLOT, self._slot(node.name)
+        return EXPR, self.expr(node)
+
+    def _binary(self, factories, left_node, right_node):
+        left_shape, left = self._operand(left_node)
+        right_shape, right = self._operand(right_node)
+        if (left_shape, right_shape) == (CONST, CONST):
+            value = left
+            left_shape, left = EXPR, lambda frame: value
+        return factories[left_shape, right_shape](left, right)
+
+    def _binop(self, node):
+        if node.op in BINARY_FACTORIES:
+            return self._binary(BINARY_FACTORIES[node.op], node.left, node.right)
+        left = self.expr(node.left)
+        if self.lazy_bool and node.op in (Op.AND, Op.OR):
+            self._conditional += 1
+            right = self.expr(node.right)
+            self._conditional -= 1
+            return self._lazy_bool(node.op, left, right, count_nodes(node.right))
+        right = self.expr(node.right)
+        match node.op:
+            case Op.AND:
+                # Both operands are always evaluated, matching visitAndExpr.
+                def and_(frame):
+                    lhs = bool(left(frame))
+                    rhs = bool(right(frame))
+                    return lhs and rhs
+                return and_
+            case Op.OR:
+                def or_(frame):
+                    lhs = bool(left(frame))
+                    rhs = bool(right(frame))
+                    return lhs or rhs
+                return or_
+        raise RuntimeError(f"Unknown binary operator: {node.op!r}")
+
+    def _lazy_bool(self, op, left, right, right_size):
+        skipped = SKIPPED
+        if op == Op.AND:
+            def and_(frame):
+                if not left(frame):
+                    skipped.subtrees += 1
+                    skipped.nodes += right_size
+                    return False
+                return bool(right(frame))
+            return and_
+
+        def or_(frame):
+            if left(frame):
+                skipped.subtrees += 1
+                skipped.nodes += right_size
+                return True
+            return bool(right(frame))
+        return or_
+
+    def _compare(self, node):
+        if len(node.operands) == 2:
+            return self._binary(BINARY_FACTORIES[node.ops[0]], *node.operands)
+
+        # Chains of three or more operands loop over the operator functions.
+        operands = [self.expr(operand) for operand in node.operands]
+        first, rest = operands[0], list(zip((COMPARE_FUNCS[op] for op in node.ops), operands[1:]))
+
+        def chain(frame):
+            left = first(frame)
+            for compare, operand in rest:
+                right = operand(frame)
+                if not compare(left, right):
+                    return False
+                left = right
+            return True
+        return chain
+
+    def _unary(self, node):
+        operand = self.expr(node.operand)
+        match node.op:
+            case Op.NOT: return lambda frame: not operand(frame)
+            case Op.NEG: return lambda frame: -operand(frame)
+            case Op.POS: return lambda frame: +operand(frame)
+        raise RuntimeError(f"Unknown unary operator: {node.op!r}")
+
+    def _pow(self, node):
+        return self._binary(POW_FACTORIES, node.base, node.exponent)
+
+    def _scientific(self, node):
+        mantissa, exponent = node.mantissa, self.expr(node.exponent)
+        return lambda frame: mantissa * (10 ** exponent(frame))
+
+
+def compile_program(program: Program, lazy_bool=False):
+    """Compiles a lowered Program into a reusable CompiledProgram."""
+    return Compiler(lazy_bool).compile_program(program)
@@ -0,0 +1,204 @@
+from bisect import bisect_right
+from itertools import accumulate
+
+from ExprFastParser import EOF, FastParseError, FastParser, tokenize
+from ExprReactive import statement_inputs
+
+
+class _Fragment:
+    """Whole lines of a document: the statements on them, or (`statements` None) text not parsed yet.
+
+    `statements` holds (stat, texts, reads) entries as ExprReactive.statement_inputs
+    makes them. Their nodes index `positions`, the token positions of the text the
+    fragment was parsed in, where the fragment starts on line `first_line`.
+    """
+    __slots__ = ('size', 'lines', 'tokens', 'statements', 'positions', 'first_line')
+
+    def __init__(self, size, lines, tokens=0, statements=None, positions=None, first_line=1):
+        self.size = size
+        self.lines = lines  # newlines in the fragment
+        self.tokens = tokens
+        self.statements = statements
+        self.positions = positions
+        self.first_line = first_line
+
+
+def common_affixes(old, new):
+    """Lengths of the longest common prefix and (not overlapping it) suffix of `old` and `new`."""
+    # Binary searches comparing slices, so the characters are compared in C.
+    limit = min(len(old), len(new))
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[:middle] == new[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = low
+    low, high = 0, limit - prefix
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[len(old) - middle:] == new[len(new) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return prefix, low
+
+
+class ParsedDocument:
+    """A program's text and its statements, kept parsed through edits.
+
+    The text is split into fragments: runs of whole lines holding whole statements,
+    with a new one at each line a statement starts on. An edit re-lexes and re-parses
+    from the fragment before the first one it touches (whose last statement may now
+    continue into the edit) until a statement ends exactly where an untouched fragment
+    starts. Fragments from there on are kept as they are: their line numbers are
+    relative, so nothing in them changes. A one-line edit thus costs O(edit) of
+    lexing and parsing, plus splicing the document's string and fragment list.
+
+    Text the fast parser rejects (mostly a syntax error halfway through typing) is
+    kept as one unparsed fragment, which later edits extend and retry; statements()
+    returns None while there is one.
+    """
+
+    def __init__(self, text=''):
+        self.text = ''
+        # Incremented by every edit, so clients can tell which text their edits apply to
+        self.version = 0
+        self.tokens = 0
+        self._fragments = []
+        self.replace(0, 0, text)
+
+    def replace_text(self, text):
+        """Changes the document to `text` through one replacement of the span where they differ."""
+        prefix, suffix = common_affixes(self.text, text)
+        self.replace(prefix, len(self.text) - prefix - suffix, text[prefix:len(text) - suffix])
+
+    def replace(self, offset, length, text):
+        """Replaces the `length` characters at `offset` with `text`; ValueError if they are not all in the document."""
+        if offset < 0 or length < 0 or offset + length > len(self.text):
+            raise ValueError(f"Edit at {offset}+{length} is outside the document ({len(self.text)} characters).")
+        removed = self.text[offset:offset + length]
+        self.text = self.text[:offset] + text + self.text[offset + length:]
+        self.version += 1
+
+        fragments = self._fragments
+        if not fragments:
+            fragments.append(_Fragment(len(self.text), self.text.count('\n')))
+            self._parse(0, 0)
+            return
+        starts = list(accumulate((fragment.size for fragment in fragments), initial=0))
+        # The fragment after the edit too if the edit ends where it starts: the edit may
+        # have removed the newline before it. The one before, as its last statement
+        # may continue into the edit now.
+        first = max(min(bisect_right(starts, offset), len(fragments)) - 2, 0)
+        last = min(bisect_right(starts, offset + length), len(fragments)) - 1
+        for index in range(len(fragments)):
+            if fragments[index].statements is None:
+                first, last = min(first, index), max(last, index)
+                break
+        replaced = fragments[first:last + 1]
+        dirty = _Fragment(
+            sum(fragment.size for fragment in replaced) + len(text) - length,
+            sum(fragment.lines for fragment in replaced) + text.count('\n') - removed.count('\n'))
+        self.tokens -= sum(fragment.tokens for fragment in replaced)
+        fragments[first:last + 1] = [dirty]
+        self._parse(first, starts[first])
+
+    def _parse(self, index, start):
+        # Parses the unparsed fragment at `index` (which starts at `start`), together
+        # with as many following fragments as it takes to get back in step.
+        fragments = self._fragments
+        lookahead = 1
+        while True:
+            stop = min(index + 1 + lookahead, len(fragments))
+            end = start + sum(fragment.size for fragment in fragments[index:stop])
+            parsed = self._parse_window(self.text[start:end], index, stop)
+            if parsed is not None:
+                new, resync = parsed
+                self.tokens += sum(fragment.tokens for fragment in new)
+                self.tokens -= sum(fragment.tokens for fragment in fragments[index + 1:resync])
+                fragments[index:resync] = new
+                return
+            if stop == len(fragments):
+                return  # does not parse; stays unparsed
+            lookahead *= 2
+
+    def _parse_window(self, window, index, stop):
+        # Parses fragments [index, stop), joined in `window`, statement by statement,
+        # until one ends where a fragment after `index` starts. Returns the new
+        # fragments and the index of that fragment (`stop` if the window runs to the
+        # end of the document), or None if the window does not parse that far.
+        fragments = self._fragments
+        at_end = stop == len(fragments)
+        try:
+            tokens = tokenize(window)
+        except FastParseError:
+            return None
+        types, texts, positions = tokens
+        # Window lines on which the fragments inside the window (after `index`) start
+        boundaries = {}
+        line = 1
+        for k in range(index, stop - 1):
+            line += fragments[k].lines
+            boundaries[line] = k + 1
+
+        parser = FastParser(window, tokens)
+        spans = []
+        resync = None
+        try:
+            while resync is None:
+                start_tok = parser.pos
+                stat = parser.next_stat()
+                if stat is None:
+                    if not at_end:
+                        return None  # the last statement might go on past the window
+                    resync = stop
+                    break
+                spans.append((stat, start_tok, parser.pos))
+                next_line = positions[parser.pos][0]
+                if (types[parser.pos] != EOF and next_line in boundaries
+                        and positions[parser.pos - 1][0] < next_line):
+                    resync = boundaries[next_line]
+        except FastParseError:
+            return None
+
+        # Offsets of the window's line starts, and where the new fragments end
+        line_starts = list(accumulate((len(text) + 1 for text in window.split('\n')), initial=0))
+        line_count = len(line_starts) - 1
+        end_line = line_count + 1 if resync == stop and at_end else next_line
+
+        new = []
+        group, group_line, group_tokens = [], 1, 0
+        for stat, start_tok, end_tok in spans:
+            line = positions[start_tok][0]
+            if group and line > positions[start_tok - 1][0]:
+                new.append(self._fragment(window, line_starts, line_count, group_line, line,
+                                          group_tokens, group, positions))
+                group, group_line, group_tokens = [], line, 0
+            group.append((stat, *statement_inputs(stat, types, texts, start_tok, end_tok)))
+            group_tokens += end_tok - start_tok
+        new.append(self._fragment(window, line_starts, line_count, group_line, end_line,
+                                  group_tokens, group, positions))
+        return new, resync
+
+    @staticmethod
+    def _fragment(window, line_starts, line_count, first_line, end_line, tokens, statements, positions):
+        # The fragment of window lines [first_line, end_line)
+        start = line_starts[first_line - 1]
+        end = min(line_starts[end_line - 1], len(window))
+        lines = min(end_line, line_count) - first_line
+        return _Fragment(end - start, lines, tokens, statements, positions, first_line)
+
+    def statements(self):
+        """The (stat, texts, reads, where) entries Interpreter.interpret_reactive runs
+        (see ExprReactive.split_statements), or None if part of the text does not parse."""
+        entries = []
+        line = 1
+        for fragment in self._fragments:
+            if fragment.statements is None:
+                return None
+            where = (fragment.positions, line - fragment.first_line)
+            entries.extend([(stat, texts, reads, where) for stat, texts, reads in fragment.statements])
+            line += fragment.lines
+        return entries
@@ -0,0 +1,366 @@
+import re
+from ExprLexer import ExprLexer
+from ExprAst import (
+    Assert, Assign, BinOp, Compare, Const, Name, OP_FROM_TEXT, Op, Pow, Print,
+    Program, Scientific, Unary,
+)
+
+
+# Token types shared with the generated ExprLexer, so token indices line up with ANTLR's.
+ASSIGN = ExprLexer.T__0    # '='
+LPAREN = ExprLexer.T__1    # '('
+RPAREN = ExprLexer.T__2    # ')'
+X10 = ExprLexer.T__3       # 'x10^'
+ASSERT = ExprLexer.ASSERT
+PRINT = ExprLexer.PRINT
+OR = ExprLexer.OR
+AND = ExprLexer.AND
+NOT = ExprLexer.NOT
+POW = ExprLexer.POW
+ADD_SUB = ExprLexer.ADD_SUB
+MUL_DIV = ExprLexer.MUL_DIV
+COMPARE = ExprLexer.COMPARE
+ID = ExprLexer.ID
+NUMBER = ExprLexer.NUMBER
+EOF = -1
+
+KEYWORDS = {'assert': ASSERT, 'print': PRINT, 'or': OR, 'and': AND, 'not': NOT}
+
+PUNCTUATION = {
+    '=': ASSIGN, '(': LPAREN, ')': RPAREN, 'x10^': X10, '^': POW,
+    '+': ADD_SUB, '-': ADD_SUB, '*': MUL_DIV, '/': MUL_DIV, '%': MUL_DIV,
+}
+
+# Alternatives are ordered so the first match is also ANTLR's longest match
+# ('x10^' before ID, two-character comparisons before '<', '>' and '=').
+TOKEN_RE = re.compile(r"""
+    (?P<WS>[ \t\r\n]+)
+  | (?P<COMMENT>\#[^\r\n]*)
+  | (?P<NUMBER>[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|\.[0-9]+(?:[eE][+-]?[0-9]+)?)
+  | (?P<PUNCT>x10\^|[()^+\-*/%])
+  | (?P<ID>[a-zA-Z_][a-zA-Z_0-9]*)
+  | (?P<COMPARE>==|!=|<=|>=|<|>)
+  | (?P<ASSIGN>=)
+""", re.VERBOSE)
+
+# Binding powers for the binary operator loop, lowest to highest.
+OR_BP, AND_BP, NOT_BP, CMP_BP, ADD_BP, MUL_BP = range(1, 7)
+
+STAT_START = frozenset((ASSERT, PRINT, NOT, ADD_SUB, ID, NUMBER, LPAREN))
+
+
+class FastParseError(Exception):
+    """The fast parser gave up; the caller should re-parse with ANTLR for diagnostics."""
+
+
+def tokenize(text):
+    """Splits `text` into (types, texts, positions) lists, skipping whitespace and comments.
+
+    The lists end with an EOF entry. Raises FastParseError on any character ANTLR's
+    lexer would not accept.
+    """
+    types, texts, positions = [], [], []
+    match = TOKEN_RE.match
+    pos, end = 0, len(text)
+    line, line_start = 1, 0
+    while pos < end:
+        m = match(text, pos)
+        if m is None:
+            raise FastParseError(f"unexpected character {text[pos]!r}")
+        kind = m.lastgroup
+        value = m.group()
+        if kind == 'WS':
+            newlines = value.count('\n')
+            if newlines:
+                line += newlines
+                line_start = pos + value.rindex('\n') + 1
+        elif kind != 'COMMENT':
+            if kind == 'ID':
+                types.append(KEYWORDS.get(value, ID))
+            elif kind == 'PUNCT':
+                types.append(PUNCTUATION[value])
+            else:
+                types.append(NUMBER if kind == 'NUMBER' else COMPARE if kind == 'COMPARE' else ASSIGN)
+            texts.append(value)
+            positions.append((line, pos - line_start))
+        pos = m.end()
+    types.append(EOF)
+    texts.append('<EOF>')
+    positions.append((line, pos - line_start))
+    return types, texts, positions
+
+
+class FastParser:
+    """Pratt parser for Expr.g4 that builds ExprAst nodes directly.
+
+    It accepts a subset of what ANTLR accepts: anything it cannot parse cleanly
+    (including input ANTLR would accept only by silently dropping trailing tokens)
+    raises FastParseError. Node token indices match those the AstBuilder assigns.
+    """
+
+    def __init__(self, text, tokens=None):
+        self.text = text
+        self.types, self.texts, self.positions = tokens if tokens is not None else tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        start = self.pos
+        try:
+            stats = self._prog()
+        except RecursionError:
+            return self._deep_parser(start).parse()
+        return Program(stats, self.text, self.positions)
+
+    def next_stat(self):
+        """Parses the statement at the current position, or returns None at EOF.
+
+        Used to parse a token stream one statement at a time; `pos` is left on the
+        first token after the statement.
+        """
+        if self.types[self.pos] == EOF:
+            return None
+        start = self.pos
+        try:
+            return self._stat()
+        except RecursionError:
+            deep = self._deep_parser(start)
+            stat = deep.next_stat()
+            self.pos = deep.pos
+            return stat
+
+    def _deep_parser(self, start):
+        """An IterativeParser over the same tokens, positioned at `start`, for input too deeply nested to recurse on."""
+        deep = IterativeParser(self.text, (self.types, self.texts, self.positions))
+        deep.pos = start
+        return deep
+
+    def _expect(self, token_type):
+        if self.types[self.pos] != token_type:
+            raise FastParseError(f"unexpected {self.texts[self.pos]!r}")
+        self.pos += 1
+
+    # ---- Statements ----
+    def _prog(self):
+        types = self.types
+        stats = []
+        while types[self.pos] != EOF:
+            stats.append(self._stat())
+        return stats
+
+    def _stat(self):
+        types, start = self.types, self.pos
+        t = types[start]
+        if t == ASSERT:
+            self.pos += 1
+            return Assert(self._expr(OR_BP), start + 1)
+        if t == PRINT:
+            self.pos += 1
+            return Print(self._expr(OR_BP), start)
+        if t == ID and types[start + 1] == ASSIGN:
+            self.pos += 2
+            return Assign(self.texts[start], self._expr(OR_BP), start)
+        if t not in STAT_START:
+            raise FastParseError(f"unexpected {self.texts[start]!r}")
+        return self._expr(OR_BP)
+
+    # ---- Expressions ----
+    def _expr(self, min_bp):
+        """Parses an expression whose binary operators bind at least as tightly as `min_bp`."""
+        types, texts = self.types, self.texts
+        start = self.pos
+        if types[start] == NOT and min_bp <= NOT_BP:
+            self.pos += 1
+            left = Unary(Op.NOT, self._expr(NOT_BP), start)
+        else:
+            left = self._unary()
+
+        while True:
+            t = types[self.pos]
+            if t == MUL_DIV and min_bp <= MUL_BP:
+                op = OP_FROM_TEXT[texts[self.pos]]
+                self.pos += 1
+                left = BinOp(op, left, self._unary(), start)
+            elif t == ADD_SUB and min_bp <= ADD_BP:
+                op = OP_FROM_TEXT[texts[self.pos]]
+                self.pos += 1
+                left = BinOp(op, left, self._expr(MUL_BP), start)
+            elif t == COMPARE and min_bp <= CMP_BP:
+                ops, operands = [], [left]
+                while types[self.pos] == COMPARE:
+                    ops.append(OP_FROM_TEXT[texts[self.pos]])
+                    self.pos += 1
+                    operands.append(self._expr(ADD_BP))
+                left = Compare(tuple(ops), tuple(operands), start)
+            elif t == AND and min_bp <= AND_BP:
+                self.pos += 1
+                left = BinOp(Op.AND, left, self._expr(NOT_BP), start)
+            elif t == OR and min_bp <= OR_BP:
+                self.pos += 1
+                left = BinOp(Op.OR, left, self._expr(AND_BP), start)
+            else:
+                return left
+
+    def _unary(self):
+        start = self.pos
+        if self.types[start] == ADD_SUB:
+            op = Op.POS if self.texts[start] == '+' else Op.NEG
+            self.pos += 1
+            return Unary(op, self._unary(), start)
+        return self._pow()
+
+    def _pow(self):
+        # powExpr: atom (POW powExpr)? -- right-associative, and the exponent cannot be signed.
+        start = self.pos
+        base = self._atom()
+        if self.types[self.pos] == POW:
+            self.pos += 1
+            return Pow(base, self._pow(), start)
+        return base
+
+    # ---- Atoms ----
+    def _atom(self):
+        types, start = self.types, self.pos
+        t = types[start]
+        if t == NUMBER:
+            value = float(self.texts[start])
+            if types[start + 1] == X10:
+                self.pos += 2
+                return Scientific(value, self._expr(OR_BP), start)
+            self.pos += 1
+            return Const(value, start)
+        if t == ID:
+            self.pos += 1
+            return Name(self.texts[start], start)
+        if t == LPAREN:
+            self.pos += 1
+            node = self._expr(OR_BP)
+            self._expect(RPAREN)
+            return node
+        raise FastParseError(f"unexpected {self.texts[start]!r}")
+
+
+# IterativeParser continuations: what to do with the node just parsed.
+(_K_LOOP, _K_NOT, _K_SIGN, _K_POW, _K_POW_RHS, _K_SCIENTIFIC, _K_PAREN, _K_BINOP,
+ _K_COMPARE) = range(9)
+
+# IterativeParser targets: the grammar rule to parse next.
+_P_EXPR, _P_UNARY, _P_POW = range(3)
+
+
+class IterativeParser(FastParser):
+    """FastParser with an explicit stack in place of recursion.
+
+    Handles nesting of any depth (thousands of parentheses, `2^2^2^...` chains) and
+    builds exactly the nodes FastParser does. It is slower on ordinary input, so
+    FastParser only switches to it when it hits the recursion limit.
+    """
+
+    def _expr(self, min_bp):
+        types, texts = self.types, self.texts
+        stack = []
+        target, bp = _P_EXPR, min_bp
+        while True:
+            # Descend: push a continuation for every prefix and open construct until an atom is parsed.
+            while True:
+                start = self.pos
+                t = types[start]
+                if target == _P_EXPR:
+                    stack.append((_K_LOOP, bp, start))
+                    if t == NOT and bp <= NOT_BP:
+                        self.pos += 1
+                        stack.append((_K_NOT, start))
+                        bp = NOT_BP
+                        continue
+                    target = _P_UNARY
+                if target == _P_UNARY:
+                    if t == ADD_SUB:
+                        stack.append((_K_SIGN, Op.POS if texts[start] == '+' else Op.NEG, start))
+                        self.pos += 1
+                        continue
+                stack.append((_K_POW, start))
+                if t == NUMBER:
+                    value = float(texts[start])
+                    if types[start + 1] == X10:
+                        self.pos += 2
+                        stack.append((_K_SCIENTIFIC, value, start))
+                        target, bp = _P_EXPR, OR_BP
+                        continue
+                    self.pos += 1
+                    node = Const(value, start)
+                elif t == ID:
+                    self.pos += 1
+                    node = Name(texts[start], start)
+                elif t == LPAREN:
+                    self.pos += 1
+                    stack.append((_K_PAREN,))
+                    target, bp = _P_EXPR, OR_BP
+                    continue
+                else:
+                    raise FastParseError(f"unexpected {texts[start]!r}")
+                break
+
+            # Ascend: hand the node to pending continuations until one needs another operand.
+            while True:
+                if not stack:
+                    return node
+                k = stack.pop()
+                kind = k[0]
+                if kind == _K_POW:
+                    if types[self.pos] == POW:
+                        self.pos += 1
+                        stack.append((_K_POW_RHS, node, k[1]))
+                        target = _P_POW
+                        break
+                elif kind == _K_POW_RHS:
+                    node = Pow(k[1], node, k[2])
+                elif kind == _K_SIGN:
+                    node = Unary(k[1], node, k[2])
+                elif kind == _K_NOT:
+                    node = Unary(Op.NOT, node, k[1])
+                elif kind == _K_SCIENTIFIC:
+                    node = Scientific(k[1], node, k[2])
+                elif kind == _K_PAREN:
+                    self._expect(RPAREN)
+                elif kind == _K_BINOP:
+                    node = BinOp(k[1], k[2], node, k[3])
+                elif kind == _K_COMPARE:
+                    _, ops, operands, start = k
+                    operands.append(node)
+                    if types[self.pos] == COMPARE:
+                        ops.append(OP_FROM_TEXT[texts[self.pos]])
+                        self.pos += 1
+                        stack.append(k)
+                        target, bp = _P_EXPR, ADD_BP
+                        break
+                    node = Compare(tuple(ops), tuple(operands), start)
+                else:
+                    # The binary operator loop of an expression parsed at binding power k[1].
+                    _, loop_bp, start = k
+                    t = types[self.pos]
+                    if t == MUL_DIV and loop_bp <= MUL_BP:
+                        target, operand_bp = _P_UNARY, None
+                    elif t == ADD_SUB and loop_bp <= ADD_BP:
+                        target, operand_bp = _P_EXPR, MUL_BP
+                    elif t == COMPARE and loop_bp <= CMP_BP:
+                        stack.append(k)
+                        stack.append((_K_COMPARE, [OP_FROM_TEXT[texts[self.pos]]], [node], start))
+                        self.pos += 1
+                        target, bp = _P_EXPR, ADD_BP
+                        break
+                    elif t == AND and loop_bp <= AND_BP:
+                        target, operand_bp = _P_EXPR, NOT_BP
+                    elif t == OR and loop_bp <= OR_BP:
+                        target, operand_bp = _P_EXPR, AND_BP
+                    else:
+                        continue
+                    op = Op.AND if t == AND else Op.OR if t == OR else OP_FROM_TEXT[texts[self.pos]]
+                    self.pos += 1
+                    stack.append(k)
+                    stack.append((_K_BINOP, op, node, start))
+                    bp = operand_bp
+                    break
+
+
+def fast_parse(text, tokens=None):
+    """Parses `text` (or its already tokenized form) into a Program, raising FastParseError if ANTLR is needed."""
+    return FastParser(text, tokens).parse()
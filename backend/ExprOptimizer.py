@@ -0,0 +1,179 @@
+from ExprAst import (
+    Assert, Assign, AstEvaluator, BinOp, Compare, Const, Name, Op, Pow, Print,
+    Program, Scientific, Unary,
+)
+
+
+# Static value kinds tracked by the optimizer; None means unknown.
+FLOAT = 'float'
+BOOL = 'bool'
+
+BOOL_OPS = (Op.AND, Op.OR)
+
+# fast_math rewrites x^n into repeated multiplication for these exponents.
+FAST_MATH_POWERS = (2.0, 3.0, 4.0)
+
+
+def _kind_of_value(value):
+    if type(value) is bool:
+        return BOOL
+    if type(value) is float:
+        return FLOAT
+    return None
+
+
+class Optimizer:
+    """Folds constant subtrees and simplifies a lowered Program.
+
+    Every rewrite is exact: folding evaluates the subtree with the AstEvaluator,
+    and a subtree whose evaluation raises (e.g. `1 / 0`) is left in place so the
+    error still happens at run time, in the statement that contains it.
+
+    Because programs are straight-line, the pass also tracks what each assignment
+    stores: variables assigned a constant are propagated, and the kind (float or
+    bool) of assigned values enables type-dependent simplifications. Variables that
+    only come from the initial environment stay unknown.
+
+    With `fast_math`, `x^2`, `x^3` and `x^4` become multiplications for variables
+    not known to hold bools. This is opt-in: repeated multiplication rounds
+    differently from pow() in the last bit, overflows to inf instead of raising
+    OverflowError, and assumes variables from the initial environment are floats.
+    """
+
+    def __init__(self, fast_math=False):
+        self.fast_math = fast_math
+        self._folder = AstEvaluator({}, None)
+        self._dispatch = {
+            Const: self._const,
+            Name: self._name,
+            BinOp: self._binop,
+            Compare: self._compare,
+            Unary: self._unary,
+            Pow: self._pow,
+            Scientific: self._scientific,
+        }
+
+    def optimize(self, program: Program):
+        self._constants = {}
+        self._kinds = {}
+        stats = [self.stat(stat) for stat in program.stats]
+        return Program(stats, program.source, program.positions)
+
+    # ---- Statements ----
+    def stat(self, node):
+        if isinstance(node, Assign):
+            value, kind = self.expr(node.value)
+            if isinstance(value, Const):
+                self._constants[node.name] = value.value
+            else:
+                self._constants.pop(node.name, None)
+            self._kinds[node.name] = kind
+            return Assign(node.name, value, node.tok)
+        if isinstance(node, Assert):
+            return Assert(self.expr(node.expr)[0], node.tok)
+        if isinstance(node, Print):
+            return Print(self.expr(node.expr)[0], node.tok)
+        return self.expr(node)[0]
+
+    # ---- Expressions ----
+    # Each handler returns (optimized node, kind).
+    def expr(self, node):
+        return self._dispatch[type(node)](node)
+
+    def _fold(self, node, kind=None):
+        """Replaces a node whose operands are all constants by its value, unless evaluating it raises."""
+        try:
+            value = self._folder.eval(node)
+        except Exception:
+            return node, kind
+        return Const(value, node.tok), _kind_of_value(value)
+
+    def _const(self, node):
+        return node, _kind_of_value(node.value)
+
+    def _name(self, node):
+        if node.name in self._constants:
+            value = self._constants[node.name]
+            return Const(value, node.tok), _kind_of_value(value)
+        return node, self._kinds.get(node.name)
+
+    def _binop(self, node):
+        (left, left_kind), (right, right_kind) = self.expr(node.left), self.expr(node.right)
+        kind = BOOL if node.op in BOOL_OPS else FLOAT if left_kind == right_kind == FLOAT else None
+        new = BinOp(node.op, left, right, node.tok)
+        if isinstance(left, Const) and isinstance(right, Const):
+            return self._fold(new, kind)
+        return new, kind
+
+    def _compare(self, node):
+        operands = tuple(self.expr(operand)[0] for operand in node.operands)
+        new = Compare(node.ops, operands, node.tok)
+        if all(isinstance(operand, Const) for operand in operands):
+            return self._fold(new, BOOL)
+        return new, BOOL
+
+    def _unary(self, node):
+        operand, kind = self.expr(node.operand)
+        if isinstance(operand, Const):
+            return self._fold(Unary(node.op, operand, node.tok), BOOL if node.op == Op.NOT else None)
+
+        double = isinstance(operand, Unary) and operand.op == node.op
+        match node.op:
+            case Op.NOT:
+                # not not e == e when e is already a bool.
+                if double and self._is_bool(operand.operand):
+                    return operand.operand, BOOL
+                return Unary(Op.NOT, operand, node.tok), BOOL
+            case Op.NEG:
+                # - -e == +e for every numeric type, and +e == e for floats.
+                if double:
+                    if kind == FLOAT:
+                        return operand.operand, FLOAT
+                    return Unary(Op.POS, operand.operand, node.tok), None
+                return Unary(Op.NEG, operand, node.tok), FLOAT if kind == FLOAT else None
+            case Op.POS:
+                if kind == FLOAT:
+                    return operand, FLOAT
+                return Unary(Op.POS, operand, node.tok), None
+        raise RuntimeError(f"Unknown unary operator: {node.op!r}")
+
+    def _is_bool(self, node):
+        """Whether an already optimized node always evaluates to a bool."""
+        if isinstance(node, Const):
+            return type(node.value) is bool
+        if isinstance(node, Name):
+            return self._kinds.get(node.name) == BOOL
+        if isinstance(node, (Unary, BinOp)):
+            return node.op in (Op.NOT, Op.AND, Op.OR)
+        return isinstance(node, Compare)
+
+    def _pow(self, node):
+        (base, base_kind), (exponent, _) = self.expr(node.base), self.expr(node.exponent)
+        new = Pow(base, exponent, node.tok)
+        if isinstance(base, Const) and isinstance(exponent, Const):
+            # Only float powers are folded: int ** int (from bool arithmetic) can be unbounded work.
+            if type(base.value) is float or type(exponent.value) is float:
+                return self._fold(new)
+            return new, None
+        if isinstance(exponent, Const) and type(exponent.value) is float:
+            if base_kind == FLOAT and exponent.value == 1.0:
+                return base, FLOAT
+            if (self.fast_math and isinstance(base, Name) and base_kind != BOOL
+                    and exponent.value in FAST_MATH_POWERS):
+                product = base
+                for _ in range(int(exponent.value) - 1):
+                    product = BinOp(Op.MUL, product, base, node.tok)
+                return product, FLOAT
+        return new, None
+
+    def _scientific(self, node):
+        exponent, kind = self.expr(node.exponent)
+        new = Scientific(node.mantissa, exponent, node.tok)
+        if isinstance(exponent, Const):
+            return self._fold(new)
+        return new, FLOAT if kind in (FLOAT, BOOL) else None
+
+
+def optimize(program: Program, fast_math=False):
+    """Returns a constant-folded, simplified copy of `program`."""
+    return Optimizer(fast_math).optimize(program)
@@ -0,0 +1,82 @@
+import math
+from time import perf_counter
+
+from ExprAst import Pow, Scientific, children, count_nodes
+from ExprTrace import Tracer
+
+
+class StatementProfile:
+    """What running one statement cost: wall time, nodes evaluated, `^` (and `x10^`)
+    operations, and the largest magnitude of any number computed on the way."""
+    __slots__ = ('stat', 'seconds', 'nodes', 'pows', 'max_magnitude')
+
+    def __init__(self, stat):
+        self.stat = stat
+        self.seconds = 0.0
+        self.nodes = 0
+        self.pows = 0
+        self.max_magnitude = 0.0
+
+    def measure(self, value):
+        t = type(value)
+        # Not bool: comparisons are no magnitudes
+        if t is float or t is int or t is complex:
+            magnitude = abs(value)
+            if magnitude > self.max_magnitude:
+                self.max_magnitude = magnitude
+
+    def to_dict(self, line, column):
+        # JSON has no infinity: an overflowing statement reports "inf"
+        magnitude = self.max_magnitude if math.isfinite(self.max_magnitude) else str(self.max_magnitude)
+        return {'line': line, 'column': column, 'seconds': self.seconds, 'nodes': self.nodes,
+                'pows': self.pows, 'max_magnitude': magnitude}
+
+
+def _count_pows(node):
+    # Pow and Scientific nodes in the subtree rooted at `node`
+    count, pending = 0, [node]
+    while pending:
+        node = pending.pop()
+        if type(node) is Pow or type(node) is Scientific:
+            count += 1
+        pending.extend(children(node))
+    return count
+
+
+class Profiler(Tracer):
+    """A Tracer that records a StatementProfile per statement run in `profiles`.
+
+    Wall times include printing (and so any wait for a slow client) and the
+    tracing itself. Statements too deep to evaluate recursively get no on_node
+    calls: their node and pow counts are those of the whole tree, short-circuited
+    operands included, and only their result's magnitude is seen.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self._profile = None
+        self._start = 0.0
+
+    def on_statement_start(self, stat, line):
+        self._profile = StatementProfile(stat)
+        self.profiles.append(self._profile)
+        self._start = perf_counter()
+
+    def on_statement_end(self, stat, line, value):
+        profile = self._profile
+        profile.seconds = perf_counter() - self._start
+        if not profile.nodes:
+            profile.nodes = count_nodes(stat)
+            profile.pows = _count_pows(stat)
+            profile.measure(value)
+
+    def on_error(self, stat, line, error):
+        self._profile.seconds = perf_counter() - self._start
+
+    def on_node(self, node, value):
+        profile = self._profile
+        profile.nodes += 1
+        t = type(node)
+        if t is Pow or t is Scientific:
+            profile.pows += 1
+        profile.measure(value)
@@ -0,0 +1,91 @@
+from ExprAst import Assign
+from ExprFastParser import ID, FastParser, tokenize
+
+
+def statement_inputs(stat, types, texts, start, end):
+    """The token texts of statement `stat`, which spans tokens [start, end), and the
+    variables it reads (its IDs, except an assignment's target)."""
+    first = start + 2 if type(stat) is Assign else start
+    return tuple(texts[start:end]), [texts[i] for i in range(first, end) if types[i] == ID]
+
+
+def split_statements(text):
+    """Parses `text` into the (stat, texts, reads, where) entries Interpreter.interpret_reactive runs.
+
+    `where` is (positions, line_offset): the token positions `stat` indexes, and what
+    to add to their line numbers. Raises FastParseError if the fast parser gives up.
+    """
+    tokens = tokenize(text)
+    types, texts, positions = tokens
+    where = (positions, 0)
+    parser = FastParser(text, tokens)
+    statements = []
+    while True:
+        start = parser.pos
+        stat = parser.next_stat()
+        if stat is None:
+            return statements
+        statements.append((stat, *statement_inputs(stat, types, texts, start, parser.pos), where))
+
+
+def _value_key(value):
+    # Floats by their exact bits: 0.0 == -0.0 although they print differently.
+    return value.hex() if type(value) is float else (type(value), value)
+
+
+class StatementMemo:
+    """What each statement of a program's last run produced, for Interpreter.interpret_reactive.
+
+    Entries are keyed by a statement's token texts and the values of the variables it
+    reads, so a statement is skipped exactly when it would compute what it did last
+    time, wherever the edit moved it. This is the dependency graph in value form: a
+    statement depends on the latest assignment before it to each variable it reads,
+    and an edit reaches it only if it changes one of those values. An edit that leaves
+    a value unchanged (`a = 10` becoming `a = 5 + 5`) stops there.
+
+    Only the last run's entries are kept (after a run stopped by an error or a
+    cancellation, the earlier ones too, for when it is fixed).
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._next = {}
+        # Token texts the keys hold, for memory estimates
+        self.tokens = 0
+
+    def key(self, texts, reads, env):
+        """Key of a statement with token texts `texts` (a tuple) reading the variables
+        `reads` from `env`; None if it cannot be memoized (a read is undefined or unhashable)."""
+        try:
+            key = (texts, tuple([_value_key(env[name]) for name in reads]))
+            hash(key)
+        except (KeyError, TypeError):
+            return None
+        return key
+
+    def get(self, key):
+        """The remembered outcome as a 1-tuple (value,), or None; keeps it for the next run."""
+        outcome = self._entries.get(key)
+        if outcome is not None:
+            self._next[key] = outcome
+        return outcome
+
+    def put(self, key, value):
+        self._next[key] = (value,)
+
+    def finish(self, complete):
+        """Ends a run: keeps what it used, plus the older entries if it did not `complete`."""
+        if complete:
+            self._entries = self._next
+        else:
+            self._entries.update(self._next)
+        self._next = {}
+        self.tokens = sum(len(texts) for texts, _ in self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._next.clear()
+        self.tokens = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,83 @@
+from ExprAst import MAX_RECURSIVE_DEPTH, Assign, AstEvaluator, RunCancelled, StackEvaluator, max_depth
+
+
+class Tracer:
+    """Hooks called while a program runs; subclass and override the ones you need
+    (see Interpreter.add_tracer).
+
+    Statement hooks get the statement's AST node and the line it starts on. Left as
+    None, `on_node` costs nothing; defined as on_node(node, value), it is called after
+    every node evaluates, except within statements too deep to evaluate recursively
+    (they run on the StackEvaluator, which has no hooks).
+    """
+
+    on_node = None
+
+    def on_statement_start(self, stat, line):
+        pass
+
+    def on_statement_end(self, stat, line, value):
+        """After a statement completes, with its value."""
+
+    def on_assign(self, name, value):
+        """After an assignment statement, before on_statement_end."""
+
+    def on_error(self, stat, line, error):
+        """When a statement raises `error` (an ExprRuntimeError, or e.g. a ZeroDivisionError), instead of on_statement_end."""
+
+
+class TracingEvaluator(AstEvaluator):
+    """An AstEvaluator that calls `tracers` around each statement.
+
+    `line_of(node)` gives the line a node starts on. Use NodeTracingEvaluator when a
+    tracer has on_node, so this one's eval stays the plain AstEvaluator's.
+    """
+
+    def __init__(self, env, on_print, tracers, line_of, lazy_bool=False, cancel_token=None):
+        super().__init__(env, on_print, lazy_bool, cancel_token)
+        self.tracers = tracers
+        self.line_of = line_of
+
+    def run(self, program):
+        result = None
+        cancel, tracers = self.cancel_token, self.tracers
+        deep = program.depth > MAX_RECURSIVE_DEPTH
+        for stat in program.stats:
+            if cancel is not None:
+                cancel.check()
+            line = self.line_of(stat)
+            for tracer in tracers:
+                tracer.on_statement_start(stat, line)
+            try:
+                if deep and max_depth(stat) > MAX_RECURSIVE_DEPTH:
+                    evaluator = StackEvaluator(self.env, self.on_print, self.lazy_bool, cancel)
+                    evaluator.skipped = self.skipped
+                    result = evaluator.eval(stat)
+                else:
+                    result = self.eval(stat)
+            except RunCancelled:
+                raise
+            except Exception as e:
+                for tracer in tracers:
+                    tracer.on_error(stat, line, e)
+                raise
+            if type(stat) is Assign:
+                for tracer in tracers:
+                    tracer.on_assign(stat.name, result)
+            for tracer in tracers:
+                tracer.on_statement_end(stat, line, result)
+        return result
+
+
+class NodeTracingEvaluator(TracingEvaluator):
+    """A TracingEvaluator that also calls the tracers' on_node hooks."""
+
+    def __init__(self, env, on_print, tracers, line_of, lazy_bool=False, cancel_token=None):
+        super().__init__(env, on_print, tracers, line_of, lazy_bool, cancel_token)
+        self._node_hooks = [tracer.on_node for tracer in tracers if tracer.on_node is not None]
+
+    def eval(self, node):
+        value = self._dispatch[type(node)](node)
+        for hook in self._node_hooks:
+            hook(node, value)
+        return value
@@ -0,0 +1,113 @@
+import numpy as np
+from ExprAst import COMPARE_FUNCS, ExprRuntimeError, Op, Program
+from ExprCompiler import CompiledProgram, Compiler
+
+
+# Failing element indices listed in an assertion message; the count is always exact.
+MAX_REPORTED_INDICES = 10
+
+
+def assertion_message(failed):
+    """Describes a failed assert from the mask of elements where it did not hold."""
+    if failed.ndim == 0:
+        return "Assertion failed."
+    indices = np.argwhere(failed)
+    shown = ', '.join(
+        str(int(index[0])) if len(index) == 1 else str(tuple(int(i) for i in index))
+        for index in indices[:MAX_REPORTED_INDICES]
+    )
+    more = len(indices) - MAX_REPORTED_INDICES
+    if more > 0:
+        shown += f", and {more} more"
+    return f"Assertion failed for {len(indices)} of {failed.size} elements (at {shown})."
+
+
+class VectorProgram(CompiledProgram):
+    """A CompiledProgram whose variables may hold NumPy arrays.
+
+    Lists, tuples and integer arrays in the environment are run as float arrays,
+    since Expr numbers are floats; the conversion is not written back, so the
+    caller's env keeps its values except for the variables the program assigns.
+    Division by zero and invalid operations give inf/nan elements instead of raising.
+    """
+    __slots__ = ()
+
+    def run(self, env, emit, cancel_token=None):
+        local, converted = {}, {}
+        for name in self.names:
+            if name not in env:
+                continue
+            value = env[name]
+            if isinstance(value, (list, tuple)) or (
+                    isinstance(value, np.ndarray) and value.dtype.kind in 'iu'):
+                value = converted[name] = np.asarray(value, dtype=float)
+            local[name] = value
+        try:
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                return super().run(local, emit, cancel_token)
+        finally:
+            for name, value in local.items():
+                if name not in converted or value is not converted[name]:
+                    env[name] = value
+
+
+class VectorCompiler(Compiler):
+    """Compiles a program to run element-wise over array-valued variables in one pass.
+
+    Arithmetic, `^`, `x10^` and two-operand comparisons already broadcast through the
+    Python operators the base Compiler emits, so each costs one NumPy call per run.
+    `and`, `or` and `not` become boolean masks, comparison chains combine their
+    pairwise masks, and a failing `assert` reports how many elements failed and
+    which. Nothing short-circuits: every operand is evaluated for every element.
+    """
+
+    program_class = VectorProgram
+
+    def __init__(self):
+        super().__init__(lazy_bool=False)
+
+    def _assert(self, node):
+        expr = self.expr(node.expr)
+
+        def assert_(frame, emit):
+            value = expr(frame)
+            failed = np.logical_not(value)
+            if failed.any():
+                raise ExprRuntimeError(node, assertion_message(failed))
+            return value
+        return assert_
+
+    def _binop(self, node):
+        if node.op not in (Op.AND, Op.OR):
+            return super()._binop(node)
+        combine = np.logical_and if node.op == Op.AND else np.logical_or
+        left, right = self.expr(node.left), self.expr(node.right)
+        return lambda frame: combine(left(frame), right(frame))
+
+    def _compare(self, node):
+        if len(node.operands) == 2:
+            return super()._compare(node)
+
+        operands = [self.expr(operand) for operand in node.operands]
+        first, rest = operands[0], list(zip((COMPARE_FUNCS[op] for op in node.ops), operands[1:]))
+
+        def chain(frame):
+            left = first(frame)
+            mask = True
+            for compare, operand in rest:
+                right = operand(frame)
+                mask = np.logical_and(mask, compare(left, right))
+                left = right
+            return mask
+        return chain
+
+    def _unary(self, node):
+        if node.op != Op.NOT:
+            return super()._unary(node)
+        operand = self.expr(node.operand)
+        return lambda frame: np.logical_not(operand(frame))
+
+
+def compile_vector(program: Program):
+    """Compiles a lowered Program into a VectorProgram."""
+    return VectorCompiler().compile_program(program)
@@ -1,5 +1,7 @@
 import json
 import sys
+from bisect import bisect_left
+from time import perf_counter
 from antlr4 import *
 from antlr4.error.ErrorListener import ErrorListener
 # IMPORTANT: These imports must point to your generated ANTLR files
@@ -7,6 +9,14 @@ from antlr4.error.ErrorListener import ErrorListener
 from ExprParser import ExprParser
 from ExprVisitor import ExprVisitor
 from ExprLexer import ExprLexer
+from ExprAst import (CANCEL_CHECK_INTERVAL, MAX_RECURSIVE_DEPTH, Assign, AstEvaluator, ExprRuntimeError, Print,
+                     Program, RunCancelled, StackEvaluator, lower, max_depth)
+from ExprCompiler import SKIPPED, CompiledProgram, compile_program
+from ExprFastParser import FastParseError, FastParser, fast_parse, tokenize
+from ExprOptimizer import Optimizer
+from ExprProfile import Profiler
+from ExprTrace import NodeTracingEvaluator, TracingEvaluator
+from ExprReactive import split_statements
 
 
 # Helper function to format the error output
@@ -42,13 +52,36 @@ def format_error(error_info, error_type="Runtime Error"):
     ]
     return "\n".join(report)
 
+
+def read_line_blocks(file, chunk_size=1 << 16):
+    """Yields the text of `file` in blocks of about `chunk_size` characters, each ending at a line break.
+
+    Tokens never span lines, so a block can always be tokenized on its own.
+    """
+    pending = []
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            if pending:
+                yield ''.join(pending)
+            return
+        cut = chunk.rfind('\n') + 1
+        if cut == 0:
+            pending.append(chunk)
+            continue
+        pending.append(chunk[:cut])
+        yield ''.join(pending)
+        pending = [chunk[cut:]]
+
 # 1. Custom Error Listener for Syntax Errors
 class ErrorReportListener(ErrorListener):
     """Captures and stores syntax errors with line/column information."""
-    def __init__(self, source_code):
+    def __init__(self, source_code, line_base=0):
         super().__init__()
         # Split source code into lines for easy lookup
         self.source_code_lines = source_code.splitlines(keepends=False)
+        # Lines before `source_code` (when it is a slice of a streamed file)
+        self.line_base = line_base
         self.errors = []
 
     def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
@@ -61,7 +94,7 @@ class ErrorReportListener(ErrorListener):
         error_message = f"Syntax Error: {msg}"
         self.errors.append({
             'message': error_message,
-            'line': line,
+            'line': line + self.line_base,
             'column': column,
             'source_line': problematic_line,
             'error_pointer': ' ' * column + '^'
@@ -80,36 +113,124 @@ class Interpreter(ExprVisitor):
             self.error_info = error_info
             super().__init__(error_info['message'], *args, **kwargs)
 
-    def __init__(self, initial_env=None):
+    # Execution engines: "compiled" runs the AST compiled to closures (see ExprCompiler.py),
+    # "ast" evaluates the lowered AST (see ExprAst.py), "stack" does so without recursion,
+    # and "visitor" walks the ANTLR parse tree directly through the visit* methods below.
+    # Programs nested deeper than MAX_RECURSIVE_DEPTH always run on the "stack" engine
+    # (except with "visitor", the reference implementation).
+    # "vector" compiles for NumPy arrays in the environment and evaluates element-wise
+    # (see ExprVector.py; NumPy is only imported for this engine).
+    ENGINES = ("compiled", "ast", "stack", "visitor", "vector")
+
+    # Try the hand-written parser before ANTLR (the "visitor" engine always uses ANTLR).
+    use_fast_parser = True
+
+    def __init__(self, initial_env=None, engine="compiled", program_cache=None,
+                 optimize=True, fast_math=False, lazy_bool=False, cancel_token=None, profile=False,
+                 static_checks=True):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {self.ENGINES}")
         self.env = initial_env if initial_env is not None else {}
+        self.engine = engine
+        # Constant folding/simplification before running (see ExprOptimizer.py);
+        # fast_math additionally allows the inexact pow -> multiplication rewrites.
+        self.optimize = optimize
+        self.fast_math = fast_math
+        # Short-circuit `and`/`or` (ast/compiled engines). Off by default because it
+        # changes semantics: skipped operands can no longer raise errors.
+        self.lazy_bool = lazy_bool
+        # Report a compiled program's reads of variables that are never defined before
+        # running any of it, rather than when the read is reached (see _execute).
+        self.static_checks = static_checks
+        # ExprTrace.Tracers called as programs run (see add_tracer)
+        self.tracers = []
+        # Measure every statement run with an ExprProfile.Profiler, into statement_profiles
+        self.profile = profile
+        self.statement_profiles = []
+        # Operands skipped by short-circuiting during the last run()
+        self.skipped_subtrees = 0
+        self.skipped_nodes = 0
+        # Optional ProgramCache shared between interpreters (see ProgramCache.py)
+        self.program_cache = program_cache
+        # Optional ExprAst.CancelToken: once cancelled, runs stop at the next check
+        # and return None without reporting anything.
+        self.cancel_token = cancel_token
         self.source_code = ""
+        self._positions = []
+        # Lines of the input before self.source_code (non-zero only in interpret_stream)
+        self._line_base = 0
+        # Seconds the last interpret() spent in each phase: 'lex' (the fast parser's
+        # tokenizer), 'parse' (including ANTLR, or relocating a cached program),
+        # 'compile' (optimizer and compiler) and 'eval'. compile() and run() add to it.
+        self.timings = {}
+
+    def _timed(self, phase, start):
+        """Adds the time since `start` (a perf_counter() value) to self.timings[phase]; returns the time now."""
+        now = perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + (now - start)
+        return now
 
     # Helper to get error info from a Context object
     def _get_error_info(self, ctx, message):
         """Extracts location information from an ANTLR context or token."""
-        # Check if ctx is a Token (e.g., from ctx.ID().getPayload()) or a RuleContext
+        # Check if ctx is a Token (e.g., from ctx.ID().getPayload()), a RuleContext,
+        # or a lowered AST node (which only knows the index of its first token)
         if isinstance(ctx, Token):
-            start_token = ctx
+            line, column = ctx.line, ctx.column
+        elif isinstance(ctx, ParserRuleContext):
+            line, column = ctx.start.line, ctx.start.column
         else:
-            start_token = ctx.start
+            line, column = self._positions[ctx.tok]
 
         # Tokens provide line and column information
         return {
             'message': message,
-            'line': start_token.line,
-            'column': start_token.column,
-            'source_line': self.source_code.splitlines(keepends=False)[start_token.line - 1],
+            'line': line + self._line_base,
+            'column': column,
+            'source_line': self.source_code.splitlines(keepends=False)[line - 1],
             # Point to the start of the token
-            'error_pointer': ' ' * start_token.column + '^'
+            'error_pointer': ' ' * column + '^'
         }
+
     
     # NEW: Default error output handler (prints to console)
     def _handle_error_output(self, error_info, error_type):
         """Default error output (prints to standard error)."""
         print(format_error(error_info, error_type), file=sys.stderr)
 
+    # Default print output handler (prints to console)
+    def _handle_print_output(self, value):
+        """Default output for `print` statements (prints to standard output)."""
+        print(value)
+
     # Entry: interpret a whole input string
     def interpret(self, text):
+        self.timings = {}
+        self.statement_profiles = []
+        if self.engine == "visitor":
+            start = perf_counter()
+            parsed = self._parse_tree(text)
+            start = self._timed('parse', start)
+            if parsed is None:
+                return None
+            try:
+                return self.visit(parsed[0])
+            except self.CustomRuntimeError as e:
+                # Use the defined error handler
+                self._handle_error_output(e.error_info, "Runtime Error")
+                return None
+            except RunCancelled:
+                return None
+            finally:
+                self._timed('eval', start)
+
+        program = self.compile(text)
+        if program is None:
+            return None
+        return self.run(program)
+
+    def _parse_tree(self, text):
+        """Parses `text` with ANTLR; returns (tree, token_stream), or None after reporting a syntax error."""
         self.source_code = text
         input_stream = InputStream(text)
         lexer = ExprLexer(input_stream)
@@ -117,10 +238,18 @@ class Interpreter(ExprVisitor):
         parser = ExprParser(stream)
 
         parser.removeErrorListeners()
-        error_listener = ErrorReportListener(text)
+        error_listener = ErrorReportListener(text, self._line_base)
         parser.addErrorListener(error_listener)
         
-        tree = parser.prog()
+        try:
+            tree = parser.prog()
+        except RecursionError:
+            # ANTLR's recursive descent only runs on input the fast parser rejected, so
+            # this is malformed as well as deeply nested; report where ANTLR gave up.
+            token = parser.getCurrentToken()
+            error_listener.syntaxError(parser, token, token.line, token.column,
+                                       "expression nested too deeply", None)
+            tree = None
 
         # Check for syntax errors first
         syntax_errors = error_listener.report_errors()
@@ -128,18 +257,368 @@ class Interpreter(ExprVisitor):
             # CALL 1: Format the syntax error before handling the output
             self._handle_error_output(syntax_errors[0], "Syntax Error")
             return None
-
+        return tree, stream
+
+    def parse(self, text, tokens=None):
+        """Parses and lowers `text` to an AST Program, or returns None after reporting a syntax error.
+
+        The hand-written parser in ExprFastParser.py handles well-formed programs; ANTLR
+        only runs when it gives up, so syntax errors keep their ErrorReportListener diagnostics.
+        """
+        if self.use_fast_parser:
+            try:
+                program = fast_parse(text, tokens)
+                self.source_code = text
+                return program
+            except FastParseError:
+                pass
+
+        parsed = self._parse_tree(text)
+        if parsed is None:
+            return None
+        tree, stream = parsed
+        return lower(tree, stream.tokens, text)
+
+    def compile(self, text):
+        """Parses `text` into the form run() executes for this engine (None on syntax errors or cancellation).
+
+        With the "compiled" engine the result is a CompiledProgram, which can be run
+        repeatedly (against different environments) without parsing again. When a
+        program_cache is set, programs with the same token stream are only built once.
+        """
+        cache, key, tokens = self.program_cache, None, None
+        start = perf_counter()
+        if self.use_fast_parser:
+            try:
+                tokens = tokenize(text)
+            except FastParseError:
+                pass  # ANTLR reports (or skips) the bad character below; not cached
+            start = self._timed('lex', start)
+        if cache is not None and tokens is not None:
+            variant = f"{self.engine}:{self.optimize:d}{self.fast_math:d}{self.lazy_bool:d}{self._traced:d}"
+            key = cache.make_key(variant, tokens[1])
+            cached = cache.get(key)
+            if cached is not None:
+                self.source_code = text
+                program = cached.relocate(text, tokens[2])
+                self._timed('parse', start)
+                return program
+
+        program = self.parse(text, tokens)
+        start = self._timed('parse', start)
+        if self.cancel_token is not None and self.cancel_token.cancelled:
+            return None
+        # The optimizer and compiler recurse; deep programs go straight to the StackEvaluator.
+        shallow = program is not None and program.depth <= MAX_RECURSIVE_DEPTH
+        if shallow and self.optimize:
+            program = Optimizer(self.fast_math).optimize(program)
+        if shallow and self.engine == "compiled" and not self._traced:
+            program = compile_program(program, self.lazy_bool)
+        if self.engine == "vector" and program is not None:
+            if not shallow:
+                # Vectorized programs only exist compiled, and the compiler recurses.
+                self._positions = program.positions
+                deepest = max(program.stats, key=max_depth)
+                self._handle_error_output(
+                    self._get_error_info(deepest, "Expression nested too deeply to vectorize."),
+                    "Runtime Error")
+                return None
+            from ExprVector import compile_vector
+            program = compile_vector(program)
+        if key is not None and program is not None:
+            cache.put(key, program, len(tokens[1]))
+        self._timed('compile', start)
+        return program
+
+    def run(self, program):
+        """Runs a Program or CompiledProgram against self.env, reporting runtime errors."""
+        self.source_code = program.source
+        self._positions = program.positions
+        start = perf_counter()
         try:
-            return self.visit(tree)
-        except self.CustomRuntimeError as e:
+            return self._execute(program, self.env, self._handle_print_output)
+        except ExprRuntimeError as e:
             # Use the defined error handler
-            self._handle_error_output(e.error_info, "Runtime Error")
+            self._handle_error_output(self._get_error_info(e.node, e.message), "Runtime Error")
+            return None
+        except RunCancelled:
+            return None
+        finally:
+            self._timed('eval', start)
+
+    def _execute(self, program, env, emit):
+        """Runs `program` against `env`, passing printed values to `emit`; raises ExprRuntimeError.
+
+        With static_checks, a CompiledProgram that reads a variable neither `env` nor an
+        earlier assignment defines fails at that read before any statement runs.
+        """
+        if isinstance(program, CompiledProgram):
+            if self.static_checks:
+                for name, node, _ in program.free_uses:
+                    if name not in env:
+                        raise ExprRuntimeError(node, f"Undefined variable '{name}'.")
+            SKIPPED.reset()
+            skipped = SKIPPED
+            execute = lambda: program.run(env, emit, self.cancel_token)
+        elif self._traced and isinstance(program, Program):
+            tracers = list(self.tracers)
+            if self.profile:
+                profiler = Profiler()
+                self.statement_profiles = profiler.profiles
+                tracers.append(profiler)
+            positions, line_base = program.positions, self._line_base
+            line_of = lambda node: positions[node.tok][0] + line_base
+            traced_nodes = any(tracer.on_node is not None for tracer in tracers)
+            evaluator_class = NodeTracingEvaluator if traced_nodes else TracingEvaluator
+            evaluator = evaluator_class(env, emit, tracers, line_of, self.lazy_bool, self.cancel_token)
+            skipped = evaluator.skipped
+            execute = lambda: evaluator.run(program)
+        else:
+            # Cancellable runs of statements too large to go without a check also take the stack
+            recursive = (self.engine != "stack" and program.depth <= MAX_RECURSIVE_DEPTH
+                         and (self.cancel_token is None or program.largest <= CANCEL_CHECK_INTERVAL))
+            evaluator_class = AstEvaluator if recursive else StackEvaluator
+            evaluator = evaluator_class(env, emit, self.lazy_bool, self.cancel_token)
+            skipped = evaluator.skipped
+            execute = lambda: evaluator.run(program)
+        try:
+            return execute()
+        finally:
+            self.skipped_subtrees, self.skipped_nodes = skipped.subtrees, skipped.nodes
+
+    def add_tracer(self, tracer):
+        """Calls the hooks of `tracer` (an ExprTrace.Tracer) in every later run.
+
+        Traced programs run on the AST evaluator (the "compiled" engine compiles them
+        no further), so add tracers before compile(). Without tracers, runs take the
+        usual path, checking no hooks per statement or node. The "vector" and
+        "visitor" engines are not traced, nor are interpret_stream() and
+        interpret_reactive().
+        """
+        self.tracers.append(tracer)
+
+    def remove_tracer(self, tracer):
+        self.tracers.remove(tracer)
+
+    @property
+    def _traced(self):
+        return bool(self.tracers) or self.profile
+
+    def profile_report(self):
+        """The statement_profiles of the last run as dicts, with the line and column each statement starts at."""
+        report = []
+        for profile in self.statement_profiles:
+            line, column = self._positions[profile.stat.tok]
+            report.append(profile.to_dict(line + self._line_base, column))
+        return report
+
+    def interpret_batch(self, text, rows):
+        """Compiles `text` once and runs it for every environment row; yields one result dict per row.
+
+        Yields nothing if `text` has a syntax error (reported through the error handler).
+        See run_batch() for the result format.
+        """
+        program = self.compile(text)
+        if program is None:
+            return
+        yield from self.run_batch(program, rows)
+
+    def run_batch(self, program, rows):
+        """Runs a compiled program once per row of variables, yielding a result dict per row.
+
+        Each row runs against a fresh copy of self.env updated with the row, so rows never
+        see each other's assignments. Stops early, between or within rows, once
+        self.cancel_token is cancelled. Results have the keys `row` (its index), `result`
+        (the last statement's value), `output` (printed values), `error` (a formatted
+        error report, or None) and `env` (the row's final variables).
+        """
+        self.source_code = program.source
+        self._positions = program.positions
+        for index, row in enumerate(rows):
+            if self.cancel_token is not None and self.cancel_token.cancelled:
+                return
+            env = dict(self.env)
+            env.update(row)
+            output = []
+            result, error = None, None
+            try:
+                result = self._execute(program, env, output.append)
+            except RunCancelled:
+                return
+            except ExprRuntimeError as e:
+                error = format_error(self._get_error_info(e.node, e.message), "Runtime Error")
+            except Exception as e:
+                # One row's arithmetic failure (1/0, overflow) must not abort the rest of the batch.
+                error = f"{type(e).__name__}: {e}"
+            yield {'row': index, 'result': result, 'output': output, 'error': error, 'env': env}
+
+    def interpret_stream(self, file, chunk_size=1 << 16):
+        """Runs a program read incrementally from the text file object `file`.
+
+        The input is read `chunk_size` characters at a time, and statements are parsed
+        and executed one by one, so output starts before the file has been read and
+        memory stays flat whatever its size. Each statement is evaluated with the
+        StackEvaluator whatever the engine: it runs exactly once, so compiling it would
+        not pay off.
+
+        Unlike interpret(), statements before a runtime or syntax error have already run.
+        Input the hand-written parser declines (syntax errors, characters ANTLR's lexer
+        skips) sends the rest of the file to ANTLR in one piece, for its diagnostics.
+        """
+        blocks = read_line_blocks(file, chunk_size)
+        evaluator = StackEvaluator(self.env, self._handle_print_output, self.lazy_bool, self.cancel_token)
+        # `text` always starts at the beginning of a line; statements before column
+        # `start_col` of its first line have already run.
+        text, start_col, at_eof = '', 0, False
+        result = None
+        self._line_base = 0
+        try:
+            while True:
+                # Read at least as much again as is carried over, so a statement
+                # spanning many blocks is re-parsed a logarithmic number of times.
+                wanted = max(len(text), 1)
+                while wanted > 0 and not at_eof:
+                    block = next(blocks, None)
+                    if block is None:
+                        at_eof = True
+                    else:
+                        text += block
+                        wanted -= len(block)
+                self.source_code = text
+
+                if not self.use_fast_parser:
+                    return self._interpret_stream_rest(evaluator, text, (1, start_col), blocks, result)
+                try:
+                    tokens = tokenize(text)
+                except FastParseError:
+                    return self._interpret_stream_rest(evaluator, text, (1, start_col), blocks, result)
+                self._positions = positions = tokens[2]
+                parser = FastParser(text, tokens)
+                parser.pos = bisect_left(positions, (1, start_col))
+                end = len(positions) - 1  # the EOF entry, provisional until at_eof
+
+                while True:
+                    start = parser.pos
+                    try:
+                        stat = parser.next_stat()
+                    except FastParseError:
+                        if parser.pos < end or at_eof:
+                            return self._interpret_stream_rest(evaluator, text, positions[start], blocks, result)
+                        break  # ran into the end of the buffered text: read more
+                    if stat is None:
+                        if at_eof:
+                            return result
+                        break
+                    if parser.pos == end and not at_eof:
+                        break  # the statement may continue in the next block
+                    result = evaluator.eval(stat)
+
+                # Carry the unfinished statement's lines over to the next round.
+                line, start_col = positions[start]
+                offset = len(text)
+                for _ in range(positions[end][0] - line + 1):
+                    offset = text.rfind('\n', 0, offset)
+                text = text[offset + 1:]
+                self._line_base += line - 1
+        except ExprRuntimeError as e:
+            self._handle_error_output(self._get_error_info(e.node, e.message), "Runtime Error")
+            return None
+        except RunCancelled:
+            return None
+        finally:
+            self.skipped_subtrees, self.skipped_nodes = evaluator.skipped.subtrees, evaluator.skipped.nodes
+            self._line_base = 0
+
+    def _interpret_stream_rest(self, evaluator, text, first, blocks, result):
+        """Parses the rest of a streamed program with ANTLR and runs its statements from position `first` on."""
+        text += ''.join(blocks)
+        parsed = self._parse_tree(text)
+        if parsed is None:
             return None
+        tree, stream = parsed
+        program = lower(tree, stream.tokens, text)
+        self._positions = program.positions
+        for stat in program.stats:
+            # Statements before `first` have already run.
+            if program.positions[stat.tok] >= first:
+                result = evaluator.eval(stat)
+        return result
+
+    def interpret_reactive(self, text, memo, document=None):
+        """Runs `text` like interpret(), skipping statements whose outcome `memo` remembers.
+
+        `memo` (an ExprReactive.StatementMemo) holds the previous run of an earlier
+        version of the program. A statement is evaluated again only if its tokens, or
+        the values of the variables it reads, differ from that run; otherwise its
+        remembered assignment or print is replayed. So after an edit, only the edited
+        statements and those downstream of a value they changed are evaluated.
+        With `document` (an ExprDocument.ParsedDocument of `text`), its already
+        parsed statements are used instead of parsing `text` again.
+
+        Returns (number of statements, indices of the statements evaluated), or None
+        after reporting a syntax error. Statements run one at a time on the
+        StackEvaluator, as in interpret_stream. Input only ANTLR accepts is run whole
+        and reported as all evaluated. self.timings gets 'parse' (when `document` is
+        not given) and 'eval', or the phases of interpret().
+        """
+        self.timings = {}
+        start = perf_counter()
+        statements = None
+        if document is not None:
+            statements = document.statements()
+        elif self.use_fast_parser:
+            try:
+                statements = split_statements(text)
+            except FastParseError:
+                pass
+            start = self._timed('parse', start)
+        if statements is None:
+            program = self.compile(text)
+            if program is None:
+                return None
+            memo.clear()
+            self.run(program)
+            return len(program.stats), list(range(len(program.stats)))
+
+        self.source_code = text
+        env, cancel = self.env, self.cancel_token
+        evaluator = StackEvaluator(env, self._handle_print_output, self.lazy_bool, cancel)
+        evaluated = []
+        complete = False
+        try:
+            for index, (stat, texts, reads, where) in enumerate(statements):
+                if cancel is not None:
+                    cancel.check()
+                key = memo.key(texts, reads, env)
+                outcome = memo.get(key) if key is not None else None
+                if outcome is None:
+                    evaluated.append(index)
+                    value = evaluator.eval(stat)
+                    if key is not None:
+                        memo.put(key, value)
+                elif type(stat) is Assign:
+                    env[stat.name] = outcome[0]
+                elif type(stat) is Print:
+                    self._handle_print_output(outcome[0])
+            complete = True
+        except ExprRuntimeError as e:
+            positions, line_offset = where
+            self._positions = [(line + line_offset, column) for line, column in positions] if line_offset else positions
+            self._handle_error_output(self._get_error_info(e.node, e.message), "Runtime Error")
+        except RunCancelled:
+            pass
+        finally:
+            memo.finish(complete)
+            self.skipped_subtrees, self.skipped_nodes = evaluator.skipped.subtrees, evaluator.skipped.nodes
+            self._timed('eval', start)
+        return len(statements), evaluated
     
     # ---- Program ----
     def visitProg(self, ctx: ExprParser.ProgContext):
         result = None
         for stat in ctx.stat():
+            if self.cancel_token is not None:
+                self.cancel_token.check()
             result = self.visit(stat)
         return result
 
@@ -162,7 +641,7 @@ class Interpreter(ExprVisitor):
     
     def visitPrintStat(self, ctx: ExprParser.PrintStatContext):
         value = self.visit(ctx.expr())
-        print(value) 
+        self._handle_print_output(value)
         return value
 
     def visitStat(self, ctx: ExprParser.StatContext):
@@ -294,10 +773,13 @@ class Interpreter(ExprVisitor):
         return base * (10 ** exponent)
 
 
+_STDOUT_EVENT_PREFIX = '{"type": "stdout", "content": '
+
+
 class StreamingInterpreter(Interpreter):
     """An Interpreter subclass that redirects print and error output via callbacks."""
-    def __init__(self, initial_env=None):
-        super().__init__(initial_env)
+    def __init__(self, initial_env=None, **kwargs):
+        super().__init__(initial_env, **kwargs)
         self._stream_callback = None
 
     def set_stream_callback(self, callback):
@@ -305,14 +787,22 @@ class StreamingInterpreter(Interpreter):
         self._stream_callback = callback
     
     # OVERRIDE: Redirects print statements to the unified callback
-    def visitPrintStat(self, ctx: ExprParser.PrintStatContext):
-        value = self.visit(ctx.expr())
+    def _handle_print_output(self, value):
         if self._stream_callback:
-            # Send structured JSON string for stdout
-            self._stream_callback(json.dumps({ 'type': 'stdout', 'content': str(value) }))
+            # Send structured JSON string for stdout (the same text as
+            # json.dumps({'type': 'stdout', 'content': str(value)}), built for less per print)
+            self._stream_callback(_STDOUT_EVENT_PREFIX + json.dumps(str(value)) + '}')
         else:
             print(value) 
-        return value
+
+    def run(self, program):
+        """Runs `program` (see Interpreter.run); with `profile`, then streams the
+        'profile' event: the profile_report() of the statements that ran."""
+        try:
+            return super().run(program)
+        finally:
+            if self.profile and self._stream_callback and self.statement_profiles:
+                self._stream_callback(json.dumps({'type': 'profile', 'content': self.profile_report()}))
 
     # OVERRIDE: Redirects all error output to the unified callback
     def _handle_error_output(self, error_info, error_type):
@@ -0,0 +1,82 @@
+import threading
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help_text, lock):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = lock
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Histogram:
+    """A Prometheus histogram, optionally split by the values of one label."""
+
+    def __init__(self, name, help_text, lock, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.label = label
+        self._series = {}  # label value (None without a label) -> [bucket counts..., count, sum]
+        self._lock = lock
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items(), key=lambda item: item[0] or ''):
+            labels = f'{self.label}="{label_value}",' if self.label is not None else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels}le="{_format(bound)}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {series[-2]}')
+            suffix = f'{{{labels[:-1]}}}' if labels else ''
+            lines.append(f"{self.name}_count{suffix} {series[-2]}")
+            lines.append(f"{self.name}_sum{suffix} {series[-1]!r}")
+        return lines
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms, rendered in the Prometheus text format
+    (without the prometheus_client dependency)."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text, self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, label=None):
+        metric = Histogram(name, help_text, self._lock, buckets, label)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            return ''.join(line + '\n' for metric in self._metrics for line in metric.render())
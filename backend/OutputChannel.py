@@ -0,0 +1,165 @@
+import asyncio
+import json
+import threading
+from collections import deque
+
+
+# What a writer does when the buffer is full: wait for the reader, drop the oldest
+# buffered items (the reader then gets a truncation marker), or end the run.
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'abort')
+
+ABORT_EVENT = json.dumps({
+    'type': 'fatal_error',
+    'content': "FATAL SERVER ERROR: Output buffer full (the client is reading too slowly); run aborted.",
+})
+
+
+# Events still buffered after an abort, past `max_bytes`: what the client needs to
+# close the run (the final environment, the profile, the session's new state).
+FINAL_EVENT_PREFIXES = tuple(
+    f'{{"type": "{event_type}"' for event_type in ('env_snapshot', 'profile', 'session', 'recomputed'))
+
+
+def truncation_event(dropped):
+    return json.dumps({'type': 'truncated', 'content': f"[{dropped} earlier output events dropped]"})
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class OutputChannel:
+    """A bounded buffer of strings from a worker thread to a coroutine on the event loop.
+
+    At most `max_bytes` of items are buffered (a single larger item is still let
+    through on its own); `policy` decides what put() does beyond that. The worker
+    thread only schedules a wakeup when the reader is actually waiting, and
+    get_frame() lets the reader take many items per wakeup.
+
+    Once the 'abort' policy has aborted, put() drops everything but the events
+    named in FINAL_EVENT_PREFIXES, which follow the abort marker.
+
+    `peak_bytes`, `dropped` and `aborted` describe the request once it is over.
+    """
+
+    def __init__(self, loop, max_bytes=1024 * 1024, policy='block', on_abort=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}', expected one of {OVERFLOW_POLICIES}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.peak_bytes = 0
+        self.dropped = 0
+        self.aborted = False
+        self._loop = loop
+        self._on_abort = on_abort
+        self._items = deque()
+        self._bytes = 0
+        self._unreported_drops = 0
+        self._finished = False  # the writer is done
+        self._closed = False    # the reader is gone
+        self._waiter = None
+        self._wake_bytes = 1    # buffered bytes at which the waiting reader is woken
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+
+    # ---- Writer side (worker thread) ----
+    def put(self, item: str):
+        """Buffers `item`; may block, drop older items or abort, as the policy says."""
+        aborting = False
+        with self._lock:
+            if self._closed or (self.aborted and not item.startswith(FINAL_EVENT_PREFIXES)):
+                return
+            size = len(item)
+            if self._items and self._bytes + size > self.max_bytes and not self.aborted:
+                if self.policy == 'block':
+                    while self._items and self._bytes + size > self.max_bytes and not self._closed:
+                        self._space.wait()
+                    if self._closed:
+                        return
+                elif self.policy == 'drop_oldest':
+                    while self._items and self._bytes + size > self.max_bytes:
+                        self._bytes -= len(self._items.popleft())
+                        self._unreported_drops += 1
+                        self.dropped += 1
+                else:
+                    self.aborted = aborting = True
+                    item, size = ABORT_EVENT, len(ABORT_EVENT)
+            self._items.append(item)
+            self._bytes += size
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            if self._bytes >= self._wake_bytes:
+                self._notify_reader()
+        if aborting and self._on_abort is not None:
+            self._on_abort()
+
+    def finish(self):
+        """Marks the end of the output; get() returns None once the buffer is drained."""
+        with self._lock:
+            self._finished = True
+            self._notify_reader()
+
+    def _notify_reader(self):
+        if self._waiter is not None:
+            self._loop.call_soon_threadsafe(_wake, self._waiter)
+            self._waiter = None
+
+    # ---- Reader side (event loop) ----
+    def _take(self):
+        # Next item (or truncation marker) with the lock held; None if the buffer is empty.
+        if self._unreported_drops:
+            dropped, self._unreported_drops = self._unreported_drops, 0
+            return truncation_event(dropped)
+        if self._items:
+            item = self._items.popleft()
+            self._bytes -= len(item)
+            self._space.notify()
+            return item
+        return None
+
+    def _wait(self, wake_bytes):
+        self._wake_bytes = wake_bytes
+        self._waiter = self._loop.create_future()
+        return self._waiter
+
+    async def get(self):
+        """Returns the next item, or None after finish() once everything was read."""
+        while True:
+            with self._lock:
+                item = self._take()
+                if item is not None or self._finished:
+                    return item
+                waiter = self._wait(1)
+            await waiter
+
+    async def get_frame(self, max_bytes, max_delay):
+        """Returns a list of items: waits for one, then up to `max_delay` seconds until
+        about `max_bytes` are available. None after finish() once everything was read.
+        """
+        first = await self.get()
+        if first is None:
+            return None
+        items, size = [first], len(first)
+        deadline = self._loop.time() + max_delay
+        while True:
+            with self._lock:
+                while size < max_bytes:
+                    item = self._take()
+                    if item is None:
+                        break
+                    items.append(item)
+                    size += len(item)
+                remaining = deadline - self._loop.time()
+                if size >= max_bytes or self._finished or remaining <= 0:
+                    self._waiter = None
+                    return items
+                waiter = self._wait(max_bytes - size)
+            await asyncio.wait((waiter,), timeout=remaining)
+
+    def close(self):
+        """Called when the reader stops early: discards the buffer and unblocks the writer."""
+        with self._lock:
+            self._closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._space.notify_all()
@@ -0,0 +1,216 @@
+import json
+import math
+import multiprocessing
+import queue
+import resource
+import signal
+import threading
+import time
+
+# How often a run waiting on its worker checks whether it was cancelled.
+CANCEL_POLL_SECONDS = 0.1
+# How long to wait for a worker whose pipe closed to finish exiting, for its exit code.
+EXIT_WAIT_SECONDS = 1.0
+
+_CANCELLED = object()
+
+
+def _limit_memory(memory_bytes):
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        memory_bytes = min(memory_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, hard))
+
+
+def _limit_cpu(cpu_seconds):
+    # RLIMIT_CPU counts the whole process lifetime, so each run moves the soft limit
+    # to the CPU time used so far plus its own allowance; going over sends SIGXCPU.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = math.ceil(usage.ru_utime + usage.ru_stime + cpu_seconds)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _worker_main(conn, memory_bytes, cpu_seconds):
+    """Worker process loop: receives (code, lazy_bool, env, profile) jobs and sends back their events.
+
+    Events are sent as the JSON strings the interpreter callback produces. A run ends
+    with ('end', reason, timings): reason is None normally, or why this worker must be
+    replaced, in which case the worker exits after sending it; timings are the run's
+    Interpreter.timings.
+    """
+    # Already imported by the forkserver (see ProcessPool), so this costs nothing per worker.
+    from Interpreter import StreamingInterpreter
+    from ProgramCache import ProgramCache
+
+    _limit_memory(memory_bytes)
+    program_cache = ProgramCache()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        code, lazy_bool, env, profile = job
+        _limit_cpu(cpu_seconds)
+
+        reason = None
+        interpreter = StreamingInterpreter(program_cache=program_cache, lazy_bool=lazy_bool, profile=profile)
+        interpreter.env = env
+        interpreter.set_stream_callback(conn.send)
+        try:
+            interpreter.interpret(code)
+        except MemoryError:
+            # The heap may be left fragmented near the cap; start the next run afresh.
+            reason = f"Memory limit of {memory_bytes // (1024 * 1024)} MB exceeded."
+        except Exception as e:
+            conn.send(json.dumps({'type': 'fatal_error', 'content': f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"}))
+        finally:
+            try:
+                final_env_json = json.dumps({'type': 'env_snapshot', 'content': interpreter.env})
+            except Exception:
+                final_env_json = json.dumps({'type': 'fatal_error', 'content': "Failed to serialize final environment."})
+            conn.send(final_env_json)
+        conn.send(('end', reason, interpreter.timings))
+        if reason is not None:
+            return
+
+
+class _Worker:
+    __slots__ = ('process', 'conn')
+
+    def __init__(self, context, memory_bytes, cpu_seconds):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, memory_bytes, cpu_seconds), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+
+class ProcessPool:
+    """Runs streaming programs in pre-forked worker processes with per-run limits.
+
+    Each worker is forked from a forkserver that has already imported the interpreter
+    and ANTLR, so starting or replacing one is cheap. A run may use `cpu_seconds` of
+    CPU and `wall_seconds` of real time, and each worker's address space is capped at
+    `memory_bytes` (RLIMIT_AS). A worker that breaks a limit, or dies, is killed and
+    replaced; the run's output up to that point has already been streamed.
+
+    Time spent blocked in `emit` (waiting on a slow client) does not count towards
+    `wall_seconds`. The worker may keep computing meanwhile, until its pipe fills,
+    but that is CPU time and `cpu_seconds` still bounds it.
+
+    run() blocks, so callers run it on a thread (one per worker, see WorkerPool).
+    """
+
+    def __init__(self, workers=4, cpu_seconds=5, wall_seconds=10, memory_bytes=512 * 1024 * 1024):
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.memory_bytes = memory_bytes
+        self.workers = workers
+        self.recycled = 0
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context('forkserver')
+        self._context.set_forkserver_preload(['Interpreter'])
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        return _Worker(self._context, self.memory_bytes, self.cpu_seconds)
+
+    def run(self, code, emit, lazy_bool=False, cancel_token=None, env=None, profile=False):
+        """Runs `code` in a worker, passing each JSON event string to `emit` as it arrives.
+
+        `env` holds the initial variables (none by default); `profile` adds the
+        'profile' event (see StreamingInterpreter.run).
+
+        Cancelling `cancel_token` kills the worker (within CANCEL_POLL_SECONDS) and
+        replaces it, without emitting anything further.
+
+        Returns the seconds the run spent in each phase (see Interpreter.timings), or
+        None if the worker did not finish it.
+        """
+        worker = self._idle.get()
+        try:
+            if not worker.process.is_alive():
+                worker.stop()
+                worker = self._spawn()
+            timings = None
+            try:
+                worker.conn.send((code, lazy_bool, env or {}, profile))
+            except OSError:
+                reason = self._lost(worker)
+            else:
+                reason, timings = self._relay(worker, emit, cancel_token)
+            if reason is not None:
+                if reason is not _CANCELLED:
+                    emit(json.dumps({'type': 'fatal_error', 'content': f"FATAL SERVER ERROR: {reason}"}))
+                worker.stop()
+                worker = self._spawn()
+                with self._lock:
+                    self.recycled += 1
+            return timings
+        finally:
+            self._idle.put(worker)
+
+    def _relay(self, worker, emit, cancel_token):
+        # Forwards events until the run ends; returns why the worker must be replaced (if
+        # it must) and the run's timings (if it finished).
+        deadline = time.monotonic() + self.wall_seconds
+        while True:
+            if cancel_token is not None and cancel_token.cancelled:
+                return _CANCELLED, None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return f"Time limit of {self.wall_seconds} s exceeded.", None
+            try:
+                if not worker.conn.poll(min(remaining, CANCEL_POLL_SECONDS)):
+                    continue
+                msg = worker.conn.recv()
+            except (EOFError, OSError):
+                return self._lost(worker), None
+            if isinstance(msg, tuple):
+                return msg[1], msg[2]
+            started = time.monotonic()
+            emit(msg)
+            deadline += time.monotonic() - started
+
+    def _lost(self, worker):
+        # The worker's end of the pipe closed (or reset) mid-run: it died or is dying.
+        worker.process.join(EXIT_WAIT_SECONDS)
+        exitcode = worker.process.exitcode
+        if exitcode == -signal.SIGXCPU:
+            return f"CPU time limit of {self.cpu_seconds} s exceeded."
+        if exitcode is None:
+            return "Lost the connection to the worker process."
+        return f"Worker process exited unexpectedly (code {exitcode})."
+
+    def stats(self):
+        with self._lock:
+            recycled = self.recycled
+        return {
+            'workers': self.workers,
+            'cpu_seconds': self.cpu_seconds,
+            'wall_seconds': self.wall_seconds,
+            'memory_bytes': self.memory_bytes,
+            'recycled': recycled,
+        }
+
+    def close(self):
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.stop()
@@ -0,0 +1,93 @@
+import json
+import zlib
+from BatchInput import parse_env
+
+
+# Largest request body accepted after decompression (see decode_body).
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+# zlib wbits for each supported Content-Encoding; 47 = 32 + 15 (zlib or gzip header).
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'x-gzip': 16 + zlib.MAX_WBITS, 'deflate': 32 + zlib.MAX_WBITS}
+
+
+class PayloadTooLarge(ValueError):
+    """The (decompressed) body is over the size limit; servers answer 413."""
+
+
+def decode_body(body: bytes, content_encoding: str, max_bytes=MAX_BODY_BYTES):
+    """Undoes a gzip/deflate Content-Encoding, refusing to inflate past `max_bytes`.
+
+    Raises ValueError for unknown encodings or corrupt data, PayloadTooLarge if the
+    result would be over the limit.
+    """
+    encoding = content_encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        data = body
+    elif encoding in _WBITS:
+        inflater = zlib.decompressobj(_WBITS[encoding])
+        try:
+            data = inflater.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise ValueError(f"Invalid {encoding} body: {e}") from None
+        if not inflater.eof and len(data) <= max_bytes:
+            raise ValueError(f"Truncated {encoding} body.")
+    else:
+        raise ValueError(f"Unsupported Content-Encoding '{encoding}'; use gzip, deflate or identity.")
+    if len(data) > max_bytes:
+        raise PayloadTooLarge(f"Request body is larger than {max_bytes} bytes.")
+    return data
+
+
+def parse_edits(request):
+    """Validates the edits of a JSON request {"version": n, "edits": [...]} into
+    (version, [(offset, length, text), ...]); raises ValueError for malformed ones.
+
+    Each edit is an object {"offset": o, "length": l, "text": "..."} replacing the `l`
+    characters at `o` (in Python characters, i.e. code points) with `text`, applied in
+    order to version `n` of a session's program (see ExprDocument.ParsedDocument).
+    """
+    def count(value):
+        return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+    version, edits = request.get('version'), request.get('edits')
+    if not count(version):
+        raise ValueError("'version' must be the session's program version.")
+    if not isinstance(edits, list):
+        raise ValueError("'edits' must be a list.")
+    parsed = []
+    for edit in edits:
+        if not (isinstance(edit, dict) and count(edit.get('offset')) and count(edit.get('length'))
+                and isinstance(edit.get('text'), str)):
+            raise ValueError("Each edit must be an object with 'offset', 'length' and 'text'.")
+        parsed.append((edit['offset'], edit['length'], edit['text']))
+    return version, parsed
+
+
+def parse_program(body: bytes, content_type: str):
+    """Parses a POSTed program into (code, env, edits).
+
+    The body is either the program text itself (text/plain) or a JSON object
+    {"code": "...", "env": {...}} where the initial variables in `env` are optional.
+    For a stream tied to a session, the JSON object can instead hold the changes to
+    the session's program, {"version": n, "edits": [...]} (see parse_edits); `code`
+    is then None and `edits` is (version, edits), otherwise None.
+    """
+    media_type = content_type.split(';')[0].strip().lower() or 'text/plain'
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError("Request body must be UTF-8.") from None
+
+    if media_type == 'text/plain':
+        return text, {}, None
+    if media_type == 'application/json':
+        try:
+            request = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}") from None
+        if isinstance(request, dict) and 'edits' in request:
+            return None, parse_env(request.get('env', {})), parse_edits(request)
+        if not isinstance(request, dict) or not isinstance(request.get('code'), str):
+            raise ValueError("Expected a JSON object with a 'code' string or 'edits'.")
+        return request['code'], parse_env(request.get('env', {})), None
+    raise ValueError(f"Unsupported Content-Type '{media_type}'; use text/plain or application/json.")
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+# Events that make a run's output unfit to replay to anyone else: server trouble
+# (limits, crashes) and output dropped for a slow client.
+_UNCACHEABLE = ('{"type": "fatal_error"', '{"type": "truncated"')
+# Events addressed to one client: a session run's 'session' event names its session.
+_PRIVATE = ('{"type": "session"',)
+
+
+class ResultCache:
+    """Bounded, thread-safe LRU cache of whole runs' events, so identical submissions
+    (a class all running the same exercise) run once.
+
+    Programs read nothing but their initial variables, so a run's events depend only
+    on the program text, those variables and the interpreter options. The key hashes
+    the exact text: error messages quote lines and columns, so even a reformatted
+    program prints something else. Runs that were cancelled or lost output, or
+    stopped on a server error, are not kept; nor are results over
+    `max_entry_bytes`. Entries expire `ttl_seconds` after they were stored.
+
+    It also tracks runs in progress by key (with the caller's protocol), so an
+    identical request arriving meanwhile can read that run's stream instead of
+    starting another (see join()). A session's run (see begin()) is cached too,
+    without its 'session' event, but not joined.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl_seconds=300,
+                 max_entry_bytes=1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.evictions = 0
+        self.expired = 0
+        self._entries = OrderedDict()  # key -> (events, size, stored at)
+        self._bytes = 0
+        self._running = {}  # (key, protocol) -> run in progress
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(variant, code, env):
+        """Hashes the interpreter options, program text and initial variables into a cache key."""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (variant, code, json.dumps(env, sort_keys=True)):
+            digest.update(part.encode('utf-8', 'surrogatepass'))
+            digest.update(b'\0')
+        return digest.digest()
+
+    def get(self, key):
+        """The cached events of `key` (a list of JSON event strings), or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic() - self.ttl_seconds:
+                self._remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, events):
+        if any(event.startswith(_UNCACHEABLE) for event in events):
+            return
+        size = sum(len(event) for event in events)
+        if size > self.max_entry_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (events, size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        # Lock held.
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def join(self, key, protocol):
+        """The run in progress for `key` and `protocol` (see begin()) if a new request
+        can read it from the start, else None."""
+        with self._lock:
+            run = self._running.get((key, protocol))
+            if run is None or not run.replayable_from_start:
+                return None
+            self.joined += 1
+            return run
+
+    def begin(self, key, protocol, run, private=False):
+        """Records `run` (a ResumableRun recording its events) as the run in progress
+        for `key`; when it ends, its events are cached if it completed.
+
+        A `private` run's stream is its client's alone (a session's, which ends with
+        its 'session' event): nobody joins it, and that event is not cached.
+        """
+        if not private:
+            with self._lock:
+                self._running.setdefault((key, protocol), run)
+
+        def finished(run):
+            with self._lock:
+                if self._running.get((key, protocol)) is run:
+                    del self._running[(key, protocol)]
+            if run.events is not None and not run.cancelled:
+                events = run.events
+                if private:
+                    events = [event for event in events if not event.startswith(_PRIVATE)]
+                self.put(key, events)
+        run.on_finish = finished
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'max_entry_bytes': self.max_entry_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'running': len(self._running),
+                'hits': self.hits,
+                'misses': self.misses,
+                # Requests that read a run already in progress instead of starting one
+                'joined': self.joined,
+                'evictions': self.evictions,
+                'expired': self.expired,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                # ...and counting requests that joined a run
+                'shared_ratio': (self.hits + self.joined) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,320 @@
+import asyncio
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+from ExprAst import CancelToken
+from OutputChannel import truncation_event
+from StreamProtocol import MAX_FRAME_BYTES, array_frame
+
+# The last message of a run stopped because its client went away with every kept message unread.
+STOPPED_EVENT = json.dumps({
+    'type': 'fatal_error',
+    'content': "FATAL SERVER ERROR: Output buffer full and the client disconnected; run stopped.",
+})
+
+
+class ResumableRun:
+    """A streamed run's SSE messages, kept after they are sent so a client that
+    reconnects (with the Last-Event-ID of the last message it got) can be sent what
+    it missed instead of the program running again.
+
+    Messages are numbered from 1. At most `max_bytes` of them are kept: the oldest
+    already sent are dropped to make room, and while every kept message is still
+    unsent, the run waits for a reader, so a slow client still slows the run down
+    as in OutputChannel's 'block' policy. If its last reader has gone by then, the
+    run is cancelled instead, ending with STOPPED_EVENT, so it does not hold a worker
+    until the client comes back or the RunStore gives up on it; a client that
+    resumes gets the kept messages and that event. Everything here runs on the
+    event loop.
+
+    With `record`, the events themselves are also kept, all of them (`events`, None
+    past `max_bytes`), for the ResultCache; on_finish(run) is called once it ends.
+    """
+
+    def __init__(self, run_id, max_bytes, frames, cancel_token, record=False):
+        self.id = run_id
+        self.max_bytes = max_bytes
+        self.frames = frames  # messages are version 2 frames (see StreamProtocol.py)
+        self.cancel_token = cancel_token
+        self.finished = False
+        self.cancelled = False
+        self.readers = 0
+        self.disconnected = False  # its last reader went away
+        self.clients = 1  # requests reading the run (see RunStore.join)
+        self.events = [] if record else None
+        self.on_finish = None
+        self.bytes = 0
+        self.last_used = time.monotonic()
+        self._messages = deque()
+        self._first = 1  # number of the oldest kept message
+        self._next = 1   # number the next message gets
+        self._sent = 0   # highest number handed to a reader
+        self._waiter = None
+        self._task = None
+
+    @property
+    def last(self):
+        """Number of the latest message (0 before the first)."""
+        return self._next - 1
+
+    @property
+    def replayable_from_start(self):
+        return self._first == 1
+
+    async def _pump(self, events):
+        # Moves the worker pool's output into the kept messages until the run ends.
+        recorded = 0
+        try:
+            async for item in events:
+                if self.events is not None:
+                    batch = item if self.frames else (item,)
+                    self.events.extend(batch)
+                    recorded += sum(len(event) for event in batch)
+                    if recorded > self.max_bytes:
+                        self.events = None
+                if not await self._append(array_frame(item) if self.frames else item):
+                    break
+        finally:
+            await events.aclose()
+            self._end()
+
+    def _end(self):
+        self.finished = True
+        self.last_used = time.monotonic()
+        self._wake()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    async def _append(self, message):
+        # False if the run was cancelled, or stopped for lack of a reader, while waiting for room.
+        size = len(message)
+        while self._messages and self.bytes + size > self.max_bytes:
+            if self.cancel_token.cancelled and not self.readers:
+                return False
+            if self._first <= self._sent:
+                self.bytes -= len(self._messages.popleft())
+                self._first += 1
+            elif self.disconnected and not self.readers:
+                self.cancel()
+                # Past max_bytes, like OutputChannel's ABORT_EVENT
+                self._push(array_frame([STOPPED_EVENT]) if self.frames else STOPPED_EVENT)
+                return False
+            else:
+                await self._wait()
+        self._push(message)
+        return True
+
+    def _push(self, message):
+        self._messages.append(message)
+        self.bytes += len(message)
+        self._next += 1
+        self._wake()
+
+    def _wait(self):
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+        return self._waiter
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def cancel(self):
+        self.cancelled = True
+        self.cancel_token.cancel()
+        self._wake()
+
+    async def messages(self, after=0):
+        """Yields (number, message) for the messages after number `after`, as they come,
+        until the run ends. Messages already dropped are replaced by one (None,
+        truncation event) item."""
+        number = after + 1
+        while True:
+            if number < self._first:
+                event = truncation_event(self._first - number)
+                yield None, array_frame([event]) if self.frames else event
+                number = self._first
+            if number < self._next:
+                message = self._messages[number - self._first]
+                self._sent = max(self._sent, number)
+                self._wake()
+                yield number, message
+                number += 1
+            elif self.finished:
+                return
+            else:
+                await self._wait()
+
+
+class RunStore:
+    """Streamed runs by id, kept so interrupted streams can be resumed.
+
+    Each run keeps up to `max_run_bytes` of its latest messages (see ResumableRun).
+    A run nobody reads for `ttl_seconds` is dropped, and cancelled first if it is
+    still going: the client is not coming back. Beyond `max_bytes` of kept messages
+    in all, the least recently read finished runs go too. Message ids are
+    "<run id>.<number>"; limits are enforced as runs start and resume, and by a
+    timer per disconnected run.
+    """
+
+    def __init__(self, ttl_seconds=30, max_run_bytes=1024 * 1024, max_bytes=64 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_run_bytes = max_run_bytes
+        self.max_bytes = max_bytes
+        self.started = 0
+        self.resumed = 0
+        self.abandoned = 0
+        self.expired = 0
+        self.evicted = 0
+        self._runs = OrderedDict()  # id -> ResumableRun, least recently read first
+        self._lock = threading.Lock()
+
+    def start(self, events, frames=False, cancel_token=None, record=False):
+        """Starts keeping what `events` (an iterator from WorkerPool.submit_stream, made
+        with `frames` and `cancel_token`) yields, and returns the new ResumableRun
+        (recording its events if `record`). Must be called on the event loop."""
+        run = ResumableRun(secrets.token_urlsafe(16), self.max_run_bytes, frames, cancel_token or CancelToken(),
+                           record)
+        with self._lock:
+            self._evict()
+            self._runs[run.id] = run
+            self.started += 1
+        run._task = asyncio.ensure_future(run._pump(events))
+        # In case no response ever reads it
+        asyncio.get_running_loop().call_later(self.ttl_seconds, self._check_abandoned, run)
+        return run
+
+    def replay(self, events, frames=False):
+        """A finished run whose messages carry `events` (JSON event strings, from the
+        ResultCache), so a cached result streams and resumes like any other run."""
+        run = ResumableRun(secrets.token_urlsafe(16), self.max_run_bytes, frames, CancelToken())
+        if frames:
+            frame, size = [], 0
+            for event in events:
+                frame.append(event)
+                size += len(event)
+                if size >= MAX_FRAME_BYTES:
+                    run._messages.append(array_frame(frame))
+                    frame, size = [], 0
+            if frame:
+                run._messages.append(array_frame(frame))
+        else:
+            run._messages.extend(events)
+        run.bytes = sum(len(message) for message in run._messages)
+        run._next += len(run._messages)
+        run._end()
+        with self._lock:
+            self._evict()
+            self._runs[run.id] = run
+            self.started += 1
+        return run
+
+    def join(self, run):
+        """Counts one more request reading `run`, which then takes a cancel() from each
+        of them to stop."""
+        run.clients += 1
+        run.last_used = time.monotonic()
+
+    def resume(self, last_event_id):
+        """The run and message number a Last-Event-ID header names, or None if the run
+        is unknown or gone."""
+        run_id, _, number = last_event_id.strip().rpartition('.')
+        if not number.isdigit():
+            return None
+        with self._lock:
+            self._evict()
+            run = self._runs.get(run_id)
+            if run is None or int(number) > run.last:
+                return None
+            self._runs.move_to_end(run_id)
+            run.last_used = time.monotonic()
+            self.resumed += 1
+            return run, int(number)
+
+    def cancel(self, run_id):
+        """Cancels a run (a client's Stop button), unless other requests joined it and
+        still want it; False if it is unknown or gone. Must be called on the event loop."""
+        with self._lock:
+            run = self._runs.get(run_id)
+        if run is None:
+            return False
+        run.clients -= 1
+        if run.clients <= 0:
+            run.cancel()
+        return True
+
+    @staticmethod
+    def event_id(run, number):
+        return f"{run.id}.{number}"
+
+    async def stream(self, run, after=0):
+        """Yields the SSE messages of `run` after message `after` as sse_starlette
+        dicts with their ids; once the reader goes away, a timer gives the client
+        `ttl_seconds` to come back."""
+        run.readers += 1
+        run.disconnected = False
+        try:
+            async for number, message in run.messages(after):
+                event = {'data': f"data: {message}\n\n"}
+                if number is not None:
+                    event['id'] = self.event_id(run, number)
+                yield event
+        finally:
+            run.readers -= 1
+            run.last_used = time.monotonic()
+            if run.readers == 0:
+                run.disconnected = True
+            run._wake()
+            if run.readers == 0:
+                asyncio.get_running_loop().call_later(self.ttl_seconds, self._check_abandoned, run)
+
+    def _check_abandoned(self, run):
+        if run.readers or run.finished:
+            return
+        remaining = run.last_used + self.ttl_seconds - time.monotonic()
+        if remaining > 0:
+            asyncio.get_running_loop().call_later(remaining, self._check_abandoned, run)
+            return
+        run.cancel()
+        with self._lock:
+            self.abandoned += 1
+            self._runs.pop(run.id, None)
+
+    def _evict(self):
+        # Lock held. Runs unread for ttl_seconds, then the least recently read finished
+        # ones while over max_bytes.
+        oldest = time.monotonic() - self.ttl_seconds
+        total = sum(run.bytes for run in self._runs.values())
+        for run in list(self._runs.values()):
+            if run.readers or not run.finished:
+                continue
+            if run.last_used < oldest:
+                self.expired += 1
+            elif total > self.max_bytes:
+                self.evicted += 1
+            else:
+                continue
+            del self._runs[run.id]
+            total -= run.bytes
+
+    def stats(self):
+        with self._lock:
+            self._evict()
+            runs = list(self._runs.values())
+            return {
+                'runs': len(runs),
+                'running': sum(not run.finished for run in runs),
+                'bytes': sum(run.bytes for run in runs),
+                'max_run_bytes': self.max_run_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'started': self.started,
+                'resumed': self.resumed,
+                'abandoned': self.abandoned,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
@@ -0,0 +1,573 @@
+import asyncio
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+from ExprAst import CancelToken
+from ExprDocument import ParsedDocument
+from ExprReactive import StatementMemo
+from ProgramCache import ESTIMATED_BYTES_PER_TOKEN
+from RequestBody import parse_edits
+from Interpreter import StreamingInterpreter
+from StreamProtocol import array_frame
+
+
+# Rough memory cost of a variable in a saved environment: a dict slot plus, on
+# average, its share of a value that changed since the previous checkpoint.
+ESTIMATED_BYTES_PER_VARIABLE = 64
+# ...and of a token held by a remembered statement outcome (see ExprReactive.py).
+ESTIMATED_BYTES_PER_MEMO_TOKEN = 64
+
+REQUEST_TYPES = ('run', 'rerun', 'sync', 'edit', 'cancel')
+
+
+class SessionUnavailable(Exception):
+    """Raised by SessionStore.attach when the session cannot be used right now."""
+
+
+class EditConflict(Exception):
+    """Raised by Session.sync for edits to a version of the program the session does not
+    have (or that do not fit it); the client should send the whole program instead."""
+
+
+def _discard(event):
+    pass
+
+
+def session_event(session):
+    return json.dumps({'type': 'session', 'content': {
+        'id': session.id,
+        'statements': session.statements,
+        'rerun_from': session.rerun_from,
+        'version': session.version,
+    }})
+
+
+def session_error(message):
+    return json.dumps({'type': 'session_error', 'content': message})
+
+
+def recomputed_event(statements, evaluated):
+    """Which statements a sync evaluated, as [first, last + 1) index ranges."""
+    ranges = []
+    for index in evaluated:
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return json.dumps({'type': 'recomputed', 'content': {
+        'statements': statements,
+        'recomputed': len(evaluated),
+        'ranges': ranges,
+    }})
+
+
+def parse_request(message):
+    """Validates a client message (JSON text); raises ValueError for a malformed one."""
+    try:
+        request = json.loads(message)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}") from None
+    if not isinstance(request, dict) or request.get('type') not in REQUEST_TYPES:
+        raise ValueError(f"Expected an object with 'type' one of {REQUEST_TYPES}.")
+    if request['type'] == 'edit':
+        request['edits'] = parse_edits(request)
+    elif request['type'] != 'cancel' and not isinstance(request.get('code'), str):
+        raise ValueError("'code' must be a string.")
+    if request['type'] == 'rerun':
+        start = request.get('from')
+        if isinstance(start, bool) or not isinstance(start, int):
+            raise ValueError("'from' must be a statement number.")
+    return request
+
+
+class _Cell:
+    """One submission: its source, how many of its statements belong to the session,
+    and the environment from before it ran."""
+    __slots__ = ('code', 'statements', 'env_before', 'bytes')
+
+    def __init__(self, code, statements, env_before):
+        self.code = code
+        self.statements = statements
+        self.env_before = env_before
+        self.bytes = len(code) + ESTIMATED_BYTES_PER_VARIABLE * len(env_before)
+
+
+class Session:
+    """An interpreter environment kept between submissions, and the statements that built it.
+
+    Each submission ("cell") runs against the environment the earlier ones left, so a
+    client only sends what is new. Statements are numbered from 0 across the session.
+    The environment from before each cell is saved, so rerun(n, code) can go back to
+    before statement n: it restores that cell's checkpoint, replays the cell's earlier
+    statements without output, then runs `code` in place of everything from n on.
+    As in a notebook, a cell runs even if an earlier one stopped on an error.
+
+    sync(code) instead runs `code` as the session's whole program, evaluating only
+    the statements an edit affected since the previous version (see
+    Interpreter.interpret_reactive); the session then holds that program as one cell.
+    The program is kept parsed (an ExprDocument.ParsedDocument), so sync can take
+    just the edits since the last version, and only the statements they touch are
+    parsed again.
+
+    `rerun_from` is the earliest statement a rerun can start at; it moves forward when
+    trim() drops old checkpoints to save memory.
+    """
+
+    def __init__(self, session_id, lazy_bool=False, program_cache=None):
+        self.id = session_id
+        self.lazy_bool = lazy_bool
+        self.program_cache = program_cache
+        self.env = {}
+        self.statements = 0
+        self.rerun_from = 0
+        self.bytes = 0
+        self.attached = False
+        self.last_used = time.monotonic()
+        self._cells = []
+        self._memo = StatementMemo()
+        self._document = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """Version of the program the last sync left (0 if none), which edits apply to."""
+        document = self._document
+        return document.version if document is not None else 0
+
+    def check_version(self, version):
+        """Raises EditConflict unless edits can be applied to program version `version`."""
+        if self._document is None or version != self._document.version:
+            raise EditConflict(
+                f"The session has program version {self.version}, not {version}; send the whole program.")
+
+    def _interpreter(self, emit, cancel_token):
+        interpreter = StreamingInterpreter(
+            program_cache=self.program_cache, lazy_bool=self.lazy_bool, cancel_token=cancel_token)
+        interpreter.env = self.env
+        interpreter.set_stream_callback(emit)
+        return interpreter
+
+    def check_rerun(self, start):
+        """Raises ValueError unless rerun(start, ...) is possible."""
+        if not self.rerun_from <= start <= self.statements:
+            raise ValueError(
+                f"Cannot rerun from statement {start}: the session can go back to "
+                f"statements {self.rerun_from} to {self.statements}.")
+
+    def run(self, code, emit, cancel_token=None):
+        """Runs `code` after the statements so far, streaming its events to `emit`.
+
+        A program with a syntax error is reported and not added to the session.
+        """
+        with self._lock:
+            self._run(code, emit, cancel_token)
+
+    def _run(self, code, emit, cancel_token):
+        interpreter = self._interpreter(emit, cancel_token)
+        program = interpreter.compile(code)
+        if program is None:
+            return
+        self._add(_Cell(code, len(program.stats), dict(self.env)))
+        try:
+            interpreter.run(program)
+        finally:
+            self._update_bytes()
+
+    def rerun(self, start, code, emit, cancel_token=None):
+        """Goes back to before statement `start` (see check_rerun) and runs `code` from there."""
+        # One critical section: another request must not run between the rewind and the run.
+        with self._lock:
+            self.check_rerun(start)
+            self._rewind(start, cancel_token)
+            if cancel_token is None or not cancel_token.cancelled:
+                self._run(code, emit, cancel_token)
+
+    def sync(self, code, emit, cancel_token=None, env=None, edits=None):
+        """Runs `code` from the variables `env` (none by default) in place of all the
+        session's statements, then emits a 'recomputed' event.
+
+        With `edits`, (version, [(offset, length, text), ...]) as RequestBody.parse_edits
+        returns them, `code` is ignored and the program is the session's program
+        version `version` with the edits applied in order; raises EditConflict (after
+        which only whole programs are accepted) if that is not the current version or
+        an edit is out of range. Every sync, even one with no changes, makes a new version.
+        A program with a syntax error is reported and leaves the session as it was,
+        except that edits go on from it.
+
+        Returns the seconds spent in each phase, as Interpreter.timings, with bringing
+        the parsed program up to date as 'parse'.
+        """
+        with self._lock:
+            start = time.perf_counter()
+            code = self._update_document(code, edits)
+            parse_seconds = time.perf_counter() - start
+            env_before = dict(env or {})
+            interpreter = self._interpreter(emit, cancel_token)
+            interpreter.env = dict(env_before)
+            try:
+                ran = interpreter.interpret_reactive(code, self._memo, self._document)
+                if ran is not None:
+                    self._commit(code, interpreter.env, env_before, ran[0])
+            except Exception:
+                # Stopped by an arithmetic error (1/0, overflow) rather than a runtime
+                # error: still the session's program, with what it assigned so far.
+                self._commit(code, interpreter.env, env_before, self._statement_count(interpreter, code))
+                raise
+            finally:
+                self._update_bytes()
+        timings = interpreter.timings
+        timings['parse'] = timings.get('parse', 0.0) + parse_seconds
+        if ran is not None:
+            emit(recomputed_event(*ran))
+        return timings
+
+    def adopt(self, code, env, events):
+        """Takes `events`, what a new session's sync(code, env=env) emitted (a cached
+        result: see ResultCache), as this session's first sync, without running anything.
+
+        Statement outcomes are not remembered, so the next sync evaluates everything.
+        Returns False, leaving the session alone, if it has run anything or is busy.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if self._document is not None or self._cells:
+                return False
+            final = {}
+            for event in events:
+                if event.startswith(('{"type": "recomputed"', '{"type": "env_snapshot"')):
+                    event = json.loads(event)
+                    final[event['type']] = event['content']
+            self._update_document(code, None)
+            # No 'recomputed' event: a syntax error, which leaves the session as it was.
+            if 'recomputed' in final:
+                self._commit(code, final['env_snapshot'], dict(env or {}), final['recomputed']['statements'])
+            self._update_bytes()
+            return True
+        finally:
+            self._lock.release()
+
+    def _commit(self, code, env, env_before, statements):
+        # A sync ran `code` from `env_before` to `env`: it is now the session's only cell.
+        self.env = env
+        self._cells.clear()
+        self.statements = self.rerun_from = 0
+        self._add(_Cell(code, statements, env_before))
+
+    def _statement_count(self, interpreter, code):
+        statements = self._document.statements()
+        if statements is not None:
+            return len(statements)
+        program = interpreter.compile(code)  # a program cache hit: it just ran
+        return len(program.stats) if program is not None else 0
+
+    def _update_document(self, code, edits):
+        # Brings the parsed program up to date; returns its text.
+        document = self._document
+        if edits is None:
+            if document is None:
+                self._document = ParsedDocument(code)
+            else:
+                document.replace_text(code)
+            return code
+        version, changes = edits
+        self.check_version(version)
+        try:
+            for offset, length, text in changes:
+                document.replace(offset, length, text)
+        except ValueError as e:
+            self._document = None
+            raise EditConflict(f"{e} Send the whole program.") from None
+        if not changes:
+            document.version += 1
+        return document.text
+
+    def _add(self, cell):
+        self._cells.append(cell)
+        self.statements += cell.statements
+
+    def _rewind(self, start, cancel_token):
+        # Drop the cells from the one holding statement `start`, then replay that cell's
+        # statements before `start` from its checkpoint.
+        first = self.statements
+        while self._cells and first > start:
+            cell = self._cells.pop()
+            first -= cell.statements
+            self.statements = first
+            self.env = dict(cell.env_before)
+        if first < start:
+            # Usually a program cache hit, as the cell was compiled when it first ran.
+            interpreter = self._interpreter(_discard, cancel_token)
+            program = interpreter.compile(cell.code)
+            if program is not None:
+                interpreter.run(program.head(start - first))
+            if cancel_token is not None and cancel_token.cancelled:
+                # Half replayed: stay at the checkpoint, which is consistent.
+                self.env = dict(cell.env_before)
+            else:
+                self._add(_Cell(cell.code, start - first, cell.env_before))
+        self._update_bytes()
+
+    def _update_bytes(self):
+        document = self._document
+        self.bytes = (sum(cell.bytes for cell in self._cells) + ESTIMATED_BYTES_PER_VARIABLE * len(self.env)
+                      + ESTIMATED_BYTES_PER_MEMO_TOKEN * self._memo.tokens
+                      + (ESTIMATED_BYTES_PER_TOKEN * document.tokens if document is not None else 0))
+
+    def trim(self, max_bytes):
+        """Drops the oldest checkpoints until the session takes at most `max_bytes`, then
+        if need be the remembered statement outcomes and the parsed program (sync() then
+        parses and evaluates everything again); skipped if the session is running.
+        Returns how many checkpoints it dropped."""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            dropped = 0
+            while dropped < len(self._cells) and self.bytes > max_bytes:
+                cell = self._cells[dropped]
+                self.rerun_from += cell.statements
+                self.bytes -= cell.bytes
+                dropped += 1
+            del self._cells[:dropped]
+            if self.bytes > max_bytes and (len(self._memo) or self._document is not None):
+                self._memo.clear()
+                self._document = None
+                self._update_bytes()
+            return dropped
+        finally:
+            self._lock.release()
+
+
+class SessionStore:
+    """Sessions by id, bounded by idle time, count and memory.
+
+    Detached sessions (no client connected) idle for more than `ttl_seconds` are
+    dropped, and beyond `max_sessions` sessions or `max_bytes` of saved environments
+    and code, the least recently used detached ones go too. If attached sessions
+    alone take more than `max_bytes`, the one that just ran loses its oldest
+    checkpoints (see Session.trim). Limits are enforced as sessions are attached and
+    after each run; there is no background thread.
+    """
+
+    def __init__(self, ttl_seconds=600, max_sessions=256, max_bytes=64 * 1024 * 1024, program_cache=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.program_cache = program_cache
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.trimmed = 0
+        self._sessions = OrderedDict()  # id -> Session, least recently used first
+        self._lock = threading.Lock()
+
+    def attach(self, session_id=None, lazy_bool=False):
+        """Returns the session `session_id` for a new connection, or a new session if
+        it is None or unknown (expired sessions are gone). `lazy_bool` only applies to
+        new sessions. Raises SessionUnavailable if another connection has the session,
+        or every session slot is taken by connected clients.
+        """
+        with self._lock:
+            session = self._get(session_id, lazy_bool)
+            if session.attached:
+                raise SessionUnavailable(f"Session {session_id} is in use by another connection.")
+            session.attached = True
+            self._touch(session)
+            return session
+
+    def get(self, session_id=None, lazy_bool=False):
+        """Like attach(), for a single request: the session is not marked attached, and
+        runs from a connection and from requests just take turns."""
+        with self._lock:
+            session = self._get(session_id, lazy_bool)
+            self._touch(session)
+            return session
+
+    def _get(self, session_id, lazy_bool):
+        self._evict(None)
+        session = self._sessions.get(session_id) if session_id else None
+        if session is None:
+            self._evict(None, room=1)
+            if len(self._sessions) >= self.max_sessions:
+                raise SessionUnavailable("Too many sessions in use, try again later.")
+            session = Session(secrets.token_urlsafe(16), lazy_bool, self.program_cache)
+            self._sessions[session.id] = session
+            self.created += 1
+        return session
+
+    def detach(self, session):
+        with self._lock:
+            session.attached = False
+            if session.id in self._sessions:
+                self._touch(session)
+
+    def account(self, session):
+        """Called after `session` ran: refreshes its idle time and enforces the limits."""
+        with self._lock:
+            if session.id in self._sessions:
+                self._touch(session)
+            self._evict(session)
+
+    def _touch(self, session):
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session.id)
+
+    def _evict(self, session, room=0):
+        # Lock held. Expired sessions first, then least recently used ones while over
+        # the limits (leaving `room` for new sessions); then, if still over max_bytes,
+        # trim `session`.
+        oldest = time.monotonic() - self.ttl_seconds
+        total = sum(s.bytes for s in self._sessions.values())
+        for candidate in list(self._sessions.values()):
+            if candidate.attached:
+                continue
+            if candidate.last_used < oldest:
+                self.expired += 1
+            elif len(self._sessions) + room > self.max_sessions or total > self.max_bytes:
+                self.evicted += 1
+            else:
+                continue
+            del self._sessions[candidate.id]
+            total -= candidate.bytes
+        if session is not None and total > self.max_bytes:
+            self.trimmed += session.trim(max(0, session.bytes - (total - self.max_bytes)))
+
+    def stats(self):
+        with self._lock:
+            self._evict(None)
+            return {
+                'sessions': len(self._sessions),
+                'attached': sum(s.attached for s in self._sessions.values()),
+                'bytes': sum(s.bytes for s in self._sessions.values()),
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'created': self.created,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'trimmed': self.trimmed,
+            }
+
+
+def _session_work(session, request):
+    # The WorkerPool job for a run, rerun, sync or edit request.
+    def work(emit, cancel_token):
+        try:
+            if request['type'] == 'run':
+                session.run(request['code'], emit, cancel_token)
+            elif request['type'] == 'sync':
+                session.sync(request['code'], emit, cancel_token)
+            elif request['type'] == 'edit':
+                session.sync(None, emit, cancel_token, edits=request['edits'])
+            else:
+                session.rerun(request['from'], request['code'], emit, cancel_token)
+        except EditConflict as e:
+            emit(session_error(str(e)))
+        except Exception as e:
+            emit(json.dumps({'type': 'fatal_error', 'content': f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"}))
+    return work
+
+
+def sync_work(store, session, code, env, edits=None):
+    """The WorkerPool job for a stream request tied to a session (?session=...):
+    syncs `code` or `edits` (see Session.sync), then emits the final environment and
+    the 'session' event with the id to pass next time. The job returns the sync's
+    phase timings (None if it failed)."""
+    def work(emit, cancel_token):
+        timings = None
+        try:
+            timings = session.sync(code, emit, cancel_token, env, edits)
+        except EditConflict as e:
+            emit(session_error(str(e)))
+        except Exception as e:
+            emit(json.dumps({'type': 'fatal_error', 'content': f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"}))
+        store.account(session)
+        for event in _final_events(session):
+            emit(event)
+        return timings
+    return work
+
+
+def _final_events(session):
+    # Sent once a run is over (even one cancelled before it started): the environment
+    # and the session's new statement count.
+    try:
+        snapshot = json.dumps({'type': 'env_snapshot', 'content': session.env})
+    except Exception:
+        snapshot = json.dumps({'type': 'fatal_error', 'content': "Failed to serialize final environment."})
+    return [snapshot, session_event(session)]
+
+
+def _is_cancel(message):
+    try:
+        return parse_request(message)['type'] == 'cancel'
+    except ValueError:
+        return False
+
+
+async def serve(websocket, store, session, pool):
+    """Runs a session's requests from a WebSocket until it disconnects.
+
+    Messages are handled one at a time, each run on `pool` (a WorkerPool); a
+    'cancel' message stops the current run, others received meanwhile wait for it.
+    Replies are version 2 frames (JSON arrays of events, see StreamProtocol.py),
+    starting with a 'session' event; every run ends with 'env_snapshot' and 'session',
+    and a sync (or edit) also reports what it recomputed.
+    The disconnect exception of `websocket` propagates, after cancelling any run.
+    """
+    await websocket.send_text(array_frame([session_event(session)]))
+    incoming = asyncio.ensure_future(websocket.receive_text())
+    frame = None
+    backlog = deque()
+    try:
+        while True:
+            if backlog:
+                message = backlog.popleft()
+            else:
+                message = await incoming
+                incoming = asyncio.ensure_future(websocket.receive_text())
+            try:
+                request = parse_request(message)
+                if request['type'] == 'rerun':
+                    session.check_rerun(request['from'])
+                elif request['type'] == 'edit':
+                    session.check_version(request['edits'][0])
+            except (ValueError, EditConflict) as e:
+                await websocket.send_text(array_frame([session_error(str(e))]))
+                continue
+            if request['type'] == 'cancel':
+                continue  # nothing is running
+
+            cancel_token = CancelToken()
+            events = pool.submit_stream(_session_work(session, request), frames=True, cancel_token=cancel_token)
+            if events is None:
+                await websocket.send_text(array_frame([session_error(
+                    f"Server busy: too many programs running, try again in {pool.retry_after()} s.")]))
+                continue
+            frame = asyncio.ensure_future(events.__anext__())
+            while frame is not None:
+                await asyncio.wait((frame, incoming), return_when=asyncio.FIRST_COMPLETED)
+                if frame.done():
+                    try:
+                        await websocket.send_text(array_frame(frame.result()))
+                        frame = asyncio.ensure_future(events.__anext__())
+                    except StopAsyncIteration:
+                        frame = None
+                if incoming.done():
+                    message = incoming.result()
+                    incoming = asyncio.ensure_future(websocket.receive_text())
+                    if _is_cancel(message):
+                        cancel_token.cancel()
+                    else:
+                        backlog.append(message)
+            store.account(session)
+            await websocket.send_text(array_frame(_final_events(session)))
+    finally:
+        # Cancelling the pending read closes the event iterator, which cancels the
+        # run (see WorkerPool.submit_stream).
+        incoming.cancel()
+        if frame is not None:
+            frame.cancel()
@@ -0,0 +1,13 @@
+# SSE protocol versions for the stream endpoints (the `protocol` query parameter):
+# 1 sends one JSON event per frame; 2 sends a JSON array of events per frame.
+PROTOCOL_VERSIONS = (1, 2)
+
+# A version 2 frame is sent once its events reach this many bytes...
+MAX_FRAME_BYTES = 64 * 1024
+# ...or this many seconds after its first event was ready (see OutputChannel.get_frame).
+MAX_FRAME_DELAY = 0.02
+
+
+def array_frame(events):
+    """Joins JSON event strings into the JSON array a version 2 frame carries."""
+    return '[' + ','.join(events) + ']'
@@ -0,0 +1,160 @@
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ExprAst import CancelToken
+from OutputChannel import OVERFLOW_POLICIES, OutputChannel
+from StreamProtocol import MAX_FRAME_BYTES, MAX_FRAME_DELAY
+
+
+# Weight of the latest run in the moving average used for Retry-After estimates.
+RUN_TIME_SMOOTHING = 0.2
+
+
+class WorkerPool:
+    """Fixed-size pool of interpreter threads with a bounded wait queue.
+
+    Requests beyond `max_workers` running plus `max_queue` waiting are rejected
+    (try_submit returns None) instead of piling up threads that fight over the GIL;
+    servers answer those with 503 and the retry_after() estimate.
+
+    Each streamed job's output goes through an OutputChannel holding at most
+    `output_bytes`, so a slow client cannot make a fast job buffer without limit;
+    `overflow` is the channel policy ('block', 'drop_oldest' or 'abort').
+    """
+
+    def __init__(self, max_workers=4, max_queue=32, output_bytes=1024 * 1024, overflow='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.output_bytes = output_bytes
+        self.overflow = overflow
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.output_truncated = 0
+        self.output_aborted = 0
+        self._output_peak_total = 0
+        self._output_peak_max = 0
+        self._streams = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._started = 0
+        self._run_average = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="expr-worker")
+
+    def try_submit(self, fn, *args):
+        """Schedules fn(*args) and returns its Future, or None if the wait queue is full."""
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return None
+            self.queued += 1
+        return self._executor.submit(self._run, time.monotonic(), fn, args)
+
+    def _run(self, enqueued, fn, args):
+        started = time.monotonic()
+        wait = started - enqueued
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self._started += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self._run_average += RUN_TIME_SMOOTHING * (elapsed - self._run_average)
+
+    def submit_stream(self, work, frames=False, overflow=None, cancel_token=None):
+        """Runs `work(emit, cancel_token)` in the pool and returns an async iterator over what it emits.
+
+        Returns None if the wait queue is full. Must be called on the event loop; `emit`
+        is called from the worker thread and may block while the output buffer is full
+        (with the 'block' policy; `overflow` overrides the pool's). The iterator ends
+        when `work` returns. With `frames`, it yields lists of items instead, batched
+        by StreamProtocol's frame size and delay.
+
+        If the iterator is closed first (the client went away), `cancel_token` is
+        cancelled: `work` should then return promptly, and if it was still queued it
+        never starts. The 'abort' policy cancels it too. Callers that want to cancel
+        `work` and still read what it emits up to then pass their own `cancel_token`.
+        """
+        loop = asyncio.get_running_loop()
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        channel = OutputChannel(loop, self.output_bytes, overflow or self.overflow, cancel_token.cancel)
+
+        def run():
+            try:
+                if not cancel_token.cancelled:
+                    work(channel.put, cancel_token)
+                if cancel_token.cancelled and not channel.aborted:
+                    with self._lock:
+                        self.cancelled += 1
+            finally:
+                channel.finish()
+
+        if self.try_submit(run) is None:
+            return None
+
+        async def items():
+            try:
+                while True:
+                    if frames:
+                        item = await channel.get_frame(MAX_FRAME_BYTES, MAX_FRAME_DELAY)
+                    else:
+                        item = await channel.get()
+                    if item is None:
+                        return
+                    yield item
+            finally:
+                cancel_token.cancel()
+                channel.close()
+                self._record_output(channel)
+        return items()
+
+    def _record_output(self, channel):
+        with self._lock:
+            self._streams += 1
+            self._output_peak_total += channel.peak_bytes
+            self._output_peak_max = max(self._output_peak_max, channel.peak_bytes)
+            self.output_truncated += channel.dropped > 0
+            self.output_aborted += channel.aborted
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: the time for the current queue to drain, at least 1."""
+        with self._lock:
+            backlog = self.queued + self.active
+            return max(1, math.ceil(self._run_average * backlog / self.max_workers))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'active': self.active,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+                'wait_avg_ms': self._wait_total / self._started * 1e3 if self._started else 0.0,
+                'wait_max_ms': self._wait_max * 1e3,
+                'run_avg_ms': self._run_average * 1e3,
+                'output_bytes': self.output_bytes,
+                'overflow': self.overflow,
+                # Most output buffered at once for a request: average and worst case
+                'output_peak_avg_bytes': self._output_peak_total / self._streams if self._streams else 0.0,
+                'output_peak_max_bytes': self._output_peak_max,
+                'output_truncated': self.output_truncated,
+                'output_aborted': self.output_aborted,
+            }
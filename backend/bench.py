@@ -0,0 +1,176 @@
+"""Micro-benchmarks for the Expr interpreter.
+
+Usage: python bench.py parse [--lines N] [--repeat N]
+       python bench.py eval [--lines N] [--depth N] [--repeat N]
+       python bench.py vector [--points N] [--repeat N]
+"""
+import argparse
+import time
+
+from Interpreter import Interpreter
+from ExprAst import AstEvaluator, StackEvaluator, lower
+from ExprFastParser import IterativeParser, fast_parse
+
+
+SAMPLE_LINES = [
+    "x = 1.23e4",
+    "y = 3x10^2",
+    "z = (x + y) * 2 / 7 - y % 3",
+    "assert x > 0 and y < 1000 or not z == 0",
+    "print x + y ^ 2 ^ 0.5",
+]
+
+
+def sample_program(lines):
+    """A program of `lines` statements cycling through typical editor input."""
+    return "\n".join(SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(lines)) + "\n"
+
+
+def discard(value):
+    """Print callback that drops the output."""
+
+
+def timed(fn, repeat):
+    """Returns the best per-call time over `repeat` calls."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(title, rows):
+    print(title)
+    baseline = rows[0][1]
+    for name, seconds, unit, count in rows:
+        print(f"  {name:<12} {seconds * 1e3:9.3f} ms   {count / seconds:12,.0f} {unit}/s   x{baseline / seconds:.1f}")
+
+
+def bench_parse(args):
+    text = sample_program(args.lines)
+    interpreter = Interpreter()
+    tree, stream = interpreter._parse_tree(text)
+    assert fast_parse(text) is not None
+    statements = len(tree.stat())
+
+    antlr = timed(lambda: interpreter._parse_tree(text), args.repeat)
+    fast = timed(lambda: fast_parse(text), args.repeat)
+    report(f"parse: {statements} statements, {len(stream.tokens)} tokens", [
+        ("antlr", antlr, "stmts", statements),
+        ("fast", fast, "stmts", statements),
+    ])
+
+
+def bench_eval(args):
+    text = sample_program(args.lines)
+    interpreter = Interpreter(engine="visitor")
+    interpreter._handle_print_output = discard
+    tree, stream = interpreter._parse_tree(text)
+    program = lower(tree, stream.tokens, text)
+    statements = len(program.stats)
+
+    def run_visitor():
+        interpreter.env = {}
+        interpreter.visit(tree)
+
+    visitor = timed(run_visitor, args.repeat)
+    recursive = timed(lambda: AstEvaluator({}, discard).run(program), args.repeat)
+    stack = timed(lambda: StackEvaluator({}, discard).run(program), args.repeat)
+    report(f"eval: {statements} shallow statements", [
+        ("visitor", visitor, "stmts", statements),
+        ("ast", recursive, "stmts", statements),
+        ("stack", stack, "stmts", statements),
+    ])
+
+    # Only the explicit-stack parser and evaluator get through these.
+    deep = {
+        "nested": "(1 + " * args.depth + "1" + ")" * args.depth,
+        "pow": "^".join(["1"] * args.depth),
+        "sum": " + ".join(["1"] * args.depth),
+    }
+    rows = []
+    for name, expr in deep.items():
+        deep_text = f"x = {expr}\n"
+        parse = timed(lambda: IterativeParser(deep_text).parse(), args.repeat)
+        deep_program = IterativeParser(deep_text).parse()
+        run = timed(lambda: StackEvaluator({}, discard).run(deep_program), args.repeat)
+        rows.append((f"{name} parse", parse, "levels", args.depth))
+        rows.append((f"{name} eval", run, "levels", args.depth))
+    report(f"deep: nesting depth {args.depth}", rows)
+
+
+VECTOR_FORMULA = """
+r = (x ^ 2 + y ^ 2) ^ 0.5
+s = r * 2.5x10^-1 - x / (1 + y * y) % 3
+inside = r <= 1 and not s > 0.5
+assert r >= 0
+print inside
+"""
+
+
+def bench_vector(args):
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-2, 2, args.points), rng.uniform(-2, 2, args.points)
+
+    def numpy_by_hand():
+        r = (x ** 2 + y ** 2) ** 0.5
+        s = r * 2.5 * 10 ** -1 - x / (1 + y * y) % 3
+        inside = np.logical_and(r <= 1, np.logical_not(s > 0.5))
+        assert np.all(r >= 0)
+        return inside
+
+    vector = Interpreter(engine="vector")
+    vector._handle_print_output = discard
+    program = vector.compile(VECTOR_FORMULA)
+
+    def vectorized():
+        vector.env = {'x': x, 'y': y}
+        vector.run(program)
+
+    # One compiled run per point, on a sample, scaled to the full size.
+    scalar = Interpreter()
+    scalar._handle_print_output = discard
+    scalar_program = scalar.compile(VECTOR_FORMULA)
+    sample = min(args.points, 2000)
+
+    def per_point():
+        for i in range(sample):
+            scalar.env = {'x': float(x[i]), 'y': float(y[i])}
+            scalar.run(scalar_program)
+
+    report(f"vector: {args.points:,} points", [
+        ("numpy", timed(numpy_by_hand, args.repeat), "points", args.points),
+        ("vector", timed(vectorized, args.repeat), "points", args.points),
+        ("per-point", timed(per_point, 1) * args.points / sample, "points", args.points),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parse_cmd = commands.add_parser("parse", help="ANTLR vs hand-written parser throughput")
+    parse_cmd.add_argument("--lines", type=int, default=5)
+    parse_cmd.add_argument("--repeat", type=int, default=50)
+    parse_cmd.set_defaults(func=bench_parse)
+
+    eval_cmd = commands.add_parser("eval", help="recursive vs explicit-stack evaluation, shallow and deep")
+    eval_cmd.add_argument("--lines", type=int, default=200)
+    eval_cmd.add_argument("--depth", type=int, default=20000)
+    eval_cmd.add_argument("--repeat", type=int, default=10)
+    eval_cmd.set_defaults(func=bench_eval)
+
+    vector_cmd = commands.add_parser("vector", help="vector engine vs hand-written NumPy vs one run per point")
+    vector_cmd.add_argument("--points", type=int, default=1_000_000)
+    vector_cmd.add_argument("--repeat", type=int, default=5)
+    vector_cmd.set_defaults(func=bench_vector)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,36 @@
+import argparse
+import sys
 from Interpreter import Interpreter
 
 def main():
-    interpreter = Interpreter()
-    with open("program.expr", mode="r", encoding="utf-8") as f:
-        program = f.read()
-    result = interpreter.interpret(program)
+    parser = argparse.ArgumentParser(description="Run an Expr program.")
+    parser.add_argument("path", nargs="?", default="program.expr")
+    parser.add_argument("--stream", action="store_true",
+                        help="read, parse and run one statement at a time (for very large files)")
+    parser.add_argument("--chunk-size", type=int, default=1 << 16,
+                        help="characters read at a time with --stream")
+    parser.add_argument("--fast-math", action="store_true",
+                        help="compute x^2, x^3 and x^4 by multiplication (may differ from pow() in the last bit, "
+                             "and overflows to inf instead of failing)")
+    parser.add_argument("--timings", action="store_true",
+                        help="print the time spent lexing, parsing, compiling and evaluating to stderr")
+    args = parser.parse_args()
+
+    interpreter = Interpreter(fast_math=args.fast_math)
+    with open(args.path, mode="r", encoding="utf-8") as f:
+        if args.stream:
+            result = interpreter.interpret_stream(f, args.chunk_size)
+        else:
+            program = f.read()
+            result = interpreter.interpret(program)
     print(result)
+    if args.timings and args.stream:
+        # interpret_stream interleaves the phases statement by statement and does not time them
+        print("No phase timings with --stream.", file=sys.stderr)
+    elif args.timings:
+        for phase, seconds in interpreter.timings.items():
+            print(f"{phase:>8}: {seconds * 1000:10.3f} ms", file=sys.stderr)
+        print(f"{'total':>8}: {sum(interpreter.timings.values()) * 1000:10.3f} ms", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,72 @@
-import asyncio
+import os
 import json
-import threading
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from sse_starlette import EventSourceResponse
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from BatchInput import parse_rows
+from ExprAst import CancelToken
+from RequestBody import PayloadTooLarge, decode_body, parse_program
 from Interpreter import StreamingInterpreter  # <-- your interpreter class
+from ProcessPool import ProcessPool
+from ProgramCache import ProgramCache
+from ResultCache import ResultCache
+from ResumableRun import RunStore
+from Session import EditConflict, SessionStore, SessionUnavailable, serve as serve_session, session_event, sync_work
+from StreamProtocol import PROTOCOL_VERSIONS
+from WorkerPool import WorkerPool
 
 app = FastAPI()
 
+# Parsed/compiled programs shared by all requests, keyed by token stream (see ProgramCache.py).
+PROGRAM_CACHE = ProgramCache(
+    max_entries=int(os.environ.get("EXPR_CACHE_ENTRIES", "256")),
+    max_bytes=int(os.environ.get("EXPR_CACHE_BYTES", str(64 * 1024 * 1024))),
+)
+
+# Interpreter threads shared by /stream and /batch; see WorkerPool.py.
+WORKER_POOL = WorkerPool(
+    max_workers=int(os.environ.get("EXPR_WORKERS", "4")),
+    max_queue=int(os.environ.get("EXPR_QUEUE", "32")),
+    # Output buffered per request, and what happens beyond it: block, drop_oldest or abort
+    output_bytes=int(os.environ.get("EXPR_OUTPUT_BYTES", str(1024 * 1024))),
+    overflow=os.environ.get("EXPR_OVERFLOW", "block"),
+)
+
+# EXPR_BACKEND=process runs /stream programs in worker processes that can be killed
+# when they exceed their CPU, wall-clock or memory limits (see ProcessPool.py).
+PROCESS_POOL = ProcessPool(
+    workers=WORKER_POOL.max_workers,
+    cpu_seconds=float(os.environ.get("EXPR_CPU_SECONDS", "5")),
+    wall_seconds=float(os.environ.get("EXPR_WALL_SECONDS", "10")),
+    memory_bytes=int(os.environ.get("EXPR_MEMORY_MB", "512")) * 1024 * 1024,
+) if os.environ.get("EXPR_BACKEND", "thread") == "process" else None
+
+# Largest POSTed program body, after decompression (see RequestBody.py)
+MAX_BODY_BYTES = int(os.environ.get("EXPR_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+
+# Environments kept between runs for /session clients (see Session.py)
+SESSIONS = SessionStore(
+    ttl_seconds=float(os.environ.get("EXPR_SESSION_TTL", "600")),
+    max_sessions=int(os.environ.get("EXPR_SESSIONS", "256")),
+    max_bytes=int(os.environ.get("EXPR_SESSION_BYTES", str(64 * 1024 * 1024))),
+    program_cache=PROGRAM_CACHE,
+)
+
+# Events of recent runs, replayed to identical requests (see ResultCache.py)
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.environ.get("EXPR_RESULT_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("EXPR_RESULT_BYTES", str(32 * 1024 * 1024))),
+    ttl_seconds=float(os.environ.get("EXPR_RESULT_TTL", "300")),
+)
+
+# Recent /stream output for clients resuming with Last-Event-ID (see ResumableRun.py)
+RUNS = RunStore(
+    ttl_seconds=float(os.environ.get("EXPR_REPLAY_TTL", "30")),
+    max_run_bytes=int(os.environ.get("EXPR_REPLAY_BYTES", str(1024 * 1024))),
+    max_bytes=int(os.environ.get("EXPR_REPLAY_TOTAL_BYTES", str(64 * 1024 * 1024))),
+)
+
 # CORS setup (adjust for production)
 origins = [
     "http://localhost:3000",
@@ -22,75 +81,220 @@ app.add_middleware(
 )
 
 @app.get("/stream")
-async def stream_expr(code: str = Query(...)):
-    
-    # --- Inner Event Generator Function ---
-    async def event_generator():
-        loop = asyncio.get_event_loop()
-        queue = asyncio.Queue()
-
-        def stream_callback(json_data: str):
-            """
-            Called by the interpreter with a JSON string representing a single event.
-            The JSON structure is {'type': '...', 'content': '...'}.
-            """
-            # Pass the raw JSON string to the queue
-            loop.call_soon_threadsafe(queue.put_nowait, json_data)
-
-        def run_interpreter():
-            interpreter = StreamingInterpreter()
-            interpreter.env = {}
-            # Set the unified callback
-            interpreter.set_stream_callback(stream_callback)
+async def stream_expr(request: Request, code: str = Query(...), protocol: int = Query(1), session: str = Query(None)):
+    if "last-event-id" in request.headers:
+        return resume_stream(request.headers["last-event-id"])
+    return stream_program(code, {}, protocol, session)
+
+@app.post("/stream")
+async def stream_expr_post(request: Request, protocol: int = Query(1), session: str = Query(None)):
+    # Same protocol as POST /api/stream in single_server.py: the program in a (compressed) body.
+    if "last-event-id" in request.headers:
+        return resume_stream(request.headers["last-event-id"])
+    try:
+        body = decode_body(await request.body(), request.headers.get("content-encoding", ""), MAX_BODY_BYTES)
+        code, env, edits = parse_program(body, request.headers.get("content-type", ""))
+    except PayloadTooLarge as e:
+        return PlainTextResponse(str(e), status_code=413)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    if edits is not None and (session is None or PROCESS_POOL is not None):
+        return PlainTextResponse("Edits apply to a session's program; pass ?session=... "
+                                 "(not available with EXPR_BACKEND=process).", status_code=400)
+    return stream_program(code, env, protocol, session, edits)
 
+def stream_program(code, env, protocol, session=None, edits=None):
+    # `session` runs the program reactively, as in single_server.py.
+    # --- Interpreter Job (runs on a WORKER_POOL thread) ---
+    def run_interpreter(stream_callback, cancel_token):
+        """
+        Called with a callback taking a JSON string representing a single event.
+        The JSON structure is {'type': '...', 'content': '...'}.
+        The cancel_token is cancelled when the client disconnects (see WorkerPool.submit_stream).
+        """
+        interpreter = StreamingInterpreter(program_cache=PROGRAM_CACHE, cancel_token=cancel_token)
+        interpreter.env = dict(env)
+        # Set the unified callback
+        interpreter.set_stream_callback(stream_callback)
+
+        try:
+            # 1. Run the interpreter
+            interpreter.interpret(code)
+            
+        except Exception as e:
+            # 2. Catch unexpected, *non-interpreter* fatal errors (e.g., memory, system)
+            error_message = f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"
+            
+            # Stream the fatal error as a structured JSON object
+            stream_callback(json.dumps({'type': 'fatal_error', 'content': error_message}))
+            
+        finally:
+            # 3. Stream the final environment snapshot (send the raw dict)
             try:
-                # 1. Run the interpreter
-                interpreter.interpret(code)
-                
-            except Exception as e:
-                # 2. Catch unexpected, *non-interpreter* fatal errors (e.g., memory, system)
-                error_message = f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"
-                
-                # Stream the fatal error as a structured JSON object
-                error_json = json.dumps({'type': 'fatal_error', 'content': error_message})
-                loop.call_soon_threadsafe(queue.put_nowait, error_json)
-                
-            finally:
-                # 3. Stream the final environment snapshot (send the raw dict)
-                try:
-                    # IMPORTANT: Send the raw dictionary object, not a formatted string
-                    env_snapshot_dict = interpreter.env
-                    final_env_json = json.dumps({
-                        'type': 'env_snapshot', 
-                        'content': env_snapshot_dict  # Send the dictionary here
-                    })
-                except Exception:
-                    final_env_json = json.dumps({
-                        'type': 'fatal_error', 
-                        'content': "Failed to serialize final environment."
-                    })
-                
-                loop.call_soon_threadsafe(queue.put_nowait, final_env_json)
-                # 4. Signal end of stream
-                loop.call_soon_threadsafe(queue.put_nowait, None)
-
-        # Run interpreter in a thread so it doesn't block the event loop
-        threading.Thread(target=run_interpreter, daemon=True).start()
-
-        # 5. Consume the queue and format as Server-Sent Events (SSE)
-        while True:
-            # The msg here is the raw JSON string (e.g., '{"type": "stdout", "content": "..."}')
-            msg = await queue.get()
+                # IMPORTANT: Send the raw dictionary object, not a formatted string
+                env_snapshot_dict = interpreter.env
+                final_env_json = json.dumps({
+                    'type': 'env_snapshot', 
+                    'content': env_snapshot_dict  # Send the dictionary here
+                })
+            except Exception:
+                final_env_json = json.dumps({
+                    'type': 'fatal_error', 
+                    'content': "Failed to serialize final environment."
+                })
             
-            if msg is None:
-                break
+            stream_callback(final_env_json)
 
-            # Yield the message formatted as an SSE packet
-            yield f"data: {msg}\n\n"
+    # protocol=1 (the default, for older clients) sends one event per SSE frame;
+    # protocol=2 sends JSON arrays of events, batched by size and time (see StreamProtocol.py).
+    if protocol not in PROTOCOL_VERSIONS:
+        return PlainTextResponse(f"Unsupported protocol {protocol}; use one of {PROTOCOL_VERSIONS}.", status_code=400)
 
-    # --- Return the EventSourceResponse ---
-    return EventSourceResponse(event_generator())
+    work = run_interpreter
+    state = None
+    if PROCESS_POOL is not None:
+        work = lambda emit, cancel_token: PROCESS_POOL.run(code, emit, cancel_token=cancel_token, env=env)
+    elif session is not None:
+        try:
+            state = SESSIONS.get(session)
+            if edits is not None:
+                state.check_version(edits[0])
+        except SessionUnavailable as e:
+            return server_busy(str(e))
+        except EditConflict as e:
+            return PlainTextResponse(str(e), status_code=409)
+        work = sync_work(SESSIONS, state, code, env, edits)
+
+    # Identical programs run once: a cached result is replayed, and a request for a
+    # program already running reads that run's stream. So does a new session's first
+    # whole program, cached separately (see single_server.py).
+    key = None
+    if state is not None:
+        if edits is None and state.version == 0 and not state.statements:
+            key = RESULT_CACHE.make_key("session", code, env)
+            cached = RESULT_CACHE.get(key)
+            if cached is not None and state.adopt(code, env, cached):
+                SESSIONS.account(state)
+                return run_response(RUNS.replay(cached + [session_event(state)], frames=protocol == 2))
+    else:
+        key = RESULT_CACHE.make_key("", code, env)
+        cached = RESULT_CACHE.get(key)
+        if cached is not None:
+            return run_response(RUNS.replay(cached, frames=protocol == 2))
+        running = RESULT_CACHE.join(key, protocol)
+        if running is not None:
+            RUNS.join(running)
+            return run_response(running)
+
+    # Queue the job before answering, so a saturated pool can still refuse with a 503.
+    cancel_token = CancelToken()
+    events = WORKER_POOL.submit_stream(work, frames=protocol == 2, cancel_token=cancel_token)
+    if events is None:
+        return server_busy()
+
+    # 4. Kept running and replayable across reconnects, as in single_server.py.
+    run = RUNS.start(events, frames=protocol == 2, cancel_token=cancel_token, record=key is not None)
+    if key is not None:
+        RESULT_CACHE.begin(key, protocol, run, private=state is not None)
+    return run_response(run)
+
+def run_response(run, after=0):
+    return EventSourceResponse(RUNS.stream(run, after), headers={"X-Run-Id": run.id})
+
+def resume_stream(last_event_id):
+    # Same as single_server.resume_stream.
+    resumed = RUNS.resume(last_event_id)
+    if resumed is None:
+        return PlainTextResponse(
+            f"No run to resume at event {last_event_id!r}: it is unknown or expired. Run the program again.",
+            status_code=410)
+    run, after = resumed
+    if run.finished and after == run.last:
+        return Response(status_code=204)
+    return run_response(run, after)
+
+@app.websocket("/session")
+async def session_socket(websocket: WebSocket, session: str = Query(None), lazy: bool = Query(False)):
+    # Same protocol as /api/session in single_server.py.
+    await websocket.accept()
+    if PROCESS_POOL is not None:
+        await websocket.close(code=1008, reason="Sessions are not available with EXPR_BACKEND=process.")
+        return
+    try:
+        state = SESSIONS.attach(session, lazy)
+    except SessionUnavailable as e:
+        await websocket.close(code=1013, reason=str(e))
+        return
+    try:
+        await serve_session(websocket, SESSIONS, state, WORKER_POOL)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        SESSIONS.detach(state)
+
+@app.post("/batch")
+async def batch_expr(request: Request, code: str = Query(...)):
+    # Same protocol as /api/batch in single_server.py: rows in, NDJSON results out.
+    try:
+        body = decode_body(await request.body(), request.headers.get("content-encoding", ""), MAX_BODY_BYTES)
+        rows = parse_rows(body, request.headers.get("content-type", ""))
+    except PayloadTooLarge as e:
+        return PlainTextResponse(str(e), status_code=413)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+
+    def run_batch(emit, cancel_token):
+        interpreter = StreamingInterpreter(program_cache=PROGRAM_CACHE, cancel_token=cancel_token)
+        compile_errors = []
+        interpreter.set_stream_callback(compile_errors.append)
+        for record in interpreter.interpret_batch(code, rows):
+            emit(json.dumps({'type': 'row', 'content': record}) + "\n")
+        for event in compile_errors:
+            emit(event + "\n")
+
+    # Rows are never dropped: a slow reader just holds the batch up.
+    lines = WORKER_POOL.submit_stream(run_batch, overflow='block')
+    if lines is None:
+        return server_busy()
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+def server_busy(message="Server busy: too many programs running, try again later."):
+    # Same 503 as single_server.py when the worker pool has no room.
+    return PlainTextResponse(
+        message,
+        status_code=503,
+        headers={"Retry-After": str(WORKER_POOL.retry_after())},
+    )
 
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
+
+@app.get("/cache")
+async def cache_stats():
+    return PROGRAM_CACHE.stats()
+
+@app.get("/pool")
+async def pool_stats():
+    stats = WORKER_POOL.stats()
+    if PROCESS_POOL is not None:
+        stats['process'] = PROCESS_POOL.stats()
+    return stats
+
+@app.get("/sessions")
+async def session_stats():
+    return SESSIONS.stats()
+
+@app.get("/results")
+async def result_cache_stats():
+    return RESULT_CACHE.stats()
+
+@app.get("/runs")
+async def run_stats():
+    return RUNS.stats()
+
+@app.delete("/runs/{run_id}")
+async def cancel_run(run_id: str):
+    if not RUNS.cancel(run_id):
+        return PlainTextResponse(f"Unknown run {run_id}.", status_code=404)
+    return Response(status_code=204)
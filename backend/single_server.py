@@ -1,22 +1,102 @@
 import os
-import asyncio
 import json
-import threading
-from fastapi import FastAPI, Query
+from time import perf_counter
+from fastapi import FastAPI, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from sse_starlette import EventSourceResponse # Keeping this import as you chose it
-from starlette.responses import FileResponse, PlainTextResponse
+from starlette.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 
+from BatchInput import parse_rows
+from ExprAst import CancelToken
+from RequestBody import PayloadTooLarge, decode_body, parse_program
 from Interpreter import StreamingInterpreter
-
-# NOTE: The 'StreamingResponse' import was not used and is removed for cleanliness.
+from Metrics import MetricsRegistry
+from ProcessPool import ProcessPool
+from ProgramCache import ProgramCache
+from ResultCache import ResultCache
+from ResumableRun import RunStore
+from Session import EditConflict, SessionStore, SessionUnavailable, serve as serve_session, session_event, sync_work
+from StreamProtocol import PROTOCOL_VERSIONS
+from WorkerPool import WorkerPool
 
 # --- Configuration (Must match the paths set up by build.sh) ---
 # This path points to the 'static_files' folder created by the build.sh script.
 # In a single container, this folder should be placed next to main.py.
 FRONTEND_DIST_DIR = os.path.join(os.path.dirname(__file__), "static_files")
 
+# Parsed/compiled programs shared by all requests, keyed by token stream (see ProgramCache.py).
+PROGRAM_CACHE = ProgramCache(
+    max_entries=int(os.environ.get("EXPR_CACHE_ENTRIES", "256")),
+    max_bytes=int(os.environ.get("EXPR_CACHE_BYTES", str(64 * 1024 * 1024))),
+)
+
+# Interpreter threads shared by /api/stream and /api/batch; requests beyond the
+# workers plus the wait queue are refused with 503 (see WorkerPool.py).
+WORKER_POOL = WorkerPool(
+    max_workers=int(os.environ.get("EXPR_WORKERS", "4")),
+    max_queue=int(os.environ.get("EXPR_QUEUE", "32")),
+    # Output buffered per request, and what happens beyond it: block, drop_oldest or abort
+    output_bytes=int(os.environ.get("EXPR_OUTPUT_BYTES", str(1024 * 1024))),
+    overflow=os.environ.get("EXPR_OVERFLOW", "block"),
+)
+
+# EXPR_BACKEND=process runs /api/stream programs in worker processes that can be killed
+# when they exceed their CPU, wall-clock or memory limits (see ProcessPool.py).
+PROCESS_POOL = ProcessPool(
+    workers=WORKER_POOL.max_workers,
+    cpu_seconds=float(os.environ.get("EXPR_CPU_SECONDS", "5")),
+    wall_seconds=float(os.environ.get("EXPR_WALL_SECONDS", "10")),
+    memory_bytes=int(os.environ.get("EXPR_MEMORY_MB", "512")) * 1024 * 1024,
+) if os.environ.get("EXPR_BACKEND", "thread") == "process" else None
+
+# Largest POSTed program body, after decompression (see RequestBody.py)
+MAX_BODY_BYTES = int(os.environ.get("EXPR_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+
+# Environments kept between runs for /api/session clients (see Session.py)
+SESSIONS = SessionStore(
+    ttl_seconds=float(os.environ.get("EXPR_SESSION_TTL", "600")),
+    max_sessions=int(os.environ.get("EXPR_SESSIONS", "256")),
+    max_bytes=int(os.environ.get("EXPR_SESSION_BYTES", str(64 * 1024 * 1024))),
+    program_cache=PROGRAM_CACHE,
+)
+
+# Events of recent runs, replayed to identical requests (see ResultCache.py)
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.environ.get("EXPR_RESULT_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("EXPR_RESULT_BYTES", str(32 * 1024 * 1024))),
+    ttl_seconds=float(os.environ.get("EXPR_RESULT_TTL", "300")),
+)
+
+# Recent /api/stream output, so a client that reconnects with Last-Event-ID gets what
+# it missed without the program running again (see ResumableRun.py)
+RUNS = RunStore(
+    ttl_seconds=float(os.environ.get("EXPR_REPLAY_TTL", "30")),
+    max_run_bytes=int(os.environ.get("EXPR_REPLAY_BYTES", str(1024 * 1024))),
+    max_bytes=int(os.environ.get("EXPR_REPLAY_TOTAL_BYTES", str(64 * 1024 * 1024))),
+)
+
+# Served at /api/metrics for Prometheus. Phase timings come from the interpreter
+# (Interpreter.timings), which each /api/stream job returns (see measured).
+METRICS = MetricsRegistry()
+QUEUE_WAIT_SECONDS = METRICS.histogram(
+    "expr_queue_wait_seconds", "Time /api/stream runs waited for a worker.")
+PHASE_SECONDS = METRICS.histogram(
+    "expr_phase_seconds", "Time runs spent lexing, parsing, compiling and evaluating.", label="phase")
+FIRST_BYTE_SECONDS = METRICS.histogram(
+    "expr_first_byte_seconds", "Time from an /api/stream request to its first SSE message.")
+STREAM_SECONDS = METRICS.histogram(
+    "expr_stream_seconds", "Time from an /api/stream request to the end of its response.")
+RUNS_TOTAL = METRICS.counter("expr_runs_total", "Programs run (not counting cached or shared results).")
+# Events counted by their first characters, as json.dumps writes them
+EVENT_COUNTERS = {
+    '{"type": "stdout"': METRICS.counter("expr_prints_total", "Values printed by runs."),
+    '{"type": "syntax_error"': METRICS.counter("expr_syntax_errors_total", "Runs stopped by a syntax error."),
+    '{"type": "runtime_error"': METRICS.counter("expr_runtime_errors_total", "Runs stopped by a runtime error."),
+    '{"type": "fatal_error"': METRICS.counter("expr_fatal_errors_total", "Runs stopped by a server error."),
+}
+STREAMED_BYTES_TOTAL = METRICS.counter("expr_streamed_bytes_total", "Bytes of SSE data sent by /api/stream.")
+
 app = FastAPI(
     title="NextJS/FastAPI Playground",
     description="Serves the static Next.js frontend and provides the /api endpoints."
@@ -38,82 +118,345 @@ def health_check():
     """Simple health check for the backend service."""
     return {"status": "ok", "service": "fastapi"}
 
+@app.get("/api/cache")
+def cache_stats():
+    """Program cache size and hit/miss counters."""
+    return PROGRAM_CACHE.stats()
+
+@app.get("/api/pool")
+def pool_stats():
+    """Worker pool load: active workers, queue depth and wait times."""
+    stats = WORKER_POOL.stats()
+    if PROCESS_POOL is not None:
+        stats['process'] = PROCESS_POOL.stats()
+    return stats
+
+@app.get("/api/sessions")
+def session_stats():
+    """Live sessions, their memory estimate and eviction counters."""
+    return SESSIONS.stats()
+
+@app.get("/api/results")
+def result_cache_stats():
+    """Result cache size, hit ratio and how many requests shared a run in progress."""
+    return RESULT_CACHE.stats()
+
+@app.get("/api/runs")
+def run_stats():
+    """Runs kept for resuming their streams, and resume/eviction counters."""
+    return RUNS.stats()
+
+@app.get("/api/metrics")
+def metrics():
+    """Run latencies and event counters in the Prometheus text format."""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+@app.delete("/api/runs/{run_id}")
+async def cancel_run(run_id: str):
+    """Stops a run (its id is the part of its SSE event ids before the '.'). Closing
+    the stream alone leaves it running for up to EXPR_REPLAY_TTL seconds, in case
+    the client reconnects, or until its unread output fills EXPR_REPLAY_BYTES."""
+    if not RUNS.cancel(run_id):
+        return PlainTextResponse(f"Unknown run {run_id}.", status_code=404)
+    return Response(status_code=204)
+
+def server_busy(message="Server busy: too many programs running, try again later."):
+    """503 for a request the worker pool (or session store) has no room for."""
+    return PlainTextResponse(
+        message,
+        status_code=503,
+        headers={"Retry-After": str(WORKER_POOL.retry_after())},
+    )
+
 # --- SSE Implementation ---
 
 # NOTE: The EventSourceResponse requires the generator to be inside the route 
 # or passed as an argument, as you have done.
 
 @app.get("/api/stream") # <<< FIX: Changed path from "/stream" to "/api/stream"
-async def stream_expr(code: str = Query(...)):
-    
-    # --- Inner Event Generator Function ---
-    async def event_generator():
-        loop = asyncio.get_event_loop()
-        queue = asyncio.Queue()
-
-        def stream_callback(json_data: str):
-            """
-            Called by the interpreter with a JSON string representing a single event.
-            The JSON structure is {'type': '...', 'content': '...'}.
-            """
-            # Pass the raw JSON string to the queue
-            loop.call_soon_threadsafe(queue.put_nowait, json_data)
-
-        def run_interpreter():
-            # NOTE: Assuming StreamingInterpreter is imported and available.
+async def stream_expr(request: Request, code: str = Query(...), lazy: bool = Query(False), protocol: int = Query(1),
+                      session: str = Query(None), profile: bool = Query(False)):
+    if "last-event-id" in request.headers:
+        return resume_stream(request.headers["last-event-id"])
+    return stream_program(code, {}, lazy, protocol, session, profile=profile)
+
+@app.post("/api/stream")
+async def stream_expr_post(request: Request, lazy: bool = Query(False), protocol: int = Query(1),
+                           session: str = Query(None), profile: bool = Query(False)):
+    """Same event stream as GET /api/stream, for a program sent in the request body.
+
+    The body is the program text (text/plain) or {"code": ..., "env": {...}}
+    (application/json), optionally gzip- or deflate-compressed (Content-Encoding).
+    With ?session=..., the JSON can hold {"version": ..., "edits": [...]} instead of
+    "code": the changes since the program version in the last 'session' event.
+    Nothing limits its size but EXPR_MAX_BODY_BYTES, and it stays out of access logs.
+    """
+    if "last-event-id" in request.headers:
+        return resume_stream(request.headers["last-event-id"])
+    try:
+        body = decode_body(await request.body(), request.headers.get("content-encoding", ""), MAX_BODY_BYTES)
+        code, env, edits = parse_program(body, request.headers.get("content-type", ""))
+    except PayloadTooLarge as e:
+        return PlainTextResponse(str(e), status_code=413)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    if edits is not None and (session is None or profile or PROCESS_POOL is not None):
+        return PlainTextResponse("Edits apply to a session's program; pass ?session=... "
+                                 "(not available with EXPR_BACKEND=process or ?profile=true).", status_code=400)
+    return stream_program(code, env, lazy, protocol, session, edits, profile)
+
+def stream_program(code, env, lazy, protocol, session=None, edits=None, profile=False):
+    """Starts running `code` with initial variables `env` and returns the SSE response.
+
+    With `session` (an id, or empty for a new session) the program runs reactively:
+    only the statements changed since that session's previous program are evaluated,
+    and a 'recomputed' event says which (see Session.sync). The stream ends with a
+    'session' event carrying the id to pass next time. Ignored with EXPR_BACKEND=process,
+    whose worker processes cannot keep session state. `edits` (see
+    RequestBody.parse_edits) replace `code` with changes to the session's program
+    version they name; a 409 answers edits to a version the session does not have.
+
+    With `profile`, the program runs without a session (their runs skip unchanged
+    statements, which leaves nothing to measure) and a 'profile' event comes just
+    before the 'env_snapshot': for each statement run, its line and column, wall
+    time, AST nodes evaluated, `^` operations and the largest magnitude computed
+    (see ExprProfile.py). Profiled runs are never cached.
+    """
+    started = perf_counter()
+
+    # --- Interpreter Job (runs on a WORKER_POOL thread) ---
+    def run_interpreter(stream_callback, cancel_token):
+        """
+        Called with a callback taking a JSON string representing a single event.
+        The JSON structure is {'type': '...', 'content': '...'}.
+        The cancel_token is cancelled when the client disconnects (see WorkerPool.submit_stream).
+        Returns the run's phase timings (see measured).
+        """
+        # NOTE: Assuming StreamingInterpreter is imported and available.
+        try:
+            # lazy=true short-circuits and/or (e.g. `x != 0 and 1/x > 2`)
+            interpreter = StreamingInterpreter(
+                program_cache=PROGRAM_CACHE, lazy_bool=lazy, cancel_token=cancel_token, profile=profile)
+            interpreter.env = dict(env)
+            # Set the unified callback
+            interpreter.set_stream_callback(stream_callback)
+
+            # 1. Run the interpreter
+            interpreter.interpret(code)
+            return interpreter.timings
+
+        except Exception as e:
+            # 2. Catch unexpected, *non-interpreter* fatal errors (e.g., memory, system)
+            error_message = f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"
+            
+            # Stream the fatal error as a structured JSON object
+            stream_callback(json.dumps({'type': 'fatal_error', 'content': error_message}))
+            
+        finally:
+            # 3. Stream the final environment snapshot (send the raw dict)
             try:
-                interpreter = StreamingInterpreter()
-                interpreter.env = {}
-                # Set the unified callback
-                interpreter.set_stream_callback(stream_callback)
-
-                # 1. Run the interpreter
-                interpreter.interpret(code)
-                
-            except Exception as e:
-                # 2. Catch unexpected, *non-interpreter* fatal errors (e.g., memory, system)
-                error_message = f"FATAL SERVER ERROR: {type(e).__name__}: {str(e)}"
-                
-                # Stream the fatal error as a structured JSON object
-                error_json = json.dumps({'type': 'fatal_error', 'content': error_message})
-                loop.call_soon_threadsafe(queue.put_nowait, error_json)
-                
-            finally:
-                # 3. Stream the final environment snapshot (send the raw dict)
-                try:
-                    # IMPORTANT: Send the raw dictionary object, not a formatted string
-                    env_snapshot_dict = interpreter.env
-                    final_env_json = json.dumps({
-                        'type': 'env_snapshot', 
-                        'content': env_snapshot_dict # Send the dictionary here
-                    })
-                except Exception:
-                    final_env_json = json.dumps({
-                        'type': 'fatal_error', 
-                        'content': "Failed to serialize final environment."
-                    })
-                
-                loop.call_soon_threadsafe(queue.put_nowait, final_env_json)
-                # 4. Signal end of stream
-                loop.call_soon_threadsafe(queue.put_nowait, None)
-
-        # Run interpreter in a thread so it doesn't block the event loop
-        threading.Thread(target=run_interpreter, daemon=True).start()
-
-        # 5. Consume the queue and format as Server-Sent Events (SSE)
-        while True:
-            # The msg here is the raw JSON string (e.g., '{"type": "stdout", "content": "..."}')
-            msg = await queue.get()
+                # IMPORTANT: Send the raw dictionary object, not a formatted string
+                env_snapshot_dict = interpreter.env
+                final_env_json = json.dumps({
+                    'type': 'env_snapshot', 
+                    'content': env_snapshot_dict # Send the dictionary here
+                })
+            except Exception:
+                final_env_json = json.dumps({
+                    'type': 'fatal_error', 
+                    'content': "Failed to serialize final environment."
+                })
             
-            if msg is None:
-                break
+            stream_callback(final_env_json)
 
-            # Yield the message formatted as an SSE packet
-            yield f"data: {msg}\n\n"
+    # protocol=1 (the default, for older clients) sends one event per SSE frame;
+    # protocol=2 sends JSON arrays of events, batched by size and time (see StreamProtocol.py).
+    if protocol not in PROTOCOL_VERSIONS:
+        return PlainTextResponse(f"Unsupported protocol {protocol}; use one of {PROTOCOL_VERSIONS}.", status_code=400)
+
+    work = run_interpreter
+    state = None
+    if PROCESS_POOL is not None:
+        work = lambda emit, cancel_token: PROCESS_POOL.run(code, emit, lazy, cancel_token, env, profile)
+    elif session is not None and not profile:
+        try:
+            state = SESSIONS.get(session, lazy)
+            if edits is not None:
+                state.check_version(edits[0])
+        except SessionUnavailable as e:
+            return server_busy(str(e))
+        except EditConflict as e:
+            return PlainTextResponse(str(e), status_code=409)
+        work = sync_work(SESSIONS, state, code, env, edits)
+
+    # Identical programs run once: a cached result is replayed, and a request for a
+    # program already running reads that run's stream. Profiles time this very run.
+    # A whole program for a session that has not run anything yet (what the client
+    # sends first) is cached separately, its result taken on by the next such session.
+    key = None
+    if state is not None:
+        if edits is None and state.version == 0 and not state.statements:
+            key = RESULT_CACHE.make_key(f"lazy={state.lazy_bool:d},session", code, env)
+            cached = RESULT_CACHE.get(key)
+            if cached is not None and state.adopt(code, env, cached):
+                SESSIONS.account(state)
+                replayed = RUNS.replay(cached + [session_event(state)], frames=protocol == 2)
+                return run_response(replayed, started=started)
+    elif not profile:
+        key = RESULT_CACHE.make_key(f"lazy={lazy:d}", code, env)
+        cached = RESULT_CACHE.get(key)
+        if cached is not None:
+            return run_response(RUNS.replay(cached, frames=protocol == 2), started=started)
+        running = RESULT_CACHE.join(key, protocol)
+        if running is not None:
+            RUNS.join(running)
+            return run_response(running, started=started)
+
+    # Queue the job before answering, so a saturated pool can still refuse with a 503.
+    cancel_token = CancelToken()
+    events = WORKER_POOL.submit_stream(measured(work, perf_counter()), frames=protocol == 2, cancel_token=cancel_token)
+    if events is None:
+        return server_busy()
+
+    # 4. The run goes on if the client disconnects, keeping its output for a while
+    # (until that fills up unread, see ResumableRun): each SSE message has an id, and a request with the last id received as its
+    # Last-Event-ID header gets the rest (see resume_stream). X-Run-Id is the id to
+    # stop the run with (DELETE /api/runs/{id}).
+    run = RUNS.start(events, frames=protocol == 2, cancel_token=cancel_token, record=key is not None)
+    if key is not None:
+        RESULT_CACHE.begin(key, protocol, run, private=state is not None)
 
     # --- Return the EventSourceResponse ---
+    return run_response(run, started=started)
+
+def measured(work, submitted):
+    """Wraps a WORKER_POOL job to record its queue wait (from `submitted`, a
+    perf_counter() value), count its events and record the phase timings it
+    returns, if any (see /api/metrics)."""
+    def run(emit, cancel_token):
+        QUEUE_WAIT_SECONDS.observe(perf_counter() - submitted)
+        RUNS_TOTAL.inc()
+        counts = dict.fromkeys(EVENT_COUNTERS, 0)
+
+        def counted(event):
+            for prefix in counts:
+                if event.startswith(prefix):
+                    counts[prefix] += 1
+                    break
+            emit(event)
+        try:
+            timings = work(counted, cancel_token)
+            for phase, seconds in (timings or {}).items():
+                PHASE_SECONDS.observe(seconds, phase)
+        finally:
+            for prefix, count in counts.items():
+                if count:
+                    EVENT_COUNTERS[prefix].inc(count)
+    return run
+
+async def measured_stream(messages, started):
+    # The SSE messages of RUNS.stream, timing the first and last and counting their bytes.
+    first = True
+    try:
+        async for message in messages:
+            if first:
+                FIRST_BYTE_SECONDS.observe(perf_counter() - started)
+                first = False
+            STREAMED_BYTES_TOTAL.inc(len(message['data']))
+            yield message
+    finally:
+        await messages.aclose()
+        STREAM_SECONDS.observe(perf_counter() - started)
+
+def run_response(run, after=0, started=None):
+    """The SSE response streaming `run` after message `after`, timed from `started`
+    (a perf_counter() value; now by default) for /api/metrics."""
+    messages = measured_stream(RUNS.stream(run, after), perf_counter() if started is None else started)
     # EventSourceResponse handles setting the media_type="text/event-stream" header
-    return EventSourceResponse(event_generator())
+    return EventSourceResponse(messages, headers={"X-Run-Id": run.id})
+
+def resume_stream(last_event_id):
+    """The rest of a run's SSE stream after the message `last_event_id`: 204 (which
+    stops EventSource reconnecting) if there is nothing more, 410 if the run is gone."""
+    resumed = RUNS.resume(last_event_id)
+    if resumed is None:
+        return PlainTextResponse(
+            f"No run to resume at event {last_event_id!r}: it is unknown or expired. Run the program again.",
+            status_code=410)
+    run, after = resumed
+    if run.finished and after == run.last:
+        return Response(status_code=204)
+    return run_response(run, after)
+
+
+# --- Persistent Sessions ---
+
+@app.websocket("/api/session")
+async def session_socket(websocket: WebSocket, session: str = Query(None), lazy: bool = Query(False)):
+    """Runs a program piece by piece against an environment the server keeps.
+
+    Messages are JSON: {"type": "run", "code": ...} runs code after the statements
+    so far, {"type": "rerun", "from": n, "code": ...} replaces statement n onwards
+    with code, {"type": "sync", "code": ...} replaces the whole program, evaluating
+    only what changed, {"type": "edit", "version": v, "edits": [...]} does the same
+    with just the changes to program version v (see RequestBody.parse_edits), and
+    {"type": "cancel"} stops the current run. Replies are arrays of
+    events like protocol 2 frames: a 'session' event on connect, with the id to
+    reconnect with (?session=...), then each run's events ending with
+    'env_snapshot' and a 'session' event with the new statement count. See Session.py.
+    """
+    await websocket.accept()
+    if PROCESS_POOL is not None:
+        # Session state lives in this process; worker processes could not keep it.
+        await websocket.close(code=1008, reason="Sessions are not available with EXPR_BACKEND=process.")
+        return
+    try:
+        state = SESSIONS.attach(session, lazy)
+    except SessionUnavailable as e:
+        await websocket.close(code=1013, reason=str(e))
+        return
+    try:
+        await serve_session(websocket, SESSIONS, state, WORKER_POOL)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        SESSIONS.detach(state)
+
+
+# --- Batch Evaluation ---
+
+@app.post("/api/batch")
+async def batch_expr(request: Request, code: str = Query(...), lazy: bool = Query(False)):
+    """Runs one program over many rows of variables, compiling it once.
+
+    The body holds the rows as a JSON array, NDJSON or CSV (chosen by Content-Type),
+    optionally gzip- or deflate-compressed like POST /api/stream's.
+    The response is NDJSON: one {'type': 'row', 'content': {...}} line per row (see
+    Interpreter.run_batch), or a single syntax_error line if the program does not parse.
+    """
+    try:
+        body = decode_body(await request.body(), request.headers.get("content-encoding", ""), MAX_BODY_BYTES)
+        rows = parse_rows(body, request.headers.get("content-type", ""))
+    except PayloadTooLarge as e:
+        return PlainTextResponse(str(e), status_code=413)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+
+    def run_batch(emit, cancel_token):
+        interpreter = StreamingInterpreter(
+            program_cache=PROGRAM_CACHE, lazy_bool=lazy, cancel_token=cancel_token)
+        compile_errors = []
+        interpreter.set_stream_callback(compile_errors.append)
+        for record in interpreter.interpret_batch(code, rows):
+            emit(json.dumps({'type': 'row', 'content': record}) + "\n")
+        for event in compile_errors:
+            emit(event + "\n")
+
+    # Rows are never dropped: a slow reader just holds the batch up.
+    lines = WORKER_POOL.submit_stream(run_batch, overflow='block')
+    if lines is None:
+        return server_busy()
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
 
 # --- Frontend Serving Configuration ---
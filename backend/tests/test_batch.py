@@ -0,0 +1,121 @@
+import json
+import unittest
+
+from starlette.testclient import TestClient
+
+from BatchInput import parse_rows
+from Interpreter import Interpreter
+from single_server import app
+
+CODE = "c = a * b\nprint c\n"
+
+
+def runtime_error(message, line, column):
+    """What a row's `error` starts with for a runtime error (the source line with a caret follows)."""
+    return f"\n❌ Runtime Error: {message}\nLocated at line {line}, column {column}:\n"
+
+
+class ParseRowsTest(unittest.TestCase):
+
+    def test_formats(self):
+        rows = [{'a': 1.0, 'b': 2.5}, {'a': 3.0, 'b': True}]
+        for body, content_type in (
+                (b'[{"a": 1, "b": 2.5}, {"a": 3, "b": true}]', 'application/json'),
+                (b'[{"a": 1, "b": 2.5}, {"a": 3, "b": true}]', ''),
+                (b'{"a": 1, "b": 2.5}\n\n{"a": 3, "b": true}\n', 'application/x-ndjson; charset=utf-8'),
+                (b'a, b\n1,2.5\n3,1\n', 'text/csv')):
+            with self.subTest(content_type=content_type):
+                expected = rows if content_type != 'text/csv' else [rows[0], {'a': 3.0, 'b': 1.0}]
+                self.assertEqual(parse_rows(body, content_type), expected)
+
+    def test_empty_csv_cells_leave_the_variable_unset(self):
+        self.assertEqual(parse_rows(b'a,b\n1,\n, 2\n', 'text/csv'), [{'a': 1.0}, {'b': 2.0}])
+
+    def test_bad_input(self):
+        for body, content_type, message in (
+                (b'a,b\n1,2,3\n', 'text/csv', "Row 0: has more or fewer cells"),
+                (b'a,b\n1,2\n3\n', 'text/csv', "Row 1: has more or fewer cells"),
+                (b'a\nx\n', 'text/csv', "Row 0: 'a' is not a number"),
+                (b'[{"a": 1}, {"a": "x"}]', 'application/json', "Row 1: 'a' must be a number"),
+                (b'{"a": 1}', 'application/json', "Expected a JSON array"),
+                (b'[{"a": 1}, [1]]', 'application/json', "Row 1: expected an object"),
+                (b'[{"a": 1', 'application/json', "Invalid JSON"),
+                (b'{"a": 1}\n{"a"\n', 'application/x-ndjson', "Invalid JSON on line 2"),
+                (b'\xff', 'application/json', "must be UTF-8"),
+                (b'a=1', 'application/x-www-form-urlencoded', "Unsupported Content-Type")):
+            with self.subTest(body=body):
+                with self.assertRaises(ValueError) as raised:
+                    parse_rows(body, content_type)
+                self.assertIn(message, str(raised.exception))
+
+
+class RunBatchTest(unittest.TestCase):
+    """Each row runs against its own copy of the environment; a row's error does not stop the rest."""
+
+    def test_rows(self):
+        interpreter = Interpreter(initial_env={'b': 10.0})
+        rows = [{'a': 1.0}, {'a': 2.0, 'b': 0.5}, {'b': 1.0}, {'a': 1e308}]
+        results = list(interpreter.interpret_batch(CODE + "assert c < 5\n", rows))
+        self.assertEqual([result['row'] for result in results], [0, 1, 2, 3])
+        self.assertEqual({key: value for key, value in results[0].items() if key != 'error'},
+                         {'row': 0, 'result': None, 'output': [10.0], 'env': {'b': 10.0, 'a': 1.0, 'c': 10.0}})
+        self.assertTrue(results[0]['error'].startswith(runtime_error("Assertion failed.", 3, 7)))
+        self.assertEqual(results[1], {'row': 1, 'result': True, 'output': [1.0], 'env': {'b': 0.5, 'a': 2.0, 'c': 1.0},
+                                      'error': None})
+        self.assertTrue(results[2]['error'].startswith(runtime_error("Undefined variable 'a'.", 1, 4)))
+        self.assertTrue(results[3]['error'].startswith(runtime_error("Assertion failed.", 3, 7)))
+        self.assertEqual(interpreter.env, {'b': 10.0})
+
+    def test_arithmetic_errors_stay_in_their_row(self):
+        results = list(Interpreter().interpret_batch("print 1 / a\n", [{'a': 0.0}, {'a': 4.0}]))
+        self.assertEqual([(result['output'], result['error']) for result in results],
+                         [([], "ZeroDivisionError: float division by zero"), ([0.25], None)])
+
+    def test_syntax_error(self):
+        errors = []
+        interpreter = Interpreter()
+        interpreter._handle_error_output = lambda info, kind: errors.append(kind)
+        self.assertEqual(list(interpreter.interpret_batch("c = (a\n", [{'a': 1.0}])), [])
+        self.assertEqual(errors, ["Syntax Error"])
+
+
+class BatchEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def post(self, body, content_type, code=CODE):
+        return self.client.post('/api/batch', params={'code': code}, content=body,
+                                headers={'Content-Type': content_type})
+
+    def lines(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['content-type'], 'application/x-ndjson')
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    def test_formats(self):
+        for body, content_type in ((b'[{"a": 2, "b": 3}, {"a": 1}]', 'application/json'),
+                                   (b'{"a": 2, "b": 3}\n{"a": 1}\n', 'application/x-ndjson'),
+                                   (b'a,b\n2,3\n1,\n', 'text/csv')):
+            with self.subTest(content_type=content_type):
+                lines = self.lines(self.post(body, content_type))
+                self.assertEqual([line['type'] for line in lines], ['row', 'row'])
+                self.assertEqual(lines[0]['content'], {'row': 0, 'result': 6.0, 'output': [6.0], 'error': None,
+                                                       'env': {'a': 2.0, 'b': 3.0, 'c': 6.0}})
+                self.assertTrue(lines[1]['content']['error'].startswith(runtime_error("Undefined variable 'b'.", 1, 8)))
+
+    def test_bad_input(self):
+        for body, content_type in ((b'a,b\n1,2,3\n', 'text/csv'), (b'[{"a": "x"}]', 'application/json'),
+                                   (b'a', 'text/plain')):
+            with self.subTest(body=body):
+                response = self.post(body, content_type)
+                self.assertEqual(response.status_code, 400)
+
+    def test_syntax_error(self):
+        lines = self.lines(self.post(b'[{"a": 1}]', 'application/json', code="c = (a\n"))
+        self.assertEqual([line['type'] for line in lines], ['syntax_error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import random
+import unittest
+
+from ExprAst import Node
+from ExprDocument import ParsedDocument, common_affixes
+from ExprFastParser import FastParseError
+from ExprReactive import split_statements
+from tests.test_engines import random_programs
+
+# Lines random edits insert at a line start
+LINES = ('a = 2\n', 'print b\n', '# note\n', '\n', 'c = (a +\n 1)\n', 'undefined\n')
+# Text random edits put anywhere: some leave the program unparsable for a while
+SNIPPETS = ('', ' ', '\n', ' + 1', ' * (c', ')', '(', 'x', '^', '3', '.5')
+
+
+def located(node, positions, line_offset):
+    """`node` as nested tuples, with each node's absolute line and column in place of
+    its token index (fragments of a document index their own token positions)."""
+    if isinstance(node, Node):
+        line, column = positions[node.tok]
+        fields = [getattr(node, slot) for cls in type(node).__mro__[:-2] for slot in cls.__slots__]
+        return (type(node).__name__, line + line_offset, column,
+                *(located(field, positions, line_offset) for field in fields))
+    if isinstance(node, (list, tuple)):
+        return tuple(located(item, positions, line_offset) for item in node)
+    return node
+
+
+def parsed(entries):
+    """Statement entries as comparable values: the located tree, and the token texts
+    and variables read; None for unparsed text."""
+    if entries is None:
+        return None
+    return [(located(stat, positions, line_offset), texts, reads)
+            for stat, texts, reads, (positions, line_offset) in entries]
+
+
+def reparsed(text):
+    try:
+        return parsed(split_statements(text))
+    except FastParseError:
+        return None
+
+
+def random_edit(rng, text):
+    """An (offset, length, text) edit of `text`."""
+    line_starts = [0] + [i + 1 for i, char in enumerate(text) if char == '\n' and i + 1 < len(text)]
+    kind = rng.random()
+    if kind < 0.35:
+        return rng.choice(line_starts + [len(text)]), 0, rng.choice(LINES)
+    if kind < 0.55 and line_starts:
+        start = rng.choice(line_starts)
+        end = text.find('\n', start)
+        return start, (len(text) if end < 0 else end + 1) - start, ''
+    if kind < 0.75:
+        digits = [i for i, char in enumerate(text) if char.isdigit()]
+        if digits:
+            return rng.choice(digits), 1, str(rng.randint(0, 9))
+    offset = rng.randint(0, len(text))
+    return offset, rng.randint(0, min(6, len(text) - offset)), rng.choice(SNIPPETS)
+
+
+class ParsedDocumentTest(unittest.TestCase):
+    """After any edits, a ParsedDocument must hold what parsing its text from scratch gives."""
+
+    def assertParsedAsNew(self, document):
+        entries = parsed(document.statements())
+        self.assertEqual(entries, reparsed(document.text))
+        if entries is not None:
+            self.assertEqual(document.tokens, ParsedDocument(document.text).tokens)
+
+    def test_random_edits(self):
+        rng = random.Random(4)
+        parses = 0
+        for text in random_programs(40, seed=5):
+            document = ParsedDocument(text)
+            last_parsed, broken = text, 0
+            for _ in range(25):
+                if broken == 3:
+                    # Undo the edits since it last parsed, as one replacement
+                    document.replace_text(last_parsed)
+                else:
+                    document.replace(*random_edit(rng, document.text))
+                with self.subTest(text=document.text):
+                    self.assertParsedAsNew(document)
+                if document.statements() is None:
+                    broken += 1
+                else:
+                    last_parsed, broken = document.text, 0
+                    parses += 1
+        self.assertGreater(parses, 600)
+
+    def test_replace_text(self):
+        programs = random_programs(30, seed=6)
+        document = ParsedDocument(programs[0])
+        for version, text in enumerate(programs[1:], start=2):
+            document.replace_text(text)
+            self.assertEqual(document.text, text)
+            self.assertEqual(document.version, version)
+            with self.subTest(text=text):
+                self.assertParsedAsNew(document)
+
+    def test_recovers_from_a_syntax_error(self):
+        document = ParsedDocument("a = 1\nb = a + 2\nprint b\n")
+        document.replace(11, 0, " * (")
+        self.assertIsNone(document.statements())
+        document.replace(15, 0, "3)")
+        self.assertEqual(document.text, "a = 1\nb = a * (3) + 2\nprint b\n")
+        self.assertParsedAsNew(document)
+
+    def test_edit_moves_later_statements(self):
+        document = ParsedDocument("a = 1\nb = 2\nc = undefined\n")
+        document.replace(0, 0, "# header\n\n")
+        entries = parsed(document.statements())
+        self.assertEqual([entry[0][1:3] for entry in entries], [(3, 0), (4, 0), (5, 0)])
+
+    def test_edit_outside_the_document(self):
+        document = ParsedDocument("a = 1\n")
+        for offset, length in ((-1, 0), (0, 7), (7, 0), (3, -1)):
+            with self.assertRaises(ValueError):
+                document.replace(offset, length, "x")
+        self.assertEqual((document.text, document.version), ("a = 1\n", 1))
+
+    def test_common_affixes(self):
+        self.assertEqual(common_affixes("abcXdef", "abcYYdef"), (3, 3))
+        self.assertEqual(common_affixes("aaa", "aaaa"), (3, 0))
+        self.assertEqual(common_affixes("", "abc"), (0, 0))
+        self.assertEqual(common_affixes("same", "same"), (4, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,349 @@
+import io
+import random
+import unittest
+
+from ExprAst import CANCEL_CHECK_INTERVAL, CancelToken, count_nodes
+from Interpreter import Interpreter
+
+# Variables random programs use; 'undefined' is never assigned.
+NAMES = ('a', 'b', 'c', 'x1', 'undefined')
+OPERATORS = ('+', '-', '*', '/', '%', '^')
+COMPARISONS = ('==', '!=', '<', '<=', '>', '>=')
+
+
+class Recorder(Interpreter):
+    """An Interpreter that records what a run prints and the errors it reports
+    (message, line and column) instead of writing them out."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.output = []
+
+    def _handle_print_output(self, value):
+        self.output.append(('print', repr(value)))
+
+    def _handle_error_output(self, error_info, error_type):
+        self.output.append((error_type, error_info['message'], error_info['line'], error_info['column']))
+
+
+def run(code, engine, use_fast_parser=True, **options):
+    """What running `code` on `engine` does: its output and errors, final variables,
+    and the type of any exception that escaped (1/0, overflow...)."""
+    interpreter = Recorder(engine=engine, **options)
+    interpreter.use_fast_parser = use_fast_parser
+    escaped = None
+    try:
+        interpreter.interpret(code)
+    except (ArithmeticError, TypeError, ValueError) as e:
+        escaped = type(e).__name__
+    env = {name: repr(value) for name, value in interpreter.env.items()}
+    return interpreter.output, env, escaped
+
+
+class ProgramGenerator:
+    """Random Expr programs: a few statements of small, arbitrarily nested expressions,
+    laid out with varying whitespace and comments, after assignments to most variables."""
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def program(self):
+        rng = self.rng
+        lines = [f"{name} = {self.number()}" for name in NAMES[:-1] if rng.random() < 0.9]
+        for _ in range(rng.randint(1, 6)):
+            kind = rng.random()
+            if kind < 0.5:
+                stat = f"{rng.choice(NAMES[:-1])} = {self.expr(3)}"
+            elif kind < 0.7:
+                stat = f"print {self.expr(3)}"
+            elif kind < 0.8:
+                stat = f"assert {self.expr(2)}"
+            else:
+                stat = self.expr(3)
+            if rng.random() < 0.2:
+                stat += "  # a comment"
+            lines.append(' ' * rng.randint(0, 2) + stat)
+        return '\n'.join(lines) + '\n'
+
+    def expr(self, depth):
+        rng = self.rng
+        if depth == 0 or rng.random() < 0.3:
+            return self.atom()
+        kind = rng.random()
+        if kind < 0.5:
+            op = rng.choice(OPERATORS)
+            right = self.atom() if op == '^' else self.expr(depth - 1)  # keeps powers small
+            return f"{self.expr(depth - 1)} {op} {right}"
+        if kind < 0.65:
+            return f"{self.expr(depth - 1)} {rng.choice(COMPARISONS)} {self.expr(depth - 1)}"
+        if kind < 0.75:
+            return f"{self.expr(depth - 1)} {rng.choice(('and', 'or'))} {self.expr(depth - 1)}"
+        if kind < 0.85:
+            return f"{rng.choice(('-', '+', 'not '))}{self.expr(depth - 1)}"
+        return f"({self.expr(depth - 1)})"
+
+    def atom(self):
+        rng = self.rng
+        if rng.random() < 0.4:
+            return rng.choice(NAMES[:-1]) if rng.random() < 0.97 else 'undefined'
+        return self.number()
+
+    def number(self):
+        rng = self.rng
+        kind = rng.random()
+        if kind < 0.7:
+            return str(rng.randint(0, 9))
+        if kind < 0.85:
+            return f"{rng.randint(0, 99)}.{rng.randint(0, 9)}"
+        return f"{rng.randint(1, 9)}x10^{rng.randint(-2, 3)}"
+
+
+def random_programs(count, seed=0):
+    generator = ProgramGenerator(seed)
+    return [generator.program() for _ in range(count)]
+
+
+class DifferentialTest(unittest.TestCase):
+    """Every engine must do what the "visitor" engine (the ANTLR tree walker, the
+    reference implementation) does: same output, same errors at the same line and
+    column, same final variables."""
+
+    ENGINES = ("ast", "stack", "compiled")
+
+    def assertSameAsVisitor(self, code, **options):
+        expected = run(code, "visitor")
+        for engine in self.ENGINES:
+            with self.subTest(engine=engine, code=code, **options):
+                # Reads of undefined variables fail where the visitor reaches them
+                self.assertEqual(run(code, engine, static_checks=False, **options), expected)
+
+    def test_random_programs(self):
+        for code in random_programs(300):
+            self.assertSameAsVisitor(code)
+
+    def test_random_programs_unoptimized(self):
+        for code in random_programs(100, seed=1):
+            self.assertSameAsVisitor(code, optimize=False)
+
+    def test_runtime_error_positions(self):
+        programs = [
+            "a = 1\nb = a + undefined\n",
+            "a = 1\n\n   print a * (2 + missing)\n",
+            "a = 2\nassert a > 1\nassert a < 1 and a > 0\n",
+            "x = 1 # comment\n  assert (x ==\n 2)\n",
+            "a = 1 < 2 < undefined\n",
+            "print 2x10^undefined\n",
+        ]
+        for code in programs:
+            self.assertSameAsVisitor(code)
+
+    def test_syntax_error_positions(self):
+        programs = [
+            "a = 1\nb = (a + \n",
+            "a = = 2\n",
+            "print\n",
+            "a = 1\n  b = 2 3 +\n",
+        ]
+        for code in programs:
+            self.assertSameAsVisitor(code)
+
+    def test_errors_escaping_the_interpreter(self):
+        for code in ("a = 1 / 0\n", "a = 5 % 0\n", "a = (9x10^300) ^ 3\n"):
+            self.assertSameAsVisitor(code)
+
+    def test_initial_variables(self):
+        code = "c = a * b\nprint c - a\n"
+        expected = Recorder(engine="visitor", initial_env={'a': 2.0, 'b': 3.5})
+        expected.interpret(code)
+        for engine in self.ENGINES:
+            with self.subTest(engine=engine):
+                interpreter = Recorder(engine=engine, initial_env={'a': 2.0, 'b': 3.5})
+                interpreter.interpret(code)
+                self.assertEqual(interpreter.output, expected.output)
+                self.assertEqual(interpreter.env, expected.env)
+
+    def test_compiled_program_reruns(self):
+        # A CompiledProgram keeps no state between runs, whatever the environment.
+        code = "c = a * b\nassert c < 10\nprint c - a\n"
+        compiler = Recorder(engine="compiled")
+        program = compiler.compile(code)
+        for env in ({'a': 2.0, 'b': 3.5}, {'a': 4.0, 'b': 3.0}, {'a': 1.0}):
+            with self.subTest(env=env):
+                expected = Recorder(engine="visitor", initial_env=dict(env))
+                expected.interpret(code)
+                interpreter = Recorder(engine="compiled", initial_env=dict(env))
+                interpreter.run(program)
+                self.assertEqual(interpreter.output, expected.output)
+                self.assertEqual(interpreter.env, expected.env)
+
+
+class StaticCheckTest(unittest.TestCase):
+    """A compiled program reading a variable that is never defined fails at its first
+    such read before any statement runs."""
+
+    def test_first_undefined_read(self):
+        code = "a = 1\nprint a\nb = a +\n  (c * 2)\nprint d + c\n"
+        self.assertEqual(run(code, "compiled"), ([('Runtime Error', "Undefined variable 'c'.", 4, 3)], {}, None))
+        # At run time, the other engines get as far as the read.
+        self.assertEqual(run(code, "ast"), ([('print', '1.0'), ('Runtime Error', "Undefined variable 'c'.", 4, 3)],
+                                            {'a': '1.0'}, None))
+
+    def test_defined_variables(self):
+        for code, env in (("a = 1\nb = a + c\n", {'c': 2.0}), ("a = 1\na = a + 1\n", {}), ("print 1\n", {})):
+            with self.subTest(code=code):
+                interpreter = Recorder(initial_env=dict(env))
+                interpreter.interpret(code)
+                self.assertNotIn('Runtime Error', [event[0] for event in interpreter.output])
+
+    def test_read_before_its_assignment(self):
+        self.assertEqual(run("print 1\nb = b + 1\n", "compiled"),
+                         ([('Runtime Error', "Undefined variable 'b'.", 2, 4)], {}, None))
+
+    def test_reads_short_circuiting_may_skip(self):
+        code = "a = 0\nb = a and c\n"
+        self.assertEqual(run(code, "compiled", lazy_bool=True), ([], {'a': '0.0', 'b': 'False'}, None))
+        self.assertEqual(run(code, "compiled"), ([('Runtime Error', "Undefined variable 'c'.", 2, 10)], {}, None))
+
+    def test_each_batch_row_is_checked(self):
+        interpreter = Recorder()
+        results = list(interpreter.interpret_batch("print a\nb = a + c\n", [{'a': 1.0, 'c': 2.0}, {'a': 1.0}]))
+        self.assertEqual([result['output'] for result in results], [[1.0], []])
+        self.assertIsNone(results[0]['error'])
+        self.assertIn("Undefined variable 'c'", results[1]['error'])
+
+    def test_disabled(self):
+        self.assertEqual(run("print 1\nprint c\n", "compiled", static_checks=False),
+                         ([('print', '1.0'), ('Runtime Error', "Undefined variable 'c'.", 2, 6)], {}, None))
+
+
+class StreamTest(unittest.TestCase):
+    """interpret_stream() does what interpret() does, however its input is cut into
+    chunks; only a syntax error differs, as the statements before it have run."""
+
+    # A code of 7 characters ends its chunks within names, numbers, operators and comments.
+    CHUNK_SIZE = 7
+
+    def stream(self, code, **options):
+        interpreter = Recorder(static_checks=False, **options)
+        escaped = None
+        try:
+            interpreter.interpret_stream(io.StringIO(code), self.CHUNK_SIZE)
+        except (ArithmeticError, TypeError, ValueError) as e:
+            escaped = type(e).__name__
+        env = {name: repr(value) for name, value in interpreter.env.items()}
+        return interpreter.output, env, escaped
+
+    def test_random_programs(self):
+        compared = 0
+        for code in random_programs(200, seed=2):
+            expected = run(code, "ast", static_checks=False)
+            if any(kind == "Syntax Error" for kind, *_ in expected[0]):
+                continue  # see test_syntax_error
+            compared += 1
+            with self.subTest(code=code):
+                self.assertEqual(self.stream(code), expected)
+        self.assertGreater(compared, 100)
+
+    def test_tokens_and_comments_across_chunks(self):
+        programs = [
+            "long_name = 12.5  # a comment, long enough to span chunks\n"
+            "print long_name >= 1.25x10^1 and long_name != 3\n\n"
+            "   other = (long_name\n  + 2)  # ends here\n"
+            "assert other <= 12\nprint other\n",
+            "# only a comment\n\n\nvalue = 100.25 % 7\nprint value\n",
+            "a = 1\nb = a / 0\nprint b\n",
+        ]
+        for code in programs:
+            with self.subTest(code=code):
+                self.assertEqual(self.stream(code), run(code, "ast", static_checks=False))
+        self.assertEqual(self.stream("print 1\nmissing = ab + 1\n", initial_env={'ab': 2.0}),
+                         run("print 1\nmissing = ab + 1\n", "ast", initial_env={'ab': 2.0}))
+
+    def test_syntax_error(self):
+        code = "a = 1\nbb = 22 # (\nc = (a + \n"
+        output, env, escaped = run(code, "ast")
+        self.assertEqual(self.stream(code), (output, {'a': '1.0', 'bb': '22.0'}, escaped))
+
+
+class LazyBoolTest(unittest.TestCase):
+    """With lazy_bool, `and`/`or` skip their right operand when the left one decides,
+    so it can guard an operation that would fail, and the skipped work is counted."""
+
+    ENGINES = ("compiled", "ast", "stack")
+    GUARDED = "print x != 0 and 1 / x > 2\nprint x == 0 or 1 / x > 2\n"
+
+    def skipped(self, code, engine, **options):
+        interpreter = Recorder(engine=engine, lazy_bool=True, **options)
+        interpreter.interpret(code)
+        return interpreter.output, (interpreter.skipped_subtrees, interpreter.skipped_nodes)
+
+    def test_guard(self):
+        for engine in self.ENGINES:
+            with self.subTest(engine=engine):
+                self.assertEqual(run(self.GUARDED, engine, initial_env={'x': 0.0}, lazy_bool=True),
+                                 ([('print', 'False'), ('print', 'True')], {'x': '0.0'}, None))
+                self.assertEqual(run(self.GUARDED, engine, initial_env={'x': 0.0}),
+                                 ([], {'x': '0.0'}, 'ZeroDivisionError'))
+                # Nothing is skipped when the left operand does not decide.
+                self.assertEqual(run(self.GUARDED, engine, initial_env={'x': 0.25}, lazy_bool=True),
+                                 ([('print', 'True'), ('print', 'True')], {'x': '0.25'}, None))
+
+    def test_skipped_counts(self):
+        # `1 / x > 2` is five nodes, `x + x * 2 > 0` seven; the `or` evaluates both its operands.
+        code = self.GUARDED + "print (x > 1 or x > 2) and (x + x * 2 > 0)\n"
+        for engine in self.ENGINES:
+            with self.subTest(engine=engine):
+                for optimize in (True, False):
+                    self.assertEqual(self.skipped(code, engine, initial_env={'x': 0.0}, optimize=optimize),
+                                     ([('print', 'False'), ('print', 'True'), ('print', 'False')], (3, 5 + 5 + 7)))
+                self.assertEqual(self.skipped("a = 1\nprint a > 0 and a < 2\n", engine), ([('print', 'True')], (0, 0)))
+
+
+class CountingToken(CancelToken):
+    """A CancelToken that counts its checks and cancels itself at check number `at`."""
+    __slots__ = ('checks', 'at')
+
+    def __init__(self, at=None):
+        super().__init__()
+        self.checks, self.at = 0, at
+
+    def check(self):
+        self.checks += 1
+        if self.checks == self.at:
+            self.cancel()
+        super().check()
+
+
+def balanced_sum(count):
+    """A sum of `count` a's, parenthesized as a balanced tree (shallow enough for every engine)."""
+    if count == 1:
+        return "a"
+    return f"({balanced_sum(count // 2)} + {balanced_sum(count - count // 2)})"
+
+
+class CancelTest(unittest.TestCase):
+    """A cancelled run stops within a statement too large to wait for its end."""
+
+    # `a` comes from the environment, so the optimizer cannot fold the sum.
+    CODE = f"b = {balanced_sum(8 * CANCEL_CHECK_INTERVAL)}\nprint b\n"
+
+    def test_large_statements_are_checked(self):
+        nodes = count_nodes(Interpreter().parse(self.CODE).stats[0])
+        for engine in ("compiled", "ast", "stack"):
+            with self.subTest(engine=engine):
+                cancel_token = CountingToken()
+                self.assertEqual(run(self.CODE, engine, initial_env={'a': 1.0}, cancel_token=cancel_token),
+                                 ([('print', repr(float(8 * CANCEL_CHECK_INTERVAL)))],
+                                  {'a': '1.0', 'b': repr(float(8 * CANCEL_CHECK_INTERVAL))}, None))
+                self.assertGreaterEqual(cancel_token.checks, nodes // CANCEL_CHECK_INTERVAL)
+
+    def test_cancel_within_a_statement(self):
+        for engine in ("compiled", "ast", "stack"):
+            with self.subTest(engine=engine):
+                # Check 1 comes before the first statement, the next ones within it.
+                self.assertEqual(run(self.CODE, engine, initial_env={'a': 1.0}, cancel_token=CountingToken(at=3)),
+                                 ([], {'a': '1.0'}, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from ExprAst import BinOp, Compare, Const, Name, Op, OP_TEXT, Pow, Scientific, Unary
+from ExprOptimizer import optimize
+from Interpreter import Interpreter
+from tests.test_engines import run
+
+
+def parse(code):
+    return Interpreter().parse(code)
+
+
+def dump(node):
+    """A node as nested tuples in source-like notation, for comparing trees."""
+    if isinstance(node, Const):
+        return node.value
+    if isinstance(node, Name):
+        return node.name
+    if isinstance(node, BinOp):
+        return (dump(node.left), OP_TEXT[node.op], dump(node.right))
+    if isinstance(node, Unary):
+        return (OP_TEXT[node.op], dump(node.operand))
+    if isinstance(node, Compare):
+        rest = [item for op, operand in zip(node.ops, node.operands[1:]) for item in (OP_TEXT[op], dump(operand))]
+        return (dump(node.operands[0]), *rest)
+    if isinstance(node, Pow):
+        return (dump(node.base), '^', dump(node.exponent))
+    if isinstance(node, Scientific):
+        return (node.mantissa, 'x10^', dump(node.exponent))
+    return (type(node).__name__, dump(getattr(node, 'value', getattr(node, 'expr', None))))
+
+
+def optimized(code, fast_math=False):
+    return [dump(stat) for stat in optimize(parse(code), fast_math).stats]
+
+
+def find(node, op):
+    """The first BinOp with operator `op` under `node`, in evaluation order."""
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, BinOp) and node.op == op:
+            return node
+        for name in ('right', 'left', 'value', 'expr', 'operand'):
+            child = getattr(node, name, None)
+            if child is not None and not isinstance(child, str):
+                pending.append(child)
+    return None
+
+
+class OptimizerTest(unittest.TestCase):
+
+    def test_constant_folding(self):
+        self.assertEqual(optimized("a = 1 + 2 * 3\nprint a + 4\nprint b * (2 - 3) < 1 + 1\n"),
+                         [('Assign', 7.0), ('Print', 11.0), ('Print', (('b', '*', -1.0), '<', 2.0))])
+        self.assertEqual(optimized("print (2x10^3) + 2 ^ 3\nprint 1 < 2 and not 3 == 4\n"),
+                         [('Print', 2008.0), ('Print', True)])
+
+    def test_variables_from_the_environment_stay(self):
+        self.assertEqual(optimized("b = a\na = 2\nprint a + b\n"),
+                         [('Assign', 'a'), ('Assign', 2.0), ('Print', (2.0, '+', 'b'))])
+
+    def test_failing_subtrees_stay_in_place(self):
+        code = "a = 2\nb = a * 3 + (4 - 1) * (1 / 0)\n"
+        program = optimize(parse(code))
+        self.assertEqual(dump(program.stats[1]), ('Assign', (6.0, '+', (3.0, '*', (1.0, '/', 0.0)))))
+        # The division keeps its position in the source.
+        division, original = find(program.stats[1], Op.DIV), find(parse(code).stats[1], Op.DIV)
+        self.assertEqual(program.positions[division.tok], program.positions[original.tok])
+        self.assertEqual(program.positions[division.tok], (2, 23))
+
+    def test_double_not(self):
+        self.assertEqual(optimized("c = 1\nprint not not (a < c)\nprint not not a\nb = a > 1\nprint not not b\n"),
+                         [('Assign', 1.0), ('Print', ('a', '<', 1.0)), ('Print', ('not', ('not', 'a'))),
+                          ('Assign', ('a', '>', 1.0)), ('Print', 'b')])
+
+    def test_fast_math(self):
+        code = "b = a ^ 2 + a ^ 3 + a ^ 5\nc = a > 1\nprint c ^ 2\n"
+        self.assertEqual(optimized(code, fast_math=True),
+                         [('Assign', ((('a', '*', 'a'), '+', (('a', '*', 'a'), '*', 'a')), '+', ('a', '^', 5.0))),
+                          ('Assign', ('a', '>', 1.0)), ('Print', ('c', '^', 2.0))])
+        self.assertEqual(optimized(code)[0], ('Assign', ((('a', '^', 2.0), '+', ('a', '^', 3.0)), '+', ('a', '^', 5.0))))
+        self.assertEqual(run(code, "compiled", initial_env={'a': 3.0}, fast_math=True),
+                         run(code, "compiled", initial_env={'a': 3.0}))
+
+
+class OptimizedRunTest(unittest.TestCase):
+    """Optimized programs do what the unoptimized ones do, errors included: the same
+    output and assignments before an error show it stops the same statement."""
+
+    PROGRAMS = (
+        "a = 2\nprint a\nb = a * 3 + (4 - 1) * (1 / 0)\nprint b\n",
+        "a = 2\nb = a - 2\nprint 1 + 2 + 3 / b\n",
+        "a = 1\nprint 2 * 3 + a\n\n  assert not not (a > 1 + 1)\n",
+        "x = 3\nprint not not x\nprint - - x\nprint 5 % (x - 3)\n",
+    )
+
+    def test_same_output_env_and_errors(self):
+        for code in self.PROGRAMS:
+            for engine in ("compiled", "ast"):
+                with self.subTest(code=code, engine=engine):
+                    self.assertEqual(run(code, engine), run(code, engine, optimize=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import asyncio
+import json
+import threading
+import unittest
+
+from OutputChannel import ABORT_EVENT, OutputChannel, truncation_event
+
+EVENTS = [json.dumps({'type': 'stdout', 'content': str(n)}) for n in range(10)]
+ENV = json.dumps({'type': 'env_snapshot', 'content': {'a': 1.0}})
+
+
+async def drain(channel):
+    items = []
+    while (item := await channel.get()) is not None:
+        items.append(item)
+    return items
+
+
+class OutputChannelTest(unittest.TestCase):
+
+    def write(self, policy, events, max_bytes=4 * len(EVENTS[0])):
+        """What a reader gets of `events` written in a burst to a channel of `policy`,
+        and the channel."""
+        async def scenario():
+            aborted = []
+            channel = OutputChannel(asyncio.get_running_loop(), max_bytes, policy, lambda: aborted.append(True))
+            for event in events:
+                channel.put(event)
+            channel.finish()
+            return await drain(channel), channel, aborted
+        return asyncio.run(scenario())
+
+    def test_drop_oldest(self):
+        items, channel, _ = self.write('drop_oldest', EVENTS)
+        self.assertEqual(items, [truncation_event(6)] + EVENTS[-4:])
+        self.assertEqual(channel.dropped, 6)
+
+    def test_abort_keeps_the_final_events(self):
+        # After the abort, stdout is dropped but the client still gets what closes the run.
+        session = json.dumps({'type': 'session', 'content': {'id': 'x', 'version': 2}})
+        items, channel, aborted = self.write('abort', EVENTS + [ENV, session])
+        self.assertEqual(items, EVENTS[:4] + [ABORT_EVENT, ENV, session])
+        self.assertTrue(channel.aborted)
+        self.assertEqual(aborted, [True])
+
+    def test_block_waits_for_the_reader(self):
+        async def scenario():
+            channel = OutputChannel(asyncio.get_running_loop(), 4 * len(EVENTS[0]), 'block')
+
+            def writer():
+                for event in EVENTS:
+                    channel.put(event)
+                channel.finish()
+            thread = threading.Thread(target=writer)
+            thread.start()
+            await asyncio.sleep(0.05)
+            self.assertEqual(channel.peak_bytes, 4 * len(EVENTS[0]))
+            items = await drain(channel)
+            thread.join()
+            return items
+        self.assertEqual(asyncio.run(scenario()), EVENTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
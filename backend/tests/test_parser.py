@@ -0,0 +1,105 @@
+import unittest
+
+from ExprAst import Node, max_depth
+from ExprFastParser import FastParseError, FastParser, IterativeParser, fast_parse
+from Interpreter import Interpreter
+from tests.test_engines import Recorder, random_programs
+
+
+def dump(node):
+    """A node as nested tuples of its type, token index and fields, for comparing trees."""
+    if isinstance(node, Node):
+        fields = [getattr(node, slot) for cls in type(node).__mro__ for slot in getattr(cls, '__slots__', ())]
+        return (type(node).__name__,) + tuple(dump(field) for field in fields)
+    if isinstance(node, (list, tuple)):
+        return tuple(dump(item) for item in node)
+    return node
+
+
+def antlr_parse(text):
+    """`text` parsed by ANTLR and lowered (None on a syntax error)."""
+    interpreter = Recorder()
+    interpreter.use_fast_parser = False
+    return interpreter.parse(text)
+
+
+class FastParserTest(unittest.TestCase):
+    """The hand-written parser must build exactly the AST that lowering ANTLR's parse
+    tree does, token indices included, and decline whatever ANTLR reports as an error.
+    It may also decline programs ANTLR accepts by dropping their trailing tokens
+    (`a = 8 / not 9`); those then go to ANTLR, as do syntax errors."""
+
+    def assertSameTree(self, text):
+        """Returns whether the fast parser took `text`."""
+        expected = antlr_parse(text)
+        try:
+            program = fast_parse(text)
+        except FastParseError:
+            return False
+        self.assertIsNotNone(expected, "the fast parser accepted a program with a syntax error")
+        self.assertEqual(dump(program.stats), dump(expected.stats))
+        for stat in program.stats:
+            self.assertEqual(program.positions[stat.tok], expected.positions[stat.tok])
+        return True
+
+    def test_random_programs(self):
+        accepted = 0
+        for text in random_programs(300, seed=2):
+            with self.subTest(text=text):
+                accepted += self.assertSameTree(text)
+        self.assertGreater(accepted, 200)
+
+    def test_precedence_and_associativity(self):
+        programs = [
+            "a = 1 - 2 - 3\n",
+            "a = 2 ^ 3 ^ 2\n",
+            "a = -2 ^ 2\n",
+            "a = not 1 < 2 == 3 and 4 or 5\n",
+            "a = 2x10^1 + 1\n",
+            "a = 2x10^-1 * 3\n",
+            "a = 6 / 3 % 2 * 4\n",
+            "a = --+-1\n",
+            "a = .5e-3 + 1.5E+2\n",
+            "a = 1 2 print 3\n",
+        ]
+        for text in programs:
+            with self.subTest(text=text):
+                self.assertSameTree(text)
+
+    def test_declines_what_antlr_reports(self):
+        programs = ["a = (1 + 2\n", "a = = 1\n", "print\n", "1 +\n", "a = not\n", "x10^2\n"]
+        for text in programs:
+            with self.subTest(text=text):
+                self.assertIsNone(antlr_parse(text))
+                with self.assertRaises(FastParseError):
+                    fast_parse(text)
+
+    def test_iterative_parser_builds_the_same_tree(self):
+        for text in random_programs(100, seed=3) + ["a = " + "(" * 40 + "1 + 2 ^ -b" + ")" * 40 + "\n"]:
+            try:
+                expected = FastParser(text).parse()
+            except FastParseError:
+                continue
+            with self.subTest(text=text):
+                self.assertEqual(dump(IterativeParser(text).parse().stats), dump(expected.stats))
+
+    def test_deep_nesting(self):
+        # Far past the recursion limit: the fast parser switches to the IterativeParser,
+        # and the programs run on the StackEvaluator.
+        depth = 5000
+        programs = {
+            "a = " + "(" * depth + "1 + 1" + ")" * depth + "\n": 2.0,
+            "a = 1" + " ^ 1" * depth + "\n": 1.0,
+            "a = " + "-" * depth + "3\n": 3.0,
+        }
+        for text, value in programs.items():
+            with self.subTest(text=text[:20]):
+                fast_parse(text)
+                interpreter = Interpreter()
+                interpreter.interpret(text)
+                self.assertEqual(interpreter.env, {'a': value})
+        self.assertGreater(max_depth(fast_parse("a = 1" + " ^ 1" * depth).stats[0]), depth)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import os
+import signal
+import threading
+import time
+import unittest
+
+from ExprAst import CancelToken
+from ProcessPool import ProcessPool
+
+# Runs for a few seconds of CPU
+SLOW_CODE = "a = 1\n" + "a = a + 1\n" * 300000 + "print a\n"
+
+
+class ProcessPoolTest(unittest.TestCase):
+    """A run that breaks a limit, is cancelled or loses its worker ends promptly, and
+    the worker is replaced so the next run goes ahead as usual."""
+
+    def pool(self, **limits):
+        pool = ProcessPool(workers=1, **limits)
+        self.addCleanup(pool.close)
+        return pool
+
+    def run_program(self, pool, code, cancel_token=None, env=None, emit_delay=0):
+        """The events of running `code` in `pool` as dicts, and the seconds it took."""
+        events = []
+
+        def emit(event):
+            events.append(json.loads(event))
+            time.sleep(emit_delay)
+        started = time.monotonic()
+        pool.run(code, emit, cancel_token=cancel_token, env=env)
+        return events, time.monotonic() - started
+
+    def assertWorks(self, pool):
+        events, _ = self.run_program(pool, "b = a * 2\nprint b\n", env={'a': 1.5})
+        self.assertEqual(events, [{'type': 'stdout', 'content': '3.0'},
+                                  {'type': 'env_snapshot', 'content': {'a': 1.5, 'b': 3.0}}])
+
+    def test_run(self):
+        pool = self.pool()
+        self.assertWorks(pool)
+        self.assertWorks(pool)
+        self.assertEqual(pool.stats()['recycled'], 0)
+
+    def test_run_returns_its_timings(self):
+        pool = self.pool(cpu_seconds=30, wall_seconds=0.5)
+        timings = pool.run("a = 1\nprint a\n", lambda event: None)
+        self.assertEqual(set(timings), {'lex', 'parse', 'compile', 'eval'})
+        self.assertIsNone(pool.run(SLOW_CODE, lambda event: None))
+
+    def test_cpu_limit(self):
+        pool = self.pool(cpu_seconds=1, wall_seconds=30)
+        events, elapsed = self.run_program(pool, SLOW_CODE)
+        self.assertEqual(events, [{'type': 'fatal_error', 'content': "FATAL SERVER ERROR: CPU time limit of 1 s exceeded."}])
+        self.assertLess(elapsed, 10)
+        self.assertEqual(pool.stats()['recycled'], 1)
+        self.assertWorks(pool)
+
+    def test_wall_limit(self):
+        pool = self.pool(cpu_seconds=30, wall_seconds=0.5)
+        events, elapsed = self.run_program(pool, SLOW_CODE)
+        self.assertEqual(events, [{'type': 'fatal_error', 'content': "FATAL SERVER ERROR: Time limit of 0.5 s exceeded."}])
+        self.assertLess(elapsed, 2)
+        self.assertEqual(pool.stats()['recycled'], 1)
+        self.assertWorks(pool)
+
+    def test_time_in_emit_does_not_count(self):
+        # A slow client keeps the run waiting longer than wall_seconds in all.
+        pool = self.pool(wall_seconds=1)
+        events, elapsed = self.run_program(pool, "print 1\n" * 6, emit_delay=0.3)
+        self.assertGreater(elapsed, 1.5)
+        self.assertEqual([event['type'] for event in events], ['stdout'] * 6 + ['env_snapshot'])
+
+    def test_cancel(self):
+        pool = self.pool(cpu_seconds=30, wall_seconds=30)
+        cancel_token = CancelToken()
+        threading.Timer(0.3, cancel_token.cancel).start()
+        events, elapsed = self.run_program(pool, SLOW_CODE, cancel_token=cancel_token)
+        self.assertEqual(events, [])
+        self.assertLess(elapsed, 2)
+        self.assertEqual(pool.stats()['recycled'], 1)
+        self.assertWorks(pool)
+
+    def test_worker_killed_mid_run(self):
+        pool = self.pool(cpu_seconds=30, wall_seconds=30)
+        pid = pool._idle.queue[0].process.pid
+        threading.Timer(0.3, os.kill, (pid, signal.SIGKILL)).start()
+        events, elapsed = self.run_program(pool, SLOW_CODE)
+        self.assertEqual(events, [{'type': 'fatal_error',
+                                   'content': f"FATAL SERVER ERROR: Worker process exited unexpectedly (code {-signal.SIGKILL})."}])
+        self.assertLess(elapsed, 5)
+        self.assertEqual(pool.stats()['recycled'], 1)
+        self.assertWorks(pool)
+
+    def test_dead_idle_worker_is_replaced(self):
+        pool = self.pool()
+        worker = pool._idle.queue[0]
+        worker.process.kill()
+        worker.process.join()
+        self.assertWorks(pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
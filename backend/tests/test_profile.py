@@ -0,0 +1,76 @@
+import json
+import unittest
+
+from starlette.testclient import TestClient
+
+from Interpreter import StreamingInterpreter
+from single_server import RESULT_CACHE, app
+from tests.test_server import stream_events
+
+# `a` comes from the environment, so the optimizer leaves the first two statements
+# whole; the third overflows to inf, and the fourth reads that.
+CODE = "b = a ^ 3 + 1\nprint b * (2x10^a)\n\n  c = b * (9x10^307) * a\nprint c > 1\n"
+
+PROFILE = [
+    {'line': 1, 'column': 0, 'nodes': 6, 'pows': 1, 'max_magnitude': 9.0},
+    {'line': 2, 'column': 0, 'nodes': 5, 'pows': 1, 'max_magnitude': 1800.0},
+    # 9x10^307 is folded into a constant
+    {'line': 4, 'column': 2, 'nodes': 6, 'pows': 0, 'max_magnitude': "inf"},
+    {'line': 5, 'column': 0, 'nodes': 4, 'pows': 0, 'max_magnitude': "inf"},
+]
+
+
+def without_seconds(report):
+    return [{key: value for key, value in statement.items() if key != 'seconds'} for statement in report]
+
+
+class ProfileTest(unittest.TestCase):
+    """With `profile`, a run ends with one 'profile' event describing each statement it ran."""
+
+    def run_code(self, code, **options):
+        events = []
+        interpreter = StreamingInterpreter(initial_env={'a': 2.0}, **options)
+        interpreter.set_stream_callback(events.append)
+        interpreter.interpret(code)
+        return [json.loads(event) for event in events]
+
+    def test_profile_event(self):
+        events = self.run_code(CODE, profile=True)
+        self.assertEqual([event['type'] for event in events], ['stdout', 'stdout', 'profile'])
+        report = events[-1]['content']
+        self.assertEqual(without_seconds(report), PROFILE)
+        self.assertTrue(all(statement['seconds'] >= 0 for statement in report))
+
+    def test_statements_up_to_an_error(self):
+        events = self.run_code("b = a * 2\nassert b < 1\nprint b\n", profile=True)
+        self.assertEqual([event['type'] for event in events], ['runtime_error', 'profile'])
+        self.assertEqual([statement['line'] for statement in events[-1]['content']], [1, 2])
+
+    def test_no_profile_by_default(self):
+        self.assertEqual([event['type'] for event in self.run_code(CODE)], ['stdout', 'stdout'])
+
+    def test_same_output_as_unprofiled_runs(self):
+        for engine in ("compiled", "ast"):
+            with self.subTest(engine=engine):
+                self.assertEqual(self.run_code(CODE, engine=engine, profile=True)[:-1],
+                                 self.run_code(CODE, engine=engine))
+
+    def test_endpoint(self):
+        RESULT_CACHE.clear()
+        with TestClient(app) as client:
+            response = client.post('/api/stream?protocol=2&profile=true',
+                                   json={'code': CODE, 'env': {'a': 2}})
+            events = stream_events(response)
+            self.assertEqual([event['type'] for event in events], ['stdout', 'stdout', 'profile', 'env_snapshot'])
+            self.assertEqual(without_seconds(events[2]['content']), PROFILE)
+
+            # Profiled runs are neither served from nor put in the result cache.
+            plain = stream_events(client.post('/api/stream?protocol=2', json={'code': CODE, 'env': {'a': 2}}))
+            self.assertEqual(plain, events[:2] + events[3:])
+            again = stream_events(client.post('/api/stream?protocol=2&profile=true',
+                                              json={'code': CODE, 'env': {'a': 2}}))
+            self.assertEqual([event['type'] for event in again].count('profile'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+from ProgramCache import ESTIMATED_BYTES_PER_TOKEN, ProgramCache
+from tests.test_engines import Recorder
+
+
+class ProgramCacheTest(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = ProgramCache()
+        key = ProgramCache.make_key("compiled:100", ["a", "=", "1"])
+        self.assertIsNone(cache.get(key))
+        cache.put(key, 'program', 3)
+        self.assertEqual(cache.get(key), 'program')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_ratio']), (1, 1, 0.5))
+        self.assertEqual(stats['bytes'], 3 * ESTIMATED_BYTES_PER_TOKEN)
+
+    def test_keys(self):
+        key = ProgramCache.make_key("compiled:100", ["a", "b"])
+        for other in (("compiled:101", ["a", "b"]), ("ast:100", ["a", "b"]), ("compiled:100", ["ab"])):
+            with self.subTest(other=other):
+                self.assertNotEqual(ProgramCache.make_key(*other), key)
+
+    def test_least_recently_used_go_first(self):
+        cache = ProgramCache(max_entries=2)
+        cache.put(b'a', 'a', 1)
+        cache.put(b'b', 'b', 1)
+        cache.get(b'a')
+        cache.put(b'c', 'c', 1)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual((cache.get(b'a'), cache.get(b'c')), ('a', 'c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        cache = ProgramCache(max_bytes=10 * ESTIMATED_BYTES_PER_TOKEN)
+        cache.put(b'a', 'a', 4)
+        cache.put(b'b', 'b', 4)
+        cache.put(b'c', 'c', 4)
+        self.assertIsNone(cache.get(b'a'))
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evictions']), (2, 8 * ESTIMATED_BYTES_PER_TOKEN, 1))
+        # A program larger than the whole cache is not kept, and evicts nothing.
+        cache.put(b'd', 'd', 11)
+        self.assertIsNone(cache.get(b'd'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_replacing_an_entry(self):
+        cache = ProgramCache()
+        cache.put(b'a', 'old', 4)
+        cache.put(b'a', 'new', 2)
+        self.assertEqual(cache.get(b'a'), 'new')
+        self.assertEqual(cache.stats()['bytes'], 2 * ESTIMATED_BYTES_PER_TOKEN)
+
+
+class InterpreterCacheTest(unittest.TestCase):
+    """Programs that differ only in comments and whitespace compile once, and runs
+    of the cached program report positions in the text actually run."""
+
+    def run_code(self, cache, code, engine="compiled"):
+        interpreter = Recorder(engine=engine, program_cache=cache)
+        interpreter.interpret(code)
+        return interpreter.output, interpreter.env
+
+    def test_comment_and_whitespace_edits_hit(self):
+        for engine in ("compiled", "ast"):
+            with self.subTest(engine=engine):
+                cache = ProgramCache()
+                self.assertEqual(self.run_code(cache, "x = 1 # a\nprint x\n", engine),
+                                 ([('print', '1.0')], {'x': 1.0}))
+                for code in ("x=1\nprint x\n", "# header\nx =  1   # b\n\n  print x"):
+                    self.assertEqual(self.run_code(cache, code, engine), ([('print', '1.0')], {'x': 1.0}))
+                self.assertEqual((cache.stats()['misses'], cache.stats()['hits'], cache.stats()['entries']), (1, 2, 1))
+
+                self.run_code(cache, "x = 2\nprint x\n", engine)
+                self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_errors_are_located_in_the_current_text(self):
+        cache = ProgramCache()
+        self.run_code(cache, "a = 1\nassert a > 1\n")
+        code = "# moved\na = 1\n\n    assert a > 1\n"
+        output, _ = self.run_code(cache, code)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(output, [('Runtime Error', 'Assertion failed.', 4, 11)])
+        self.assertEqual(output, self.run_code(None, code)[0])
+
+    def test_options_compile_separately(self):
+        cache = ProgramCache()
+        Recorder(program_cache=cache).compile("a = 1\n")
+        Recorder(program_cache=cache, lazy_bool=True).compile("a = 1\n")
+        Recorder(program_cache=cache, engine="ast").compile("a = 1\n")
+        self.assertEqual((cache.stats()['hits'], cache.stats()['entries']), (0, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import gzip
+import json
+import unittest
+import zlib
+from unittest import mock
+
+from starlette.testclient import TestClient
+
+import single_server
+from RequestBody import PayloadTooLarge, decode_body, parse_edits, parse_program
+from single_server import RESULT_CACHE, app
+from tests.test_server import stream_events
+
+CODE = b"a = 2\nprint a * 3\n"
+
+
+class DecodeBodyTest(unittest.TestCase):
+
+    def test_encodings(self):
+        for encoding, body in (('', CODE), ('identity', CODE), ('gzip', gzip.compress(CODE)),
+                               ('x-gzip', gzip.compress(CODE)), ('GZip ', gzip.compress(CODE)),
+                               ('deflate', zlib.compress(CODE))):
+            with self.subTest(encoding=encoding):
+                self.assertEqual(decode_body(body, encoding), CODE)
+
+    def test_size_limit(self):
+        # Far smaller than the limit, far larger once inflated
+        bomb = gzip.compress(b"print 1\n" * 1000000)
+        self.assertLess(len(bomb), 64 * 1024)
+        for encoding, body in (('gzip', bomb), ('', b"x" * (64 * 1024 + 1))):
+            with self.subTest(encoding=encoding):
+                with self.assertRaises(PayloadTooLarge):
+                    decode_body(body, encoding, max_bytes=64 * 1024)
+        self.assertEqual(decode_body(gzip.compress(b"x" * 1000), 'gzip', max_bytes=1000), b"x" * 1000)
+
+    def test_bad_bodies(self):
+        compressed = gzip.compress(CODE * 100)
+        for encoding, body, message in (('gzip', compressed[:len(compressed) // 2], "Truncated gzip body"),
+                                        ('gzip', b"not gzip at all", "Invalid gzip body"),
+                                        ('deflate', b"\x78\x9c garbage", "Invalid deflate body"),
+                                        ('br', CODE, "Unsupported Content-Encoding 'br'")):
+            with self.subTest(encoding=encoding, message=message):
+                with self.assertRaises(ValueError) as raised:
+                    decode_body(body, encoding)
+                self.assertNotIsInstance(raised.exception, PayloadTooLarge)
+                self.assertIn(message, str(raised.exception))
+
+
+class ParseProgramTest(unittest.TestCase):
+
+    def test_text(self):
+        for content_type in ('text/plain', 'text/plain; charset=utf-8', ''):
+            with self.subTest(content_type=content_type):
+                self.assertEqual(parse_program(CODE, content_type), (CODE.decode(), {}, None))
+
+    def test_json(self):
+        body = json.dumps({'code': "print a\n", 'env': {'a': 1, 'b': True}}).encode()
+        self.assertEqual(parse_program(body, 'application/json'), ("print a\n", {'a': 1.0, 'b': True}, None))
+        self.assertEqual(parse_program(b'{"code": "print 1"}', 'application/json'), ("print 1", {}, None))
+
+    def test_edits(self):
+        body = json.dumps({'version': 3, 'edits': [{'offset': 0, 'length': 1, 'text': 'b'}]}).encode()
+        self.assertEqual(parse_program(body, 'application/json'), (None, {}, (3, [(0, 1, 'b')])))
+        for request in ({'version': -1, 'edits': []}, {'version': True, 'edits': []}, {'version': 1, 'edits': {}},
+                        {'version': 1, 'edits': [{'offset': 0, 'length': 1}]}):
+            with self.subTest(request=request):
+                self.assertRaises(ValueError, parse_edits, request)
+
+    def test_bad_programs(self):
+        for body, content_type, message in (
+                (b'{"code": 1}', 'application/json', "Expected a JSON object with a 'code'"),
+                (b'["print 1"]', 'application/json', "Expected a JSON object with a 'code'"),
+                (b'{"code": "print a", "env": {"a": "x"}}', 'application/json', "'a' must be a number"),
+                (b'{"code": ', 'application/json', "Invalid JSON"),
+                (b'\xff\xfe', 'text/plain', "must be UTF-8"),
+                (CODE, 'text/csv', "Unsupported Content-Type 'text/csv'")):
+            with self.subTest(body=body, content_type=content_type):
+                with self.assertRaises(ValueError) as raised:
+                    parse_program(body, content_type)
+                self.assertIn(message, str(raised.exception))
+
+
+class PostedProgramTest(unittest.TestCase):
+    """POST /api/stream with compressed and JSON bodies, and its 400 and 413 answers."""
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def post(self, body, content_type='text/plain', encoding=None):
+        headers = {'Content-Type': content_type}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return self.client.post('/api/stream?protocol=2', content=body, headers=headers)
+
+    def test_bodies(self):
+        expected = [{'type': 'stdout', 'content': '6.0'}, {'type': 'env_snapshot', 'content': {'a': 2.0}}]
+        for body, content_type, encoding in ((CODE, 'text/plain', None), (gzip.compress(CODE), 'text/plain', 'gzip'),
+                                             (zlib.compress(CODE), 'text/plain', 'deflate')):
+            with self.subTest(encoding=encoding):
+                self.assertEqual(stream_events(self.post(body, content_type, encoding)), expected)
+        body = json.dumps({'code': "print a * 3\n", 'env': {'a': 2}}).encode()
+        self.assertEqual(stream_events(self.post(zlib.compress(body), 'application/json', 'deflate')), expected)
+
+    def test_bad_bodies(self):
+        for body, content_type, encoding in ((gzip.compress(CODE)[:-12], 'text/plain', 'gzip'),
+                                             (b"garbage", 'text/plain', 'gzip'),
+                                             (CODE, 'text/plain', 'compress'),
+                                             (CODE, 'application/xml', None),
+                                             (b'{"env": {}}', 'application/json', None)):
+            with self.subTest(body=body, content_type=content_type, encoding=encoding):
+                self.assertEqual(self.post(body, content_type, encoding).status_code, 400)
+
+    def test_decompressed_size_limit(self):
+        bomb = gzip.compress(b"print 1\n" * 1000000)
+        with mock.patch.object(single_server, 'MAX_BODY_BYTES', 64 * 1024):
+            response = self.post(bomb, encoding='gzip')
+        self.assertEqual(response.status_code, 413)
+        self.assertIn(str(64 * 1024), response.text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+import unittest
+
+from ResultCache import ResultCache
+from ResumableRun import RunStore
+from tests.test_runs import EVENTS, produce, read
+
+FATAL = json.dumps({'type': 'fatal_error', 'content': 'Time limit exceeded'})
+SESSION = json.dumps({'type': 'session', 'content': {'id': 'x', 'version': 1}})
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def test_keys(self):
+        key = ResultCache.make_key("lazy=0", "a = 1\n", {'b': 2.0})
+        self.assertEqual(key, ResultCache.make_key("lazy=0", "a = 1\n", {'b': 2.0}))
+        for other in (("lazy=1", "a = 1\n", {'b': 2.0}), ("lazy=0", "a =  1\n", {'b': 2.0}),
+                      ("lazy=0", "a = 1\n", {'b': 3.0}), ("lazy=0", "a = 1\n", {})):
+            with self.subTest(other=other):
+                self.assertNotEqual(ResultCache.make_key(*other), key)
+
+    def test_put_and_get(self):
+        cache = ResultCache()
+        self.assertIsNone(cache.get(b'k'))
+        cache.put(b'k', EVENTS)
+        self.assertEqual(cache.get(b'k'), EVENTS)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+    def test_uncacheable_results(self):
+        cache = ResultCache(max_entry_bytes=sum(map(len, EVENTS)) - 1)
+        cache.put(b'failed', EVENTS[:2] + [FATAL])
+        cache.put(b'large', EVENTS)
+        self.assertIsNone(cache.get(b'failed'))
+        self.assertIsNone(cache.get(b'large'))
+
+    def test_least_recently_used_go_first(self):
+        cache = ResultCache(max_entries=2)
+        cache.put(b'a', EVENTS[:1])
+        cache.put(b'b', EVENTS[:1])
+        cache.get(b'a')
+        cache.put(b'c', EVENTS[:1])
+        self.assertIsNone(cache.get(b'b'))
+        self.assertIsNotNone(cache.get(b'a'))
+        self.assertIsNotNone(cache.get(b'c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache = ResultCache(max_bytes=2 * len(EVENTS[0]))
+        for key in (b'a', b'b', b'c'):
+            cache.put(key, EVENTS[:1])
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertIsNone(cache.get(b'a'))
+
+    def test_entries_expire(self):
+        cache = ResultCache(ttl_seconds=0.05)
+        cache.put(b'k', EVENTS)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(b'k'))
+        self.assertEqual(cache.stats()['expired'], 1)
+
+
+class SingleFlightTest(unittest.TestCase):
+    """Identical requests arriving while a run is going read that run's stream,
+    and its events are cached once it completes."""
+
+    def test_requests_join_a_run_in_progress(self):
+        async def scenario():
+            cache, store = ResultCache(), RunStore()
+            events = asyncio.Queue()
+            run = store.start(produce(events), record=True)
+            cache.begin(b'k', 1, run)
+            self.assertIs(cache.join(b'k', 1), run)
+            self.assertIsNone(cache.join(b'k', 2))  # other protocols frame messages differently
+            self.assertIsNone(cache.get(b'k'))
+
+            for event in EVENTS + [None]:
+                events.put_nowait(event)
+            self.assertEqual([event for _, event in await read(store, run)], EVENTS)
+            self.assertIsNone(cache.join(b'k', 1))
+            self.assertEqual(cache.get(b'k'), EVENTS)
+            self.assertEqual(cache.stats()['joined'], 1)
+        asyncio.run(scenario())
+
+    def test_no_joining_once_messages_were_dropped(self):
+        async def scenario():
+            cache, store = ResultCache(), RunStore(max_run_bytes=4 * len(EVENTS[0]))
+            events = asyncio.Queue()
+            run = store.start(produce(events), record=True)
+            cache.begin(b'k', 1, run)
+            for event in EVENTS:
+                events.put_nowait(event)
+            await read(store, run, count=len(EVENTS))
+            self.assertFalse(run.replayable_from_start)
+            self.assertIsNone(cache.join(b'k', 1))
+            events.put_nowait(None)
+            await read(store, run, run.last)
+            # Nor is it cached: runs record no more events than they keep messages.
+            self.assertIsNone(cache.get(b'k'))
+        asyncio.run(scenario())
+
+    def test_incomplete_runs_are_not_cached(self):
+        async def scenario():
+            cache, store = ResultCache(), RunStore()
+            cancelled = store.start(produce(EVENTS), record=True)
+            cache.begin(b'cancelled', 1, cancelled)
+            cancelled.cancel()
+            await read(store, cancelled)
+            failed = store.start(produce(EVENTS[:3] + [FATAL]), record=True)
+            cache.begin(b'failed', 1, failed)
+            await read(store, failed)
+            self.assertIsNone(cache.get(b'cancelled'))
+            self.assertIsNone(cache.get(b'failed'))
+            self.assertEqual(cache.stats()['running'], 0)
+        asyncio.run(scenario())
+
+    def test_private_runs(self):
+        # A session's run: nobody else reads its stream, and its 'session' event,
+        # naming the session, is not cached.
+        async def scenario():
+            cache, store = ResultCache(), RunStore()
+            events = asyncio.Queue()
+            run = store.start(produce(events), record=True)
+            cache.begin(b'k', 1, run, private=True)
+            self.assertIsNone(cache.join(b'k', 1))
+            for event in EVENTS + [SESSION, None]:
+                events.put_nowait(event)
+            await read(store, run)
+            self.assertEqual(cache.get(b'k'), EVENTS)
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
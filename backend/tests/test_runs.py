@@ -0,0 +1,168 @@
+import asyncio
+import json
+import unittest
+
+from OutputChannel import truncation_event
+from ResumableRun import STOPPED_EVENT, RunStore
+
+EVENTS = [json.dumps({'type': 'stdout', 'content': str(n)}) for n in range(10)]
+
+
+async def produce(events):
+    """What WorkerPool.submit_stream yields: `events`, a list, or an asyncio.Queue
+    of them ending with None, for a run still going."""
+    if isinstance(events, list):
+        for event in events:
+            yield event
+        return
+    while (event := await events.get()) is not None:
+        yield event
+
+
+async def read(store, run, after=0, count=None):
+    """The SSE messages RunStore.stream gives for `run` after message `after`, as
+    (id, event) pairs; just the first `count` of them, like a client that goes away."""
+    messages = []
+    stream = store.stream(run, after)
+    try:
+        async for message in stream:
+            messages.append((message.get('id'), message['data'][len('data: '):-2]))
+            if len(messages) == count:
+                break
+    finally:
+        await stream.aclose()
+    return messages
+
+
+class RunStoreTest(unittest.TestCase):
+    """A client that reconnects with the Last-Event-ID of the last message it got must
+    get exactly the messages after it, without the program running again."""
+
+    def test_resume_after_last_event_id(self):
+        async def scenario():
+            store = RunStore()
+            run = store.start(produce(EVENTS))
+            first = await read(store, run, count=3)
+            self.assertEqual([event for _, event in first], EVENTS[:3])
+            self.assertEqual(first[-1][0], f"{run.id}.3")
+
+            resumed, after = store.resume(first[-1][0])
+            self.assertIs(resumed, run)
+            rest = await read(store, resumed, after)
+            self.assertEqual([event for _, event in rest], EVENTS[3:])
+            self.assertEqual([number for number, _ in rest],
+                             [f"{run.id}.{n}" for n in range(4, len(EVENTS) + 1)])
+            self.assertTrue(run.finished)
+            self.assertEqual(store.stats()['resumed'], 1)
+
+            # Resuming at the last message leaves nothing to send.
+            self.assertEqual(store.resume(rest[-1][0]), (run, len(EVENTS)))
+            self.assertEqual(await read(store, run, len(EVENTS)), [])
+        asyncio.run(scenario())
+
+    def test_resume_while_the_run_goes_on(self):
+        async def scenario():
+            store = RunStore()
+            events = asyncio.Queue()
+            run = store.start(produce(events))
+            events.put_nowait(EVENTS[0])
+            first = await read(store, run, count=1)
+            # The reader waits for the messages the run has yet to produce.
+            reader = asyncio.ensure_future(read(store, *store.resume(first[0][0])))
+            await asyncio.sleep(0.01)
+            self.assertFalse(reader.done())
+            for event in EVENTS[1:] + [None]:
+                events.put_nowait(event)
+            self.assertEqual([event for _, event in await reader], EVENTS[1:])
+        asyncio.run(scenario())
+
+    def test_unknown_ids(self):
+        async def scenario():
+            store = RunStore()
+            run = store.start(produce(EVENTS))
+            await read(store, run)
+            for last_event_id in ("nope.1", f"{run.id}.{len(EVENTS) + 1}", f"{run.id}.x", run.id, ""):
+                with self.subTest(last_event_id=last_event_id):
+                    self.assertIsNone(store.resume(last_event_id))
+        asyncio.run(scenario())
+
+    def test_dropped_messages_are_reported(self):
+        # A run keeps only its latest max_run_bytes of messages sent: a client resuming
+        # from further back gets a 'truncated' event for what is gone, then the rest.
+        async def scenario():
+            store = RunStore(max_run_bytes=4 * len(EVENTS[0]))
+            run = store.start(produce(EVENTS))
+            self.assertEqual([event for _, event in await read(store, run)], EVENTS)
+            messages = await read(store, *store.resume(f"{run.id}.1"))
+            first_kept = len(EVENTS) - 4
+            self.assertEqual(messages[0], (None, truncation_event(first_kept - 1)))
+            self.assertEqual([event for _, event in messages[1:]], EVENTS[first_kept:])
+        asyncio.run(scenario())
+
+    def test_run_waits_for_a_reader_when_full(self):
+        # Unsent messages are never dropped: the run waits for them to be read.
+        async def scenario():
+            store = RunStore(max_run_bytes=4 * len(EVENTS[0]))
+            run = store.start(produce(EVENTS))
+            await asyncio.sleep(0.01)
+            self.assertEqual(run.last, 4)
+            self.assertFalse(run.finished)
+            self.assertEqual([event for _, event in await read(store, run)], EVENTS)
+            self.assertTrue(run.finished)
+        asyncio.run(scenario())
+
+    def test_run_stops_when_full_after_its_reader_left(self):
+        # Rather than hold its worker until the client comes back, the run ends.
+        async def scenario():
+            store = RunStore(max_run_bytes=4 * len(EVENTS[0]))
+            run = store.start(produce(EVENTS))
+            first = await read(store, run, count=2)
+            await asyncio.sleep(0.01)
+            self.assertTrue(run.cancel_token.cancelled)
+            self.assertTrue(run.finished)
+            rest = await read(store, *store.resume(first[-1][0]))
+            self.assertEqual([event for _, event in rest], EVENTS[2:6] + [STOPPED_EVENT])
+        asyncio.run(scenario())
+
+    def test_replayed_events_resume_like_a_run(self):
+        async def scenario():
+            store = RunStore()
+            for frames in (False, True):
+                with self.subTest(frames=frames):
+                    run = store.replay(EVENTS, frames=frames)
+                    self.assertTrue(run.finished)
+                    messages = await read(store, run)
+                    if frames:
+                        events = [event for _, frame in messages for event in json.loads(frame)]
+                        self.assertEqual([json.dumps(event) for event in events], EVENTS)
+                    else:
+                        self.assertEqual([event for _, event in messages], EVENTS)
+                        rest = await read(store, *store.resume(messages[5][0]))
+                        self.assertEqual([event for _, event in rest], EVENTS[6:])
+        asyncio.run(scenario())
+
+    def test_cancel_waits_for_every_client(self):
+        async def scenario():
+            store = RunStore()
+            run = store.start(produce(asyncio.Queue()))
+            store.join(run)
+            self.assertTrue(store.cancel(run.id))
+            self.assertFalse(run.cancel_token.cancelled)
+            self.assertTrue(store.cancel(run.id))
+            self.assertTrue(run.cancel_token.cancelled)
+            self.assertFalse(store.cancel("nope"))
+        asyncio.run(scenario())
+
+    def test_abandoned_run_is_cancelled(self):
+        async def scenario():
+            store = RunStore(ttl_seconds=0.05)
+            run = store.start(produce(asyncio.Queue()))
+            await asyncio.sleep(0.2)
+            self.assertTrue(run.cancel_token.cancelled)
+            self.assertIsNone(store.resume(f"{run.id}.0"))
+            self.assertEqual(store.stats()['abandoned'], 1)
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,383 @@
+import asyncio
+import gzip
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import urlencode
+
+import httpx
+from starlette.testclient import TestClient
+
+import single_server
+from single_server import RESULT_CACHE, RUNS, WORKER_POOL, app
+import WorkerPool as worker_pool
+from WorkerPool import WorkerPool
+
+
+def stream_events(response):
+    """The events of an SSE response in protocol 2 (JSON arrays), with the second
+    "data: " prefix stripped as the client does."""
+    events = []
+    for line in response.text.splitlines():
+        if not line.startswith('data: '):
+            continue
+        payload = line[len('data: '):]
+        if payload.startswith('data: '):
+            payload = payload[len('data: '):]
+        if payload.strip():
+            events.extend(json.loads(payload))
+    return events
+
+
+def sse_messages(response):
+    """The (id, payload) pairs of a protocol 1 SSE response."""
+    messages = []
+    for block in response.text.split('\r\n\r\n'):
+        lines = block.split('\r\n')
+        ids = [line[len('id: '):] for line in lines if line.startswith('id: ')]
+        data = [line[len('data: data: '):] for line in lines if line.startswith('data: data: ')]
+        if data:
+            messages.append((ids[0] if ids else None, data[0]))
+    return messages
+
+
+class ProtocolTest(unittest.TestCase):
+    """protocol=1 sends one event per SSE message, protocol=2 arrays of them."""
+
+    CODE = "".join(f"print {n}\n" for n in range(40))
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def get(self, **params):
+        return self.client.get('/api/stream', params={'code': self.CODE, **params})
+
+    def test_protocol_1(self):
+        for params in ({}, {'protocol': 1}):
+            with self.subTest(params=params):
+                messages = sse_messages(self.get(**params))
+                events = [json.loads(payload) for _, payload in messages]
+                self.assertEqual(events, [{'type': 'stdout', 'content': f'{float(n)}'} for n in range(40)]
+                                 + [{'type': 'env_snapshot', 'content': {}}])
+                self.assertTrue(all(message_id for message_id, _ in messages))
+
+    def test_protocol_2(self):
+        # Frames of at least MAX_FRAME_BYTES, but for the last
+        with mock.patch.object(worker_pool, 'MAX_FRAME_BYTES', 200), \
+                mock.patch.object(worker_pool, 'MAX_FRAME_DELAY', 5):
+            messages = sse_messages(self.get(protocol=2))
+        frames = [json.loads(payload) for _, payload in messages]
+        self.assertTrue(all(isinstance(frame, list) for frame in frames))
+        self.assertEqual([event for frame in frames for event in frame],
+                         [{'type': 'stdout', 'content': f'{float(n)}'} for n in range(40)]
+                         + [{'type': 'env_snapshot', 'content': {}}])
+        sizes = [sum(len(json.dumps(event)) for event in frame) for frame in frames]
+        self.assertGreater(len(frames), 5)
+        self.assertTrue(all(200 <= size < 250 for size in sizes[:-1]), sizes)
+
+    def test_unknown_protocol(self):
+        for protocol in (0, 3):
+            with self.subTest(protocol=protocol):
+                response = self.get(protocol=protocol)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("Unsupported protocol", response.text)
+
+
+class ResumeTest(unittest.TestCase):
+    """A client reconnecting with the Last-Event-ID header gets the rest of the run."""
+
+    CODE = "print 1\nprint 2\nprint 3\n"
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def resume(self, last_event_id):
+        return self.client.get('/api/stream', params={'code': self.CODE}, headers={'Last-Event-ID': last_event_id})
+
+    def test_resume_after_each_message(self):
+        messages = sse_messages(self.client.get('/api/stream', params={'code': self.CODE}))
+        self.assertEqual([json.loads(payload)['type'] for _, payload in messages],
+                         ['stdout', 'stdout', 'stdout', 'env_snapshot'])
+        for n, (last_event_id, _) in enumerate(messages[:-1]):
+            with self.subTest(last_event_id=last_event_id):
+                self.assertEqual(sse_messages(self.resume(last_event_id)), messages[n + 1:])
+        self.assertEqual(self.resume(messages[-1][0]).status_code, 204)
+
+    def test_unknown_run(self):
+        for last_event_id in ('nope.1', 'garbage'):
+            with self.subTest(last_event_id=last_event_id):
+                self.assertEqual(self.resume(last_event_id).status_code, 410)
+
+
+class SingleFlightTest(unittest.TestCase):
+    """Identical requests arriving together run the program once."""
+
+    # Long enough that the other requests come while it runs
+    CODE = "a = 1\n" + "a = a + 1\n" * 20000 + "print a\n"
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+
+    def test_concurrent_identical_requests(self):
+        async def requests(count):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+                return await asyncio.gather(*(
+                    client.post('/api/stream?protocol=2', content=self.CODE, headers={'Content-Type': 'text/plain'})
+                    for _ in range(count)))
+
+        stats = RESULT_CACHE.stats()
+        responses = asyncio.run(requests(4))
+        results = [stream_events(response) for response in responses]
+        self.assertEqual(results[0], [{'type': 'stdout', 'content': '20001.0'},
+                                      {'type': 'env_snapshot', 'content': {'a': 20001.0}}])
+        self.assertEqual(results, results[:1] * 4)
+        self.assertEqual(RESULT_CACHE.stats()['joined'], stats['joined'] + 3)
+        self.assertEqual(RESULT_CACHE.stats()['entries'], 1)
+
+
+def metrics(client):
+    """The samples of GET /api/metrics, by name with labels."""
+    samples = {}
+    for line in client.get('/api/metrics').text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+class MetricsTest(unittest.TestCase):
+    """Runs counted and timed by phase in /api/metrics, with or without a session."""
+
+    COUNTERS = ('expr_runs_total', 'expr_prints_total', 'expr_syntax_errors_total',
+                'expr_runtime_errors_total', 'expr_fatal_errors_total')
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def assertCounted(self, request, expected, phases):
+        before = metrics(self.client)
+        request()
+        after = metrics(self.client)
+        changes = {name: after.get(name, 0) - before.get(name, 0) for name in self.COUNTERS}
+        self.assertEqual(changes, dict(zip(self.COUNTERS, expected)))
+        self.assertGreater(after['expr_streamed_bytes_total'], before['expr_streamed_bytes_total'])
+        for name in ('expr_queue_wait_seconds_count', 'expr_first_byte_seconds_count', 'expr_stream_seconds_count'):
+            self.assertEqual(after[name] - before.get(name, 0), 1, name)
+        for phase in phases:
+            with self.subTest(phase=phase):
+                count = f'expr_phase_seconds_count{{phase="{phase}"}}'
+                self.assertEqual(after[count] - before.get(count, 0), 1)
+                # Every phase of so small a program takes well under a second.
+                bucket = f'expr_phase_seconds_bucket{{phase="{phase}",le="1"}}'
+                self.assertEqual(after[bucket] - before.get(bucket, 0), 1)
+                self.assertEqual(after[f'expr_phase_seconds_bucket{{phase="{phase}",le="+Inf"}}'], after[count])
+
+    def get(self, code):
+        return lambda: self.client.get('/api/stream', params={'code': code})
+
+    def post(self, code):
+        # As the frontend does it: in a new session
+        return lambda: self.client.post('/api/stream?protocol=2&session=', content=code,
+                                        headers={'Content-Type': 'text/plain'})
+
+    def test_print(self):
+        self.assertCounted(self.get("a = 1\nprint a\nprint a + 1\n"), (1, 2, 0, 0, 0),
+                           ('lex', 'parse', 'compile', 'eval'))
+
+    def test_syntax_error(self):
+        self.assertCounted(self.get("print 1\na = (1 +\n"), (1, 0, 1, 0, 0), ('lex', 'parse'))
+
+    def test_runtime_error(self):
+        self.assertCounted(self.get("a = 2\nprint a\nassert a < 1\n"), (1, 1, 0, 1, 0),
+                           ('lex', 'parse', 'compile', 'eval'))
+
+    def test_session_runs(self):
+        self.assertCounted(self.post("m = 1\nprint m\nprint m * 2\n"), (1, 2, 0, 0, 0), ('parse', 'eval'))
+        self.assertCounted(self.post("m = 1\nprint m\nassert m < 1\n"), (1, 1, 0, 1, 0), ('parse', 'eval'))
+        self.assertCounted(self.post("m = 1\nprint (m\n"), (1, 0, 1, 0, 0), ('parse',))
+
+
+class SessionResultCacheTest(unittest.TestCase):
+    """Requests as frontend/lib/streamClient.jsx sends them: POST /api/stream?protocol=2
+    with a gzip-compressed text/plain body, `session` empty for a new session."""
+
+    CODE = "a = 2\nb = a * 3\nprint(b)\nc = d + 1\n"
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def post(self, code, session=''):
+        return self.client.post(
+            f'/api/stream?protocol=2&session={session}', content=gzip.compress(code.encode()),
+            headers={'Content-Type': 'text/plain', 'Content-Encoding': 'gzip'})
+
+    def test_first_run_of_a_new_session_is_cached(self):
+        hits = RESULT_CACHE.stats()['hits']
+        first = stream_events(self.post(self.CODE))
+        self.assertEqual(RESULT_CACHE.stats()['hits'], hits)
+        second = stream_events(self.post(self.CODE))
+        self.assertEqual(RESULT_CACHE.stats()['hits'], hits + 1)
+
+        # The same events, but each session gets its own 'session' event.
+        self.assertEqual(first[:-1], second[:-1])
+        self.assertEqual([event['type'] for event in second],
+                         ['stdout', 'runtime_error', 'recomputed', 'env_snapshot', 'session'])
+        self.assertNotEqual(first[-1]['content']['id'], second[-1]['content']['id'])
+        self.assertEqual(first[-1]['content']['version'], second[-1]['content']['version'])
+
+    def test_session_adopting_a_cached_run_takes_edits(self):
+        self.post(self.CODE)
+        session = stream_events(self.post(self.CODE))[-1]['content']
+        edits = {'version': session['version'], 'edits': [{'offset': 0, 'length': 5, 'text': 'a = 3'}]}
+        response = self.client.post(
+            f"/api/stream?protocol=2&session={session['id']}", content=json.dumps(edits),
+            headers={'Content-Type': 'application/json'})
+        events = stream_events(response)
+        self.assertEqual(events[0], {'type': 'stdout', 'content': '9.0'})
+        self.assertEqual(events[-2]['content'], {'a': 3.0, 'b': 9.0})
+        self.assertEqual(events[-1]['content']['version'], session['version'] + 1)
+
+    def test_later_runs_of_a_session_are_not_cached(self):
+        session = stream_events(self.post(self.CODE))[-1]['content']
+        stats = RESULT_CACHE.stats()
+        self.post(self.CODE, session['id'])
+        self.assertEqual(RESULT_CACHE.stats()['hits'], stats['hits'])
+        self.assertEqual(RESULT_CACHE.stats()['entries'], stats['entries'])
+
+
+class AdmissionTest(unittest.TestCase):
+    """With every worker busy and the wait queue full, requests get 503 and a Retry-After."""
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+        self.pool = WorkerPool(max_workers=1, max_queue=1)
+        patcher = mock.patch.object(single_server, 'WORKER_POOL', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(app)
+        self.addCleanup(self.client.close)
+
+    def test_full_pool(self):
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        self.pool.try_submit(gate.wait, 5)
+        while self.pool.stats()['active'] < 1:
+            time.sleep(0.01)
+        self.pool.try_submit(gate.wait, 5)
+
+        for response in (self.client.get('/api/stream', params={'code': "print 1\n"}),
+                         self.client.post('/api/batch', params={'code': "print a\n"}, json=[{'a': 1}])):
+            with self.subTest(path=response.request.url.path):
+                self.assertEqual(response.status_code, 503)
+                self.assertRegex(response.headers['Retry-After'], r'^[1-9][0-9]*$')
+        stats = self.client.get('/api/pool').json()
+        self.assertEqual({name: stats[name] for name in ('workers', 'active', 'queued', 'max_queue', 'rejected')},
+                         {'workers': 1, 'active': 1, 'queued': 1, 'max_queue': 1, 'rejected': 2})
+
+        time.sleep(0.1)
+        gate.set()
+        self.assertEqual(stream_events(self.client.get('/api/stream', params={'code': "print 1\n", 'protocol': 2})),
+                         [{'type': 'stdout', 'content': '1.0'}, {'type': 'env_snapshot', 'content': {}}])
+        stats = self.client.get('/api/pool').json()
+        self.assertEqual((stats['active'], stats['queued'], stats['completed']), (0, 0, 3))
+        # The queued job waited for the first one.
+        self.assertGreaterEqual(stats['wait_max_ms'], 100)
+
+
+class OpenStream:
+    """A GET /api/stream request whose response is read as it comes, until disconnect()."""
+
+    def __init__(self, params):
+        self.headers = asyncio.get_running_loop().create_future()
+        self.body = []
+        self._disconnected = asyncio.Event()
+        self._requested = False
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': '/api/stream', 'raw_path': b'/api/stream', 'root_path': '',
+            'query_string': urlencode(params).encode(), 'headers': [(b'host', b'test')],
+            'server': ('test', 80), 'client': ('127.0.0.1', 1234),
+        }
+        self.task = asyncio.ensure_future(app(scope, self._receive, self._send))
+
+    async def _receive(self):
+        if not self._requested:
+            self._requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self._disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def _send(self, message):
+        if message['type'] == 'http.response.start':
+            self.headers.set_result({name.decode(): value.decode() for name, value in message['headers']})
+        elif message.get('body'):
+            self.body.append(message['body'])
+
+    def disconnect(self):
+        self._disconnected.set()
+
+
+class RunCancelTest(unittest.TestCase):
+    """A run stopped with DELETE /api/runs/{id}, or by a client that went away with
+    its output piling up, frees its worker thread right away."""
+
+    def setUp(self):
+        RESULT_CACHE.clear()
+
+    async def assertWorkerFreed(self, before):
+        for _ in range(200):
+            stats = WORKER_POOL.stats()
+            if stats['active'] == before['active']:
+                break
+            await asyncio.sleep(0.05)
+        self.assertEqual(stats['active'], before['active'])
+        self.assertEqual(stats['cancelled'], before['cancelled'] + 1)
+
+    def test_delete(self):
+        # Takes a couple of seconds, printing nothing until the end
+        code = "a = 2\n" + "a = a + 1\n" * 50000 + "print a\n"
+
+        async def scenario():
+            before = WORKER_POOL.stats()
+            stream = OpenStream({'code': code})
+            run_id = (await stream.headers)['x-run-id']
+            await asyncio.sleep(0.2)
+            self.assertEqual(WORKER_POOL.stats()['active'], before['active'] + 1)
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+                self.assertEqual((await client.delete(f'/api/runs/{run_id}')).status_code, 204)
+            await self.assertWorkerFreed(before)
+            await asyncio.wait_for(stream.task, 5)
+        asyncio.run(scenario())
+
+    def test_disconnect_with_output_unread(self):
+        code = "a = 3\n" + "a = a + 1\nprint a\n" * 20000
+        for pool, name, size in ((WORKER_POOL, 'output_bytes', 4096), (RUNS, 'max_run_bytes', 4096)):
+            self.addCleanup(setattr, pool, name, getattr(pool, name))
+            setattr(pool, name, size)
+
+        async def scenario():
+            before = WORKER_POOL.stats()
+            stream = OpenStream({'code': code})
+            await stream.headers
+            while not stream.body:
+                await asyncio.sleep(0.01)
+            stream.disconnect()
+            await asyncio.wait_for(stream.task, 5)
+            await self.assertWorkerFreed(before)
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
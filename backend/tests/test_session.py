@@ -0,0 +1,69 @@
+import json
+import threading
+import time
+import unittest
+
+from Session import Session
+
+
+class YieldingLock:
+    """A lock that gives the threads waiting for it time to take it each time it is released."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def acquire(self, *args):
+        return self._lock.acquire(*args)
+
+    def release(self):
+        self._lock.release()
+        time.sleep(0.05)
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SessionTest(unittest.TestCase):
+
+    def test_rerun(self):
+        session = Session('s')
+        session.run("a = 1\nb = 2\n", lambda event: None)
+        session.run("c = a + b\n", lambda event: None)
+        session.rerun(1, "b = 5\nc = a + b\n", lambda event: None)
+        self.assertEqual(session.statements, 3)
+        self.assertEqual(session.env, {'a': 1.0, 'b': 5.0, 'c': 6.0})
+
+    def test_nothing_runs_between_a_rerun_and_its_rewind(self):
+        session = Session('s')
+        session.run("a = 1\nb = 2\n", lambda event: None)
+        session._lock = YieldingLock()
+        events = []
+        rewind = session._rewind
+        other = threading.Thread(target=session.run, args=("print b\n", events.append))
+
+        def rewind_then_run_another(start, cancel_token):
+            rewind(start, cancel_token)
+            other.start()
+        session._rewind = rewind_then_run_another
+        session.rerun(1, "b = 5\nprint b\n", events.append)
+        other.join()
+        printed = [json.loads(event)['content'] for event in events if '"stdout"' in event]
+        self.assertEqual(printed, ['5.0', '5.0'])
+
+    def test_sync_stopped_by_an_arithmetic_error(self):
+        # The error escapes, but the session keeps the program and what it assigned.
+        session = Session('s')
+        with self.assertRaises(ZeroDivisionError):
+            session.sync("a = 2\nb = a / 0\nc = 3\n", lambda event: None)
+        self.assertEqual((session.env, session.statements, session.version), ({'a': 2.0}, 3, 1))
+
+        events = []
+        session.sync("a = 2\nb = a / 1\nc = 3\n", events.append)
+        self.assertEqual(session.env, {'a': 2.0, 'b': 2.0, 'c': 3.0})
+        self.assertEqual(json.loads(events[-1])['content']['recomputed'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
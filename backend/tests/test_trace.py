@@ -0,0 +1,100 @@
+import unittest
+
+from ExprAst import Name
+from ExprCompiler import CompiledProgram
+from ExprTrace import Tracer
+from ProgramCache import ProgramCache
+from tests.test_engines import Recorder
+
+CODE = "a = 1 + b\nprint a * 2\n\nassert a > 5\nprint a\n"
+
+
+class Recording(Tracer):
+    """Records every hook call, in order; with `nodes`, on_node too."""
+
+    def __init__(self, nodes=True):
+        self.calls = []
+        if nodes:
+            self.on_node = lambda node, value: self.calls.append(
+                ('node', node.name if type(node) is Name else type(node).__name__, value))
+
+    def on_statement_start(self, stat, line):
+        self.calls.append(('start', type(stat).__name__, line))
+
+    def on_statement_end(self, stat, line, value):
+        self.calls.append(('end', line, value))
+
+    def on_assign(self, name, value):
+        self.calls.append(('assign', name, value))
+
+    def on_error(self, stat, line, error):
+        self.calls.append(('error', line, str(error)))
+
+
+class TracerTest(unittest.TestCase):
+
+    def traced(self, code=CODE, nodes=True, **options):
+        tracer = Recording(nodes)
+        interpreter = Recorder(initial_env={'b': 2.0}, **options)
+        interpreter.add_tracer(tracer)
+        interpreter.interpret(code)
+        return tracer.calls, interpreter.output
+
+    def test_hooks_in_order(self):
+        calls, output = self.traced()
+        self.assertEqual(calls, [
+            ('start', 'Assign', 1),
+            ('node', 'Const', 1.0), ('node', 'b', 2.0), ('node', 'BinOp', 3.0), ('node', 'Assign', 3.0),
+            ('assign', 'a', 3.0), ('end', 1, 3.0),
+            ('start', 'Print', 2),
+            ('node', 'a', 3.0), ('node', 'Const', 2.0), ('node', 'BinOp', 6.0), ('node', 'Print', 6.0),
+            ('end', 2, 6.0),
+            ('start', 'Assert', 4),
+            ('node', 'a', 3.0), ('node', 'Const', 5.0), ('node', 'Compare', False),
+            ('error', 4, "Assertion failed."),
+        ])
+        self.assertEqual(output, [('print', '6.0'), ('Runtime Error', 'Assertion failed.', 4, 7)])
+
+    def test_statement_hooks_only(self):
+        calls, _ = self.traced(nodes=False)
+        self.assertEqual([call[0] for call in calls], ['start', 'assign', 'end', 'start', 'end', 'start', 'error'])
+
+    def test_same_output_as_untraced_runs(self):
+        for engine in ("compiled", "ast", "stack"):
+            with self.subTest(engine=engine):
+                untraced = Recorder(engine=engine, initial_env={'b': 2.0})
+                untraced.interpret(CODE)
+                self.assertEqual(self.traced(engine=engine)[1], untraced.output)
+
+    def test_arithmetic_errors(self):
+        tracer = Recording(nodes=False)
+        interpreter = Recorder()
+        interpreter.add_tracer(tracer)
+        with self.assertRaises(ZeroDivisionError):
+            interpreter.interpret("a = 1\nb = a - 1\nprint a / b\n")
+        self.assertEqual(tracer.calls[-2:], [('start', 'Print', 3), ('error', 3, "float division by zero")])
+
+    def test_tracer_added_after_compile(self):
+        # The program compiled untraced is cached; compiling again with a tracer must
+        # not pick it up, or the tracer would never be called.
+        cache = ProgramCache()
+        interpreter = Recorder(initial_env={'b': 2.0}, program_cache=cache)
+        compiled = interpreter.compile(CODE)
+        self.assertIsInstance(compiled, CompiledProgram)
+
+        tracer = Recording(nodes=False)
+        interpreter.add_tracer(tracer)
+        interpreter.run(compiled)
+        self.assertEqual(tracer.calls, [])  # already compiled: not traced
+        interpreter.interpret(CODE)
+        self.assertEqual([call[0] for call in tracer.calls], ['start', 'assign', 'end', 'start', 'end', 'start', 'error'])
+        self.assertEqual(cache.stats()['entries'], 2)
+
+        # Without tracers again, the compiled program is used.
+        interpreter.remove_tracer(tracer)
+        self.assertIsInstance(interpreter.compile(CODE), CompiledProgram)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
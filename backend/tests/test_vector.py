@@ -0,0 +1,35 @@
+import unittest
+
+import numpy as np
+
+from tests.test_engines import Recorder
+
+
+class VectorEngineTest(unittest.TestCase):
+
+    def test_element_wise(self):
+        interpreter = Recorder(engine="vector", initial_env={'a': [1, 2, 3], 'n': 2})
+        interpreter.interpret("b = a * n\nassert b < 5\nprint b\n")
+        self.assertEqual(interpreter.output, [('Runtime Error', 'Assertion failed for 1 of 3 elements (at 2).', 2, 7)])
+        np.testing.assert_array_equal(interpreter.env['b'], [2.0, 4.0, 6.0])
+
+    def test_variables_keep_their_values(self):
+        # Lists and integer arrays run as float arrays; the caller's env keeps them as given.
+        values = {'a': [1, 2, 3], 'i': np.arange(3), 'f': np.ones(3), 'n': 2}
+        env = dict(values)
+        interpreter = Recorder(engine="vector", initial_env=env)
+        interpreter.interpret("b = a + i + f + n\n")
+        for name, value in values.items():
+            self.assertIs(env[name], value)
+        np.testing.assert_array_equal(env['b'], [4.0, 6.0, 8.0])
+
+    def test_assigned_variables_are_written_back(self):
+        env = {'a': [1, 2, 3]}
+        interpreter = Recorder(engine="vector", initial_env=env)
+        interpreter.interpret("a = a / 0\n")
+        self.assertIsInstance(env['a'], np.ndarray)
+        self.assertTrue(np.isinf(env['a']).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
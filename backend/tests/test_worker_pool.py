@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+import WorkerPool as worker_pool
+from WorkerPool import WorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """Jobs beyond the running and queued limits are turned away, not piled up."""
+
+    def test_full_queue_rejects(self):
+        pool = WorkerPool(max_workers=1, max_queue=1)
+        self.addCleanup(pool._executor.shutdown)
+        gate = threading.Event()
+        running = pool.try_submit(gate.wait, 5)
+        while pool.stats()['active'] < 1:
+            time.sleep(0.01)
+        queued = pool.try_submit(lambda: 'queued')
+        self.assertIsNone(pool.try_submit(lambda: 'rejected'))
+        stats = pool.stats()
+        self.assertEqual((stats['active'], stats['queued'], stats['rejected']), (1, 1, 1))
+        self.assertIsInstance(pool.retry_after(), int)
+        self.assertGreaterEqual(pool.retry_after(), 1)
+
+        time.sleep(0.1)
+        gate.set()
+        self.assertTrue(running.result(5))
+        self.assertEqual(queued.result(5), 'queued')
+        stats = pool.stats()
+        self.assertEqual((stats['active'], stats['queued'], stats['completed']), (0, 0, 2))
+        # The second job waited for the first one.
+        self.assertGreaterEqual(stats['wait_max_ms'], 100)
+        self.assertGreater(stats['wait_avg_ms'], 0)
+
+    def test_retry_after_follows_the_backlog(self):
+        pool = WorkerPool(max_workers=2, max_queue=8)
+        self.addCleanup(pool._executor.shutdown)
+        pool._run_average = 3.0
+        pool.active, pool.queued = 2, 4
+        self.assertEqual(pool.retry_after(), 9)
+
+
+class FrameTest(unittest.TestCase):
+    """With `frames`, output comes in lists cut at MAX_FRAME_BYTES, or MAX_FRAME_DELAY
+    after their first item."""
+
+    def frames(self, work):
+        async def scenario():
+            pool = WorkerPool(max_workers=1)
+            self.addCleanup(pool._executor.shutdown)
+            return [frame async for frame in pool.submit_stream(work, frames=True)]
+        return asyncio.run(scenario())
+
+    def test_size(self):
+        items = [f"{n:010d}" for n in range(25)]
+
+        def work(emit, cancel_token):
+            for item in items:
+                emit(item)
+        with mock.patch.object(worker_pool, 'MAX_FRAME_BYTES', 100), mock.patch.object(worker_pool, 'MAX_FRAME_DELAY', 5):
+            frames = self.frames(work)
+        self.assertEqual([len(frame) for frame in frames], [10, 10, 5])
+        self.assertEqual([item for frame in frames for item in frame], items)
+
+    def test_delay(self):
+        def work(emit, cancel_token):
+            emit("a")
+            emit("b")
+            time.sleep(0.3)
+            emit("c")
+        with mock.patch.object(worker_pool, 'MAX_FRAME_DELAY', 0.1):
+            self.assertEqual(self.frames(work), [["a", "b"], ["c"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
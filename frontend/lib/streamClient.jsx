@@ -0,0 +1,223 @@
+// Client for POST /api/stream: the program goes in the request body (gzip-compressed
+// where the browser has CompressionStream) and the event stream is read with fetch,
+// so large programs are not limited by URL length and stay out of access logs.
+// Within a session, runs after the first send only what was edited. Streams resume
+// where they stopped if the connection drops.
+
+async function encodeBody(code, type = 'text/plain') {
+    const body = new Blob([code], { type });
+    if (typeof CompressionStream === 'undefined') {
+        return { body, headers: { 'Content-Type': type } };
+    }
+    const compressed = await new Response(
+        body.stream().pipeThrough(new CompressionStream('gzip'))
+    ).blob();
+    return { body: compressed, headers: { 'Content-Type': type, 'Content-Encoding': 'gzip' } };
+}
+
+// Turns one SSE message (its lines up to the blank line) into its id (null if it has
+// none) and the events it carries. Payloads arrive with a second "data: " prefix,
+// stripped here as with EventSource.
+function parseMessage(message) {
+    const lines = message.split(/\r?\n/);
+    const idLine = lines.find((line) => line.startsWith('id:'));
+    const id = idLine ? idLine.slice(3).trim() : null;
+    const data = lines
+        .filter((line) => line.startsWith('data:'))
+        .map((line) => line.slice(5).replace(/^ /, ''))
+        .join('\n');
+    const rawData = data.replace(/^data:\s*/, '').trim();
+    if (!rawData) {
+        return { id, events: [] };
+    }
+    const parsed = JSON.parse(rawData);
+    return { id, events: Array.isArray(parsed) ? parsed : [parsed] };
+}
+
+// Reads an SSE response, calling onMessage({ id, events }) for each message.
+async function readMessages(response, onMessage) {
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    for (;;) {
+        const { value, done } = await reader.read();
+        if (done) {
+            return;
+        }
+        buffer += value;
+        const messages = buffer.split(/\r?\n\r?\n/);
+        buffer = messages.pop();
+        messages.map(parseMessage).forEach(onMessage);
+    }
+}
+
+// Number of code points in `text`: edit offsets count Python characters, not UTF-16 units.
+function codePoints(text) {
+    const pairs = text.match(/[\uD800-\uDBFF][\uDC00-\uDFFF]/g);
+    return text.length - (pairs ? pairs.length : 0);
+}
+
+const isHighSurrogate = (unit) => unit >= 0xd800 && unit <= 0xdbff;
+const isLowSurrogate = (unit) => unit >= 0xdc00 && unit <= 0xdfff;
+
+// The single edit turning `before` into `after`: the span between their common
+// prefix and suffix, as { offset, length, text } in code points.
+function diff(before, after) {
+    const limit = Math.min(before.length, after.length);
+    let prefix = 0;
+    while (prefix < limit && before.charCodeAt(prefix) === after.charCodeAt(prefix)) {
+        prefix++;
+    }
+    if (prefix > 0 && isHighSurrogate(before.charCodeAt(prefix - 1))) {
+        prefix--;
+    }
+    let suffix = 0;
+    while (suffix < limit - prefix
+           && before.charCodeAt(before.length - 1 - suffix) === after.charCodeAt(after.length - 1 - suffix)) {
+        suffix++;
+    }
+    if (suffix > 0 && isLowSurrogate(before.charCodeAt(before.length - suffix))) {
+        suffix--;
+    }
+    return {
+        offset: codePoints(before.slice(0, prefix)),
+        length: codePoints(before.slice(prefix, before.length - suffix)),
+        text: after.slice(prefix, after.length - suffix),
+    };
+}
+
+// What a client knows of its server session: the id, and the program version the
+// server holds with its text, so a run can send just the edit since then.
+export class ProgramSession {
+    constructor() {
+        this.id = '';
+        this.version = 0;
+        this.text = null;
+    }
+
+    // Request for running `code`: its body (the edit from the server's program when
+    // that is known) and the version the server is expected to have (null if unknown).
+    request(code, allowEdits = true) {
+        if (!allowEdits || !this.id) {
+            return { body: code, version: null };
+        }
+        if (this.text === null) {
+            return { body: code, version: this.version };
+        }
+        const edits = [diff(this.text, code)];
+        return {
+            body: JSON.stringify({ version: this.version, edits }),
+            type: 'application/json',
+            version: this.version,
+        };
+    }
+
+    // Takes in the 'session' event ending a run of `code` requested at `sentVersion`.
+    // A different version means the server now holds `code`, the same version that
+    // it never got to it, and version 0 that it holds no program to edit.
+    update(event, code, sentVersion) {
+        this.id = event.content.id;
+        if (event.content.version !== sentVersion) {
+            this.text = event.content.version === 0 ? null : code;
+        }
+        this.version = event.content.version;
+    }
+}
+
+async function post(body, type, session, signal, profile) {
+    const encoded = await encodeBody(body, type);
+    let url = '/api/stream?protocol=2';
+    if (session !== undefined) {
+        url += `&session=${encodeURIComponent(session.id)}`;
+    }
+    if (profile) {
+        url += '&profile=true';
+    }
+    return fetch(url, { method: 'POST', body: encoded.body, headers: encoded.headers, signal });
+}
+
+// Attempts at resuming a stream whose connection dropped, the first after RESUME_DELAY_MS
+// and each later one after twice as long as the one before.
+const RESUME_ATTEMPTS = 4;
+const RESUME_DELAY_MS = 500;
+
+const delay = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+async function checkResponse(response) {
+    if (!response.ok) {
+        throw new Error(`${response.status} ${response.statusText}: ${await response.text()}`);
+    }
+    return response;
+}
+
+// Runs `code` and calls onEvents(events) for each batch of events as it arrives.
+// Resolves when the stream ends; rejects on HTTP errors (e.g. 503 when the server is
+// busy) or with an AbortError once `signal` is aborted, which also stops the run on
+// the server. If the connection drops, the stream is resumed from the last event
+// received (Last-Event-ID): the server kept running the program and buffering its
+// output, so nothing runs twice.
+// With a `session` (a ProgramSession, empty for a new session), only the statements
+// changed since that session's previous program are evaluated, and only the edit
+// since then is sent (the whole program again if the server lost that version);
+// the 'session' event ending the stream updates `session` for the next run.
+// With `profile`, a 'profile' event near the end of the stream measures each statement;
+// the run then goes without the session, as it has to evaluate every statement.
+export async function streamProgram(code, { onEvents, signal, session, profile = false }) {
+    if (profile) {
+        session = undefined;
+    }
+    let request = session !== undefined ? session.request(code) : { body: code, version: null };
+    let response = await post(request.body, request.type, session, signal, profile);
+    if (response.status === 409 && request.type === 'application/json') {
+        request = session.request(code, false);
+        response = await post(request.body, request.type, session, signal, profile);
+    }
+    await checkResponse(response);
+
+    const runId = response.headers.get('X-Run-Id');
+    const stopRun = () => fetch(`/api/runs/${encodeURIComponent(runId)}`, { method: 'DELETE' }).catch(() => {});
+    if (runId && signal) {
+        signal.addEventListener('abort', stopRun, { once: true });
+    }
+
+    let lastId = null;
+    const onMessage = ({ id, events }) => {
+        if (id !== null) {
+            lastId = id;
+        }
+        if (events.length === 0) {
+            return;
+        }
+        if (session !== undefined) {
+            const ended = events.find((event) => event.type === 'session');
+            if (ended) {
+                session.update(ended, code, request.version);
+            }
+        }
+        onEvents(events);
+    };
+
+    try {
+        for (let attempt = 0; ; attempt++) {
+            try {
+                await readMessages(response, onMessage);
+                return;
+            } catch (error) {
+                if (error.name === 'AbortError' || lastId === null || attempt >= RESUME_ATTEMPTS) {
+                    throw error;
+                }
+            }
+            await delay(RESUME_DELAY_MS * 2 ** attempt);
+            response = await fetch('/api/stream?protocol=2', {
+                method: 'POST', headers: { 'Last-Event-ID': lastId }, signal,
+            });
+            if (response.status === 204) {
+                return;  // the connection dropped just as the stream ended
+            }
+            await checkResponse(response);
+        }
+    } finally {
+        if (runId && signal) {
+            signal.removeEventListener('abort', stopRun);
+        }
+    }
+}
@@ -4,6 +4,7 @@ import dynamic from "next/dynamic";
 import Split from 'react-split';
 import React from 'react';
 import { Inter, JetBrains_Mono } from 'next/font/google';
+import { ProgramSession, streamProgram } from '../lib/streamClient';
 
 // 1. Define the UI font
 const inter = Inter({
@@ -25,6 +26,9 @@ const BORDER_COLOR = '#343A40';
 const PRIMARY_ACCENT = '#9370DB';
 const OUTPUT_FLASH_COLOR = '#7B68EE';
 
+// Stream events that carry state rather than program output.
+const SESSION_EVENT_TYPES = new Set(['env_snapshot', 'session', 'recomputed', 'profile']);
+
 
 // --- Utility Components ---
 
@@ -97,6 +101,52 @@ const OutputList = React.memo(({ events }) => {
 });
 OutputList.displayName = 'OutputList';
 
+// Hot-line gutter for a 'profile' event: one row per source line that ran, shaded by
+// its share of the slowest line's time. Statements sharing a line are summed.
+const ProfileGutter = React.memo(({ statements }) => {
+    const lines = useMemo(() => {
+        const byLine = new Map();
+        for (const stat of statements) {
+            const line = byLine.get(stat.line) || { line: stat.line, seconds: 0, nodes: 0, pows: 0, magnitude: 0 };
+            line.seconds += stat.seconds;
+            line.nodes += stat.nodes;
+            line.pows += stat.pows;
+            // JSON has no infinity: the server sends "inf"
+            line.magnitude = Math.max(line.magnitude, stat.max_magnitude === 'inf' ? Infinity : stat.max_magnitude);
+            byLine.set(stat.line, line);
+        }
+        return [...byLine.values()].sort((a, b) => a.line - b.line);
+    }, [statements]);
+    const slowest = Math.max(...lines.map((line) => line.seconds), Number.EPSILON);
+
+    return (
+        <div className="font-code text-xs mb-3 border-b pb-2" style={{ borderColor: BORDER_COLOR }}>
+            <div className="flex text-gray-500 pb-1">
+                <span className="w-12 text-right pr-2">line</span>
+                <span className="w-20 text-right">ms</span>
+                <span className="w-20 text-right">nodes</span>
+                <span className="w-12 text-right">pow</span>
+                <span className="w-24 text-right">max |x|</span>
+            </div>
+            {lines.map((line) => (
+                <div key={line.line} className="flex text-gray-300">
+                    <span
+                        className="w-12 text-right pr-2 rounded-sm"
+                        style={{ backgroundColor: `${OUTPUT_FLASH_COLOR}${Math.round(255 * line.seconds / slowest).toString(16).padStart(2, '0')}` }}
+                    >
+                        {line.line}
+                    </span>
+                    <span className="w-20 text-right">{(line.seconds * 1000).toFixed(3)}</span>
+                    <span className="w-20 text-right">{line.nodes}</span>
+                    <span className="w-12 text-right">{line.pows}</span>
+                    <span className="w-24 text-right">{line.magnitude.toPrecision(3)}</span>
+                </div>
+            ))}
+        </div>
+    );
+});
+ProfileGutter.displayName = 'ProfileGutter';
+
 
 const VariableEntryComponent = ({ name, value, isRoot = false, depth = 0 }) => {
     const type = typeof value;
@@ -244,12 +294,20 @@ assert x > 0
 `);
     const [outputEvents, setOutputEvents] = useState([]);
     const [finalEnv, setFinalEnv] = useState(null);
+    // Whether runs are profiled, and the per-statement measurements of the last one that was
+    const [profiling, setProfiling] = useState(false);
+    const [profile, setProfile] = useState(null);
     const [running, setRunning] = useState(false);
     const [flashOutput, setFlashOutput] = useState(false);
     const [editorFontSize, setEditorFontSize] = useState(18);
 
     const outputRef = useRef(null);
-    const eventSourceRef = useRef(null);
+    const abortControllerRef = useRef(null);
+    // Server session of the previous run, so a rerun only sends and evaluates what was edited
+    const sessionRef = useRef(null);
+    if (sessionRef.current === null) {
+        sessionRef.current = new ProgramSession();
+    }
 
     const triggerFlash = useCallback(() => {
         setFlashOutput(true);
@@ -259,78 +317,66 @@ assert x > 0
     const clearOutput = useCallback(() => {
         setOutputEvents([]);
         setFinalEnv(null);
+        setProfile(null);
     }, []);
 
     const runCode = useCallback(() => {
         clearOutput();
         setRunning(true);
 
-        const evtSource = new EventSource(
-            `/api/stream?code=${encodeURIComponent(code)}`
-        );
-        eventSourceRef.current = evtSource;
-
-        evtSource.onmessage = (e) => {
-            const rawData = e.data.replace(/^data:\s*/, '');
-
-            try {
-                const event = JSON.parse(rawData);
+        const controller = new AbortController();
+        abortControllerRef.current = controller;
 
-                if (event.type === 'env_snapshot') {
-                    setFinalEnv(event.content);
-                    evtSource.close();
-                    setRunning(false);
-                    eventSourceRef.current = null;
-                } else {
+        streamProgram(code, {
+            signal: controller.signal,
+            session: sessionRef.current,
+            profile: profiling,
+            onEvents: (events) => {
+                const outputs = events.filter((event) => !SESSION_EVENT_TYPES.has(event.type));
+                if (outputs.length > 0) {
                     setOutputEvents((prev) => {
-                        const newEvents = [...prev, event];
+                        const newEvents = [...prev, ...outputs];
                         triggerFlash();
                         return newEvents;
                     });
                 }
 
-            } catch (error) {
-                console.error("Failed to parse event data:", rawData, error);
-                setOutputEvents((prev) => {
-                    const newEvents = [...prev, { type: 'client_error', content: `[Client Error] Failed to read stream data on final event.` }];
-                    triggerFlash();
-                    return newEvents;
-                });
-            }
-        };
-
-        evtSource.addEventListener('close', () => {
-            console.log("SSE Stream received 'close' event. Terminating connection.");
-            evtSource.close();
-            setRunning(false);
-            eventSourceRef.current = null;
-        });
-
+                const snapshot = events.find((event) => event.type === 'env_snapshot');
+                if (snapshot) {
+                    setFinalEnv(snapshot.content);
+                }
 
-        evtSource.onerror = (e) => {
-            if (evtSource.readyState === 2) {
-                console.warn("SSE Stream closed or failed irreversibly. Assuming execution finished.");
-                setRunning(false);
-                evtSource.close();
-                eventSourceRef.current = null;
-            } else if (evtSource.readyState === 0) {
-                console.warn("SSE Connection warning: Retrying or initial connection issue.");
-            } else {
-                console.error("Unresolved SSE Error:", e);
+                const measured = events.find((event) => event.type === 'profile');
+                if (measured) {
+                    setProfile(measured.content);
+                }
+            },
+        }).catch((error) => {
+            if (error.name === 'AbortError') {
+                return;
+            }
+            console.error("Program stream failed:", error);
+            setOutputEvents((prev) => {
+                const newEvents = [...prev, { type: 'client_error', content: `[Client Error] ${error.message}` }];
+                triggerFlash();
+                return newEvents;
+            });
+        }).finally(() => {
+            // A newer run (or Stop) may already own the ref.
+            if (abortControllerRef.current === controller) {
+                abortControllerRef.current = null;
                 setRunning(false);
-                evtSource.close();
-                eventSourceRef.current = null;
             }
-        };
+        });
 
-        return () => evtSource.close();
-    }, [code, clearOutput]);
+        return () => controller.abort();
+    }, [code, profiling, clearOutput, triggerFlash]);
 
     const stopCode = useCallback(() => {
-        if (eventSourceRef.current) {
-            console.log("Stopping SSE stream manually.");
-            eventSourceRef.current.close();
-            eventSourceRef.current = null;
+        if (abortControllerRef.current) {
+            console.log("Stopping program stream manually.");
+            abortControllerRef.current.abort();
+            abortControllerRef.current = null;
         }
         setRunning(false);
         setOutputEvents(prev => {
@@ -589,20 +635,36 @@ assert x > 0
                                         )}
                                     </span>
 
-                                    {/* Clear Console Button */}
-                                    <button
-                                        onClick={clearOutput}
-                                        className={`px-3 py-0.5 text-xs rounded font-medium text-gray-300 hover:bg-[#505050] transition`}
-                                        title="Clear Console Output"
-                                    >
-                                        Clear 🗑️
-                                    </button>
+                                    <span className="flex items-center gap-3">
+                                        <label
+                                            className="flex items-center text-xs font-normal text-gray-400 cursor-pointer"
+                                            title="Measure each line's time, evaluated nodes, powers and largest value"
+                                        >
+                                            <input
+                                                type="checkbox"
+                                                checked={profiling}
+                                                onChange={(e) => setProfiling(e.target.checked)}
+                                                className="mr-1 accent-indigo-400"
+                                            />
+                                            Profile
+                                        </label>
+
+                                        {/* Clear Console Button */}
+                                        <button
+                                            onClick={clearOutput}
+                                            className={`px-3 py-0.5 text-xs rounded font-medium text-gray-300 hover:bg-[#505050] transition`}
+                                            title="Clear Console Output"
+                                        >
+                                            Clear 🗑️
+                                        </button>
+                                    </span>
                                 </div>
                                 <div
                                     ref={outputRef}
                                     className={`flex-1 p-4 overflow-y-auto`}
                                     style={{ backgroundColor: BG_DEEP }}
                                 >
+                                    {profile && profile.length > 0 && <ProfileGutter statements={profile} />}
                                     {/* Console Output Events - Using the new memoized OutputList */}
                                     {outputEvents.length > 0 ? (
                                         <OutputList events={outputEvents} />